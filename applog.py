@@ -0,0 +1,157 @@
+"""
+Structured, non-blocking application logging.
+
+Events are JSON objects (one per line) carrying the request id of the
+request that emitted them. Request threads only put records on a bounded
+queue; a QueueListener thread formats them and writes the rotating log
+file (and stdout with LOG_STDOUT=1), so a slow disk or a blocked docker
+stdout pipe never stalls a card scan. When the queue is full, records
+are dropped and counted instead of blocking.
+
+event() checks the level before building anything, so DEBUG events on
+the hot path cost one comparison when LOG_LEVEL is INFO.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+# Logging configuration
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.environ.get("LOG_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs",
+                                                   "laundry.jsonl"))
+LOG_STDOUT = os.environ.get("LOG_STDOUT", "1") == "1"
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.environ.get("LOG_BACKUPS", 5))
+LOG_QUEUE_SIZE = 10000
+
+request_id = contextvars.ContextVar("request_id", default=None)
+# perf_counter() at the start of the current request
+request_started = contextvars.ContextVar("request_started", default=None)
+
+_listener = None
+_handler = None
+_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        event = {"ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                 "level": record.levelname.lower(), "logger": record.name, "event": record.getMessage()}
+        rid = getattr(record, "request_id", None)
+        if rid:
+            event["request_id"] = rid
+        event.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            event["exc"] = self.formatException(record.exc_info)
+        return json.dumps(event, default=str, ensure_ascii=False)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Capture the request id on the request thread; formatting happens on the listener
+        record.request_id = request_id.get()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure(level=LOG_LEVEL, log_file=LOG_FILE, stdout=LOG_STDOUT):
+    """(Re)start the background writer. Safe to call more than once."""
+    global _listener, _handler
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+        handlers = []
+        if log_file:
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+            handlers.append(logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES,
+                                                                 backupCount=LOG_BACKUPS, encoding="utf-8"))
+        if stdout:
+            handlers.append(logging.StreamHandler(sys.stdout))
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+
+        root = logging.getLogger("laundry")
+        if _handler is not None:
+            root.removeHandler(_handler)
+        _handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        root.addHandler(_handler)
+        root.setLevel(level)
+        root.propagate = False
+        _listener = logging.handlers.QueueListener(_handler.queue, *handlers, respect_handler_level=False)
+        _listener.start()
+    return root
+
+
+def shutdown():
+    """Flush queued records; registered with atexit"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+atexit.register(shutdown)
+
+
+def get_logger(name):
+    return logging.getLogger(f"laundry.{name}")
+
+
+def event(logger, level, name, **fields):
+    """Log one structured event if `level` is enabled"""
+    if logger.isEnabledFor(level):
+        logger.log(level, name, extra={"fields": fields})
+
+
+def dropped():
+    return _handler.dropped if _handler else 0
+
+
+def queued():
+    return _handler.queue.qsize() if _handler else 0
+
+
+def instrument(app):
+    """Give every request an id (X-Request-Id is honoured and echoed) and a start time"""
+    from flask import request
+
+    @app.before_request
+    def _assign_request_id():
+        request_started.set(time.perf_counter())
+        request_id.set(request.headers.get("X-Request-Id") or uuid.uuid4().hex[:16])
+
+    @app.after_request
+    def _echo_request_id(response):
+        rid = request_id.get()
+        if rid:
+            response.headers["X-Request-Id"] = rid
+        return response
+
+    return app
+
+
+def elapsed_ms():
+    """Milliseconds since the current request started"""
+    started = request_started.get()
+    return round((time.perf_counter() - started) * 1000, 2) if started else None
@@ -0,0 +1,186 @@
+"""
+Online backups of the laundry database.
+
+Snapshots are taken with the SQLite backup API a few pages at a time,
+sleeping between steps so `/scan_card` never waits behind the copy. A
+write on another connection restarts that copy from the first page, so
+after BACKUP_MAX_RESTARTS restarts the rest is copied in a single step
+(under WAL that only holds a read snapshot, which writers do not wait
+for). Every snapshot is checked with PRAGMA integrity_check,
+gzip-compressed to ``$DB_DIR/backups/laundry_YYYYmmdd_HHMMSS.db.gz`` and
+old ones rotated.
+
+    python backup.py                      # take one snapshot now
+    python backup.py list                 # show snapshots
+    python backup.py restore <snapshot>   # restore a snapshot into the live db
+"""
+import sqlite3
+import os
+import glob
+import gzip
+import shutil
+import time
+from datetime import datetime
+
+# Database configuration
+DB_DIR = os.environ.get("DB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "database"))
+DB_PATH = os.path.join(DB_DIR, "laundry.db")
+BACKUP_DIR = os.environ.get("BACKUP_DIR", os.path.join(DB_DIR, "backups"))
+
+# Backup configuration
+BACKUP_PAGES_PER_STEP = int(os.environ.get("BACKUP_PAGES_PER_STEP", 64))
+BACKUP_STEP_PAUSE = float(os.environ.get("BACKUP_STEP_PAUSE", 0.005))
+BACKUP_MAX_RESTARTS = int(os.environ.get("BACKUP_MAX_RESTARTS", 3))
+BACKUP_KEEP = int(os.environ.get("BACKUP_KEEP", 14))
+BACKUP_SCHEDULE = os.environ.get("BACKUP_SCHEDULE", "30 4 * * *")
+
+
+class BackupError(Exception):
+    """Raised when a snapshot fails verification"""
+
+
+class _Restarted(Exception):
+    """The stepwise copy kept starting over"""
+
+
+def copy_database(src_path, dest_path, pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE,
+                  max_restarts=BACKUP_MAX_RESTARTS):
+    """
+    Copy src_path to dest_path with the incremental backup API.
+    The source read lock is only held while a step runs; between steps we
+    sleep so writers on other connections get their turn. Returns how
+    often the copy restarted and whether it ended in a single step.
+    """
+    copied, restarts = [0], [0]
+
+    def progress(status, remaining, total):
+        done = total - remaining
+        if done <= copied[0]:
+            restarts[0] += 1
+            if restarts[0] > max_restarts:
+                raise _Restarted()
+        copied[0] = done
+        if remaining:
+            time.sleep(pause)
+
+    src = sqlite3.connect(src_path, timeout=10.0)
+    dest = sqlite3.connect(dest_path)
+    try:
+        try:
+            src.backup(dest, pages=pages, progress=progress)
+            single_step = False
+        except _Restarted:
+            src.backup(dest)
+            single_step = True
+    finally:
+        dest.close()
+        src.close()
+    return {"restarts": min(restarts[0], max_restarts), "single_step": single_step}
+
+
+def verify_database(path):
+    """Run PRAGMA integrity_check; raise BackupError unless it says 'ok'"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        result = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+    finally:
+        conn.close()
+    if result != ["ok"]:
+        raise BackupError(f"integrity_check failed for {path}: {'; '.join(result[:5])}")
+
+
+def list_backups(backup_dir=BACKUP_DIR):
+    """Snapshot files, newest first"""
+    return sorted(glob.glob(os.path.join(backup_dir, "laundry_*.db.gz")), reverse=True)
+
+
+def rotate_backups(backup_dir=BACKUP_DIR, keep=BACKUP_KEEP):
+    """Delete all but the newest `keep` snapshots; returns the removed paths"""
+    removed = []
+    for path in list_backups(backup_dir)[keep:]:
+        os.remove(path)
+        removed.append(path)
+    return removed
+
+
+def create_backup(db_path=DB_PATH, backup_dir=BACKUP_DIR, keep=BACKUP_KEEP,
+                  pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE):
+    """Take, verify, compress and rotate one snapshot. Returns the snapshot path."""
+    os.makedirs(backup_dir, exist_ok=True)
+    started = time.time()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    raw_path = os.path.join(backup_dir, f".laundry_{timestamp}.db.tmp")
+    final_path = os.path.join(backup_dir, f"laundry_{timestamp}.db.gz")
+
+    try:
+        copied = copy_database(db_path, raw_path, pages, pause)
+        verify_database(raw_path)
+
+        partial = final_path + ".part"
+        with open(raw_path, "rb") as src, gzip.open(partial, "wb", compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(partial, final_path)
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+
+    removed = rotate_backups(backup_dir, keep)
+    print(f"✓ Backup written: {os.path.basename(final_path)} "
+          f"({os.path.getsize(final_path)} bytes, {time.time() - started:.1f}s, {copied['restarts']} restart(s)"
+          f"{', finished in one step' if copied['single_step'] else ''}, {len(removed)} rotated)")
+    return final_path
+
+
+def restore_backup(snapshot, db_path=DB_PATH, backup_dir=BACKUP_DIR):
+    """
+    Restore a snapshot into db_path. The snapshot is decompressed and
+    verified first, then copied in with the backup API so connections
+    that are still open see a consistent database.
+    """
+    if not os.path.exists(snapshot):
+        snapshot = os.path.join(backup_dir, snapshot)
+    if not os.path.exists(snapshot):
+        raise FileNotFoundError(snapshot)
+
+    raw_path = db_path + ".restore.tmp"
+    try:
+        if snapshot.endswith(".gz"):
+            with gzip.open(snapshot, "rb") as src, open(raw_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        else:
+            shutil.copyfile(snapshot, raw_path)
+        verify_database(raw_path)
+
+        src = sqlite3.connect(raw_path)
+        dest = sqlite3.connect(db_path, timeout=30.0)
+        try:
+            src.backup(dest)
+        finally:
+            dest.close()
+            src.close()
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+    print(f"✓ Restored {os.path.basename(snapshot)} into {db_path}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Laundry database backups")
+    parser.add_argument("command", nargs="?", default="create", choices=["create", "list", "restore"])
+    parser.add_argument("snapshot", nargs="?", help="snapshot file to restore")
+    parser.add_argument("--db", default=DB_PATH, help="database file")
+    parser.add_argument("--dir", default=BACKUP_DIR, help="backup directory")
+    parser.add_argument("--keep", type=int, default=BACKUP_KEEP, help="snapshots to keep")
+    args = parser.parse_args()
+
+    if args.command == "create":
+        create_backup(args.db, args.dir, args.keep)
+    elif args.command == "list":
+        for path in list_backups(args.dir):
+            print(f"{os.path.basename(path)}  {os.path.getsize(path)} bytes")
+    else:
+        if not args.snapshot:
+            parser.error("restore needs a snapshot file")
+        restore_backup(args.snapshot, args.db, args.dir)
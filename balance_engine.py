@@ -0,0 +1,443 @@
+"""
+In-memory authoritative balance engine.
+
+When BALANCE_ENGINE=1 every card balance lives in memory (an array of
+64-bit integers indexed through a card_id -> slot map) and each debit or
+top-up is appended to a journal before the request is answered. Journal
+writes are group-committed: one background writer fsyncs whatever has
+queued up since its last fsync, so many concurrent debits share one disk
+flush.
+
+Balances are checkpointed back into USERS periodically together with the
+last journal sequence number they include. A checkpoint adds the
+engine's net change per card since the last one (balance = balance + ?)
+rather than overwriting the column, and then takes in whatever other
+writers (cloneWep.py, a second tool on the same database) changed or
+added in USERS meanwhile, so their top-ups are kept. On startup the
+engine loads USERS (the snapshot) and replays journal records newer than
+that sequence number. A torn record at the end of the journal (crash mid
+write) fails its CRC and is cut off.
+
+If a journal write fails, the changes that did not become durable are
+undone in memory and the engine stops: every later debit, top-up and
+checkpoint raises JournalError until the process is restarted and the
+journal replayed.
+
+Journal record layout (little endian):
+
+    crc32:u32  seq:u64  op:u8  amount:i64  card_len:u16  card_id:bytes
+
+    python balance_engine.py replay      # rebuild, checkpoint and report
+"""
+import sqlite3
+import os
+import glob
+import struct
+import zlib
+import time
+import threading
+from array import array
+
+# Database configuration
+DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database")
+DB_PATH = os.path.join(DB_DIR, "laundry.db")
+JOURNAL_DIR = os.path.join(DB_DIR, "journal")
+
+# Engine configuration
+BALANCE_ENGINE_ENABLED = os.environ.get("BALANCE_ENGINE", "0") == "1"
+GROUP_COMMIT_DELAY = float(os.environ.get("BALANCE_GROUP_COMMIT_DELAY", 0.0))
+CHECKPOINT_SCHEDULE = os.environ.get("BALANCE_CHECKPOINT_SCHEDULE", "* * * * *")
+
+OP_DEBIT = 1
+OP_CREDIT = 2
+
+HEADER = struct.Struct("<IQBqH")
+
+
+class JournalError(Exception):
+    """Raised when a journal write could not be made durable"""
+
+
+def read_segment(path):
+    """
+    Yield (seq, op, amount, card_id, end_offset) for every intact record.
+    Stops at the first short or corrupt record.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        crc, seq, op, amount, card_len = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + card_len
+        if end > len(data):
+            break
+        if zlib.crc32(data[offset + 4:end]) != crc:
+            break
+        yield seq, op, amount, data[offset + HEADER.size:end].decode("utf-8"), end
+        offset = end
+
+
+def encode_record(seq, op, amount, card_id):
+    card = card_id.encode("utf-8")
+    body = HEADER.pack(0, seq, op, amount, len(card))[4:] + card
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+
+class Journal:
+    """Append-only, segmented journal with a group-commit writer thread"""
+
+    def __init__(self, journal_dir=JOURNAL_DIR, delay=GROUP_COMMIT_DELAY):
+        self.dir = journal_dir
+        self.delay = delay
+        self.pending = []
+        self.appended_seq = 0
+        self.durable_seq = 0
+        self.error = None
+        self.cond = threading.Condition()
+        self.segment = 0
+        self.file = None
+        self.thread = None
+        self.fsyncs = 0
+
+    def segments(self):
+        """(index, path) of every segment, oldest first"""
+        found = []
+        for path in glob.glob(os.path.join(self.dir, "balances-*.journal")):
+            found.append((int(os.path.basename(path)[9:-8]), path))
+        return sorted(found)
+
+    def segment_path(self, index):
+        return os.path.join(self.dir, f"balances-{index:06d}.journal")
+
+    def open(self, last_seq):
+        os.makedirs(self.dir, exist_ok=True)
+        segments = self.segments()
+        self.segment = segments[-1][0] if segments else 1
+        self.file = open(self.segment_path(self.segment), "ab")
+        self.appended_seq = self.durable_seq = last_seq
+        self.thread = threading.Thread(target=self._writer, name="balance-journal", daemon=True)
+        self.thread.start()
+
+    def check(self):
+        """Raise JournalError once a write has failed"""
+        if self.error is not None:
+            raise JournalError(self.error)
+
+    def append(self, seq, record):
+        """Queue an encoded record; caller holds the engine lock so seq order is file order"""
+        with self.cond:
+            self.pending.append((seq, record))
+            self.appended_seq = seq
+            self.cond.notify_all()
+
+    def rotate(self):
+        """
+        Start a new segment after everything queued so far. Returns a marker
+        to pass to wait_rotated(); its "segment" is then the index of the
+        new segment.
+        """
+        marker = {"segment": None}
+        with self.cond:
+            self.pending.append(marker)
+            self.cond.notify_all()
+        return marker
+
+    def wait_durable(self, seq):
+        with self.cond:
+            while self.durable_seq < seq and self.error is None:
+                self.cond.wait()
+            if self.durable_seq < seq:
+                raise JournalError(self.error)
+
+    def wait_rotated(self, marker):
+        with self.cond:
+            while marker["segment"] is None and self.error is None:
+                self.cond.wait()
+            if marker["segment"] is None:
+                raise JournalError(self.error)
+
+    def _writer(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            if self.delay:
+                # Let a few more debits join this fsync
+                time.sleep(self.delay)
+            with self.cond:
+                batch, self.pending = self.pending, []
+            try:
+                buffer = []
+                for item in batch:
+                    if isinstance(item, dict):
+                        self._flush(buffer)
+                        buffer = []
+                        self.file.close()
+                        self.segment += 1
+                        self.file = open(self.segment_path(self.segment), "ab")
+                        with self.cond:
+                            item["segment"] = self.segment
+                            self.cond.notify_all()
+                    else:
+                        buffer.append(item)
+                self._flush(buffer)
+            except Exception as e:
+                with self.cond:
+                    self.error = f"journal write failed: {e}"
+                    self.cond.notify_all()
+                return
+
+    def _flush(self, records):
+        """Write and fsync records; on failure cut the file back so they are not replayed either"""
+        if not records:
+            return
+        start = self.file.tell()
+        try:
+            self.file.write(b"".join(record for _seq, record in records))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except OSError:
+            try:
+                self.file.truncate(start)
+                os.fsync(self.file.fileno())
+            except (OSError, ValueError):
+                pass
+            raise
+        self.fsyncs += 1
+        with self.cond:
+            self.durable_seq = max(self.durable_seq, records[-1][0])
+            self.cond.notify_all()
+
+
+class BalanceEngine:
+    def __init__(self, db_path=DB_PATH, journal_dir=JOURNAL_DIR, delay=GROUP_COMMIT_DELAY):
+        self.db_path = db_path
+        self.journal = Journal(journal_dir, delay)
+        self.lock = threading.Lock()
+        self.checkpoint_lock = threading.Lock()
+        self.slots = {}
+        self.cards = []
+        self.usernames = []
+        self.balances = array("q")
+        self.synced = array("q")     # USERS.balance as of the last load or checkpoint
+        self.dirty = bytearray()
+        self.seq = 0
+        self.checkpointed_seq = 0
+        self.replayed = 0
+        self.truncated_bytes = 0
+
+    # -- startup ---------------------------------------------------------
+
+    def open(self):
+        """Load the USERS snapshot, replay the journal and start the writer"""
+        started = time.time()
+        conn = sqlite3.connect(self.db_path, timeout=10.0)
+        try:
+            conn.execute('''CREATE TABLE IF NOT EXISTS balance_engine_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                last_seq INTEGER NOT NULL
+            )''')
+            conn.commit()
+            row = conn.execute("SELECT last_seq FROM balance_engine_state WHERE id = 1").fetchone()
+            self.checkpointed_seq = self.seq = row[0] if row else 0
+            for card_id, username, balance in conn.execute("SELECT card_id, username, balance FROM USERS"):
+                self._add_slot(card_id, username, balance or 0)
+        finally:
+            conn.close()
+
+        self._replay()
+        self.journal.open(self.seq)
+        if self.replayed:
+            self.checkpoint()
+        print(f"✓ Balance engine: {len(self.cards)} cards loaded, {self.replayed} journal records replayed "
+              f"in {(time.time() - started) * 1000:.0f}ms")
+        return self
+
+    def _add_slot(self, card_id, username, balance):
+        self.slots[card_id] = len(self.cards)
+        self.cards.append(card_id)
+        self.usernames.append(username)
+        self.balances.append(balance)
+        self.synced.append(balance)
+        self.dirty.append(0)
+
+    def _replay(self):
+        segments = self.journal.segments()
+        for i, (_index, path) in enumerate(segments):
+            good_end = 0
+            for seq, op, amount, card_id, end in read_segment(path):
+                good_end = end
+                if seq <= self.checkpointed_seq:
+                    continue
+                slot = self.slots.get(card_id)
+                if slot is None:
+                    print(f"✗ Journal record {seq} for unknown card {card_id} skipped")
+                else:
+                    self.balances[slot] += amount
+                    self.dirty[slot] = 1
+                self.seq = max(self.seq, seq)
+                self.replayed += 1
+            size = os.path.getsize(path)
+            if good_end < size and i == len(segments) - 1:
+                # Torn write from a crash: cut it off so new records follow intact ones
+                with open(path, "r+b") as f:
+                    f.truncate(good_end)
+                self.truncated_bytes += size - good_end
+
+    # -- balance operations ------------------------------------------------
+
+    def _journal(self, op, card_id, amount):
+        """Append a record; caller holds self.lock. Returns its sequence number."""
+        self.seq += 1
+        self.journal.append(self.seq, encode_record(self.seq, op, amount, card_id))
+        return self.seq
+
+    def lookup(self, card_id):
+        """(username, balance) or None for an unknown card"""
+        slot = self.slots.get(card_id)
+        if slot is None:
+            return None
+        return self.usernames[slot], self.balances[slot]
+
+    def register(self, card_id, username, balance):
+        """Track a user that was just inserted into USERS"""
+        with self.lock:
+            if card_id not in self.slots:
+                self._add_slot(card_id, username, balance)
+
+    def _undo(self, slot, amount):
+        """Take back a change whose journal write failed; the caller re-raises"""
+        with self.lock:
+            self.balances[slot] -= amount
+
+    def debit(self, card_id, amount):
+        """
+        Take `amount` coins if the balance allows it.
+        Returns None for an unknown card, else (approved, username, balance).
+        Only returns once an approved debit is durable in the journal.
+        """
+        with self.lock:
+            self.journal.check()
+            slot = self.slots.get(card_id)
+            if slot is None:
+                return None
+            balance = self.balances[slot]
+            if balance < amount:
+                return False, self.usernames[slot], balance
+            balance -= amount
+            self.balances[slot] = balance
+            self.dirty[slot] = 1
+            seq = self._journal(OP_DEBIT, card_id, -amount)
+            username = self.usernames[slot]
+        try:
+            self.journal.wait_durable(seq)
+        except JournalError:
+            self._undo(slot, -amount)
+            raise
+        return True, username, balance
+
+    def credit(self, card_id, amount):
+        """Top up a card. Returns (username, balance) or None for an unknown card."""
+        with self.lock:
+            self.journal.check()
+            slot = self.slots.get(card_id)
+            if slot is None:
+                return None
+            self.balances[slot] += amount
+            self.dirty[slot] = 1
+            seq = self._journal(OP_CREDIT, card_id, amount)
+            result = self.usernames[slot], self.balances[slot]
+        try:
+            self.journal.wait_durable(seq)
+        except JournalError:
+            self._undo(slot, amount)
+            raise
+        return result
+
+    def total(self):
+        return sum(self.balances)
+
+    # -- checkpointing -----------------------------------------------------
+
+    def checkpoint(self):
+        """
+        Add the changed balances into SQLite with the sequence number they
+        cover, take in changes other writers made to USERS, then drop the
+        journal segments that are now redundant.
+        """
+        with self.checkpoint_lock:
+            with self.lock:
+                # Never write balances the journal could not make durable
+                self.journal.check()
+                seq = self.seq
+                changed = [(self.balances[i] - self.synced[i], self.cards[i], i)
+                           for i, flag in enumerate(self.dirty) if flag]
+                self.dirty[:] = bytes(len(self.dirty))
+                marker = self.journal.rotate() if seq != self.checkpointed_seq else None
+            try:
+                if marker is not None:
+                    self.journal.wait_durable(seq)
+                    self.journal.wait_rotated(marker)
+                conn = sqlite3.connect(self.db_path, timeout=30.0)
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.executemany("UPDATE USERS SET balance = balance + ? WHERE card_id = ?",
+                                     [(delta, card_id) for delta, card_id, _slot in changed if delta])
+                    if marker is not None:
+                        conn.execute("INSERT OR REPLACE INTO balance_engine_state (id, last_seq) VALUES (1, ?)",
+                                     (seq,))
+                    rows = conn.execute("SELECT card_id, username, balance FROM USERS").fetchall()
+                    conn.commit()
+                finally:
+                    conn.close()
+            except Exception:
+                with self.lock:
+                    for _delta, _card_id, slot in changed:
+                        self.dirty[slot] = 1
+                raise
+            reconciled = 0
+            with self.lock:
+                for delta, _card_id, slot in changed:
+                    self.synced[slot] += delta
+                for card_id, username, balance in rows:
+                    slot = self.slots.get(card_id)
+                    if slot is None:
+                        self._add_slot(card_id, username, balance or 0)
+                        reconciled += 1
+                    elif (balance or 0) != self.synced[slot]:
+                        # Changed by another writer since the last checkpoint
+                        self.balances[slot] += (balance or 0) - self.synced[slot]
+                        self.synced[slot] = balance or 0
+                        reconciled += 1
+            if marker is None:
+                return {"cards": len(changed), "seq": seq, "reconciled": reconciled}
+            self.checkpointed_seq = seq
+
+            for index, path in self.journal.segments():
+                if index < marker["segment"]:
+                    os.remove(path)
+            return {"cards": len(changed), "seq": seq, "reconciled": reconciled}
+
+    def status(self):
+        return {
+            "cards": len(self.cards),
+            "seq": self.seq,
+            "checkpointed_seq": self.checkpointed_seq,
+            "durable_seq": self.journal.durable_seq,
+            "fsyncs": self.journal.fsyncs,
+            "error": self.journal.error
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Balance engine journal tools")
+    parser.add_argument("command", choices=["replay"])
+    parser.add_argument("--db", default=DB_PATH, help="database file")
+    parser.add_argument("--journal", default=JOURNAL_DIR, help="journal directory")
+    args = parser.parse_args()
+
+    engine = BalanceEngine(args.db, args.journal).open()
+    print(f"Replayed {engine.replayed} records, cut {engine.truncated_bytes} torn bytes, "
+          f"checkpointed through seq {engine.checkpointed_seq}")
@@ -0,0 +1,106 @@
+"""
+Benchmark: coin debits through the in-memory balance engine versus the
+plain SQLite path web.py uses without it (one connection, conditional
+UPDATE and commit per debit).
+
+    python benchmarks/bench_balance_engine.py --threads 8 --debits 2000
+"""
+import sqlite3
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from common import summarize
+
+import balance_engine
+
+
+def make_db(path, cards):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute('''CREATE TABLE USERS (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        card_id TEXT UNIQUE NOT NULL,
+        balance INTEGER DEFAULT 0
+    )''')
+    conn.executemany("INSERT INTO USERS (username, card_id, balance) VALUES (?, ?, ?)",
+                     [(f"user{i}", f"CARD{i:06d}", 10 ** 9) for i in range(cards)])
+    conn.commit()
+    conn.close()
+
+
+def sqlite_debit(db_path, card_id, cost):
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    try:
+        c = conn.execute("UPDATE USERS SET balance = balance - ? WHERE card_id = ? AND balance >= ?",
+                         (cost, card_id, cost))
+        conn.commit()
+        return c.rowcount == 1
+    finally:
+        conn.close()
+
+
+def drive(debit, threads, debits, cards):
+    """Run `debits` debits per thread; returns (elapsed seconds, sorted latencies)"""
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(n):
+        local = []
+        for i in range(debits):
+            card_id = f"CARD{(n * 7919 + i) % cards:06d}"
+            started = time.perf_counter()
+            debit(card_id, 1)
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.perf_counter() - started, sorted(latencies)
+
+
+def run(threads=8, debits=1000, cards=5000):
+    work_dir = tempfile.mkdtemp(prefix="laundry-bench-")
+    try:
+        db_path = os.path.join(work_dir, "laundry.db")
+        make_db(db_path, cards)
+        results = [summarize("sqlite", *drive(lambda card, cost: sqlite_debit(db_path, card, cost),
+                                              threads, debits, cards))]
+
+        engine = balance_engine.BalanceEngine(db_path, os.path.join(work_dir, "journal")).open()
+        elapsed, latencies = drive(engine.debit, threads, debits, cards)
+        results.append(summarize("engine", elapsed, latencies, fsyncs=engine.journal.fsyncs))
+
+        started = time.perf_counter()
+        engine.checkpoint()
+        checkpoint_ms = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        balance_engine.BalanceEngine(db_path, os.path.join(work_dir, "journal")).open()
+        results.append({"name": "engine_startup", "checkpoint_ms": round(checkpoint_ms, 1),
+                        "startup_ms": round((time.perf_counter() - started) * 1000, 1)})
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Balance engine vs SQLite debit benchmark")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--debits", type=int, default=1000, help="debits per thread")
+    parser.add_argument("--cards", type=int, default=5000)
+    args = parser.parse_args()
+
+    for result in run(args.threads, args.debits, args.cards):
+        print("  ".join(f"{k}={v}" for k, v in result.items()))
@@ -0,0 +1,76 @@
+"""
+Benchmark: bsdiff patch size against the full image, and the time to
+generate and apply it, for consecutive firmware images.
+
+Pass real images in upload order (e.g. the server's firmware folder);
+without arguments a synthetic 1.2 MB image and a slightly changed
+rebuild of it are compared.
+
+    python benchmarks/bench_firmware_delta.py firmware/*.bin
+"""
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import common  # noqa: F401  (puts the repo root on sys.path)
+
+import ota_delta
+
+
+def synthetic_pair(work_dir, size=1200000, seed=7):
+    """An image and a 'rebuild' with an inserted function and changed constants"""
+    rng = random.Random(seed)
+    old = bytearray(b"\xe9" + bytes(rng.getrandbits(8) for _ in range(size - 1)))
+    new = bytearray(old)
+    new[size // 3:size // 3] = bytes(rng.getrandbits(8) for _ in range(6000))
+    for _ in range(400):
+        offset = rng.randrange(1, len(new) - 4)
+        new[offset:offset + 4] = rng.getrandbits(32).to_bytes(4, "little")
+    paths = []
+    for name, data in (("old.bin", old), ("new.bin", new)):
+        path = os.path.join(work_dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        paths.append(path)
+    return paths
+
+
+def run(images=None):
+    if ota_delta.bsdiff4 is None:
+        raise SystemExit("bsdiff4 is not installed (pip install -r requirement.txt)")
+    work_dir = tempfile.mkdtemp(prefix="laundry-bench-")
+    try:
+        images = list(images or synthetic_pair(work_dir))
+        results = []
+        for old_path, new_path in zip(images, images[1:]):
+            patch_path = os.path.join(work_dir, "patch.bsdiff")
+            size, _sha256, generation_ms = ota_delta.make_patch(old_path, new_path, patch_path)
+
+            with open(old_path, "rb") as f:
+                old = f.read()
+            with open(patch_path, "rb") as f:
+                patch = f.read()
+            started = time.perf_counter()
+            ota_delta.bsdiff4.patch(old, patch)
+            apply_ms = (time.perf_counter() - started) * 1000
+
+            full_size = os.path.getsize(new_path)
+            results.append({"name": f"{os.path.basename(old_path)}->{os.path.basename(new_path)}",
+                            "full_bytes": full_size, "patch_bytes": size, "ratio": round(size / full_size, 3),
+                            "generation_ms": round(generation_ms, 1), "apply_ms": round(apply_ms, 1)})
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Firmware delta size and generation time")
+    parser.add_argument("images", nargs="*", help="firmware images in upload order")
+    args = parser.parse_args()
+
+    for result in run(args.images):
+        print("  ".join(f"{k}={v}" for k, v in result.items()))
@@ -0,0 +1,94 @@
+"""
+Benchmark: many devices downloading the same firmware image at once from
+web.py's /firmware/<filename> route, over real HTTP. A share of the
+clients drop half way and resume with a Range request, like an ESP32 on
+a flaky link.
+
+    python benchmarks/bench_firmware_download.py --clients 50 --size 1500000
+"""
+import http.client
+import os
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+from common import prepare_web, ServerThread, summarize
+
+
+def download(url, path, resume_at=None):
+    """Fetch path fully (optionally in two parts); returns bytes received"""
+    parsed = urlparse(url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=60)
+    try:
+        received = 0
+        if resume_at:
+            conn.request("GET", path, headers={"Range": f"bytes=0-{resume_at - 1}"})
+            response = conn.getresponse()
+            received += len(response.read())
+            etag = response.getheader("ETag")
+            conn.request("GET", path, headers={"Range": f"bytes={resume_at}-", "If-Range": etag})
+        else:
+            conn.request("GET", path)
+        response = conn.getresponse()
+        while True:
+            chunk = response.read(64 * 1024)
+            if not chunk:
+                break
+            received += len(chunk)
+        return received
+    finally:
+        conn.close()
+
+
+def run(clients=50, size=1500000, resume_share=0.2):
+    work_dir = tempfile.mkdtemp(prefix="laundry-bench-")
+    try:
+        web = prepare_web(work_dir)
+        with open(os.path.join(web.UPLOAD_FOLDER, "bench.bin"), "wb") as f:
+            f.write(b"\xe9" + os.urandom(size - 1))
+
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        with ServerThread(web.app) as server:
+            def client(n):
+                resume_at = size // 2 if n < clients * resume_share else None
+                started = time.perf_counter()
+                try:
+                    received = download(server.url, "/firmware/bench.bin", resume_at)
+                    if received != size:
+                        raise ValueError(f"got {received} of {size} bytes")
+                    with lock:
+                        latencies.append(time.perf_counter() - started)
+                except Exception as e:
+                    with lock:
+                        errors.append(str(e))
+
+            threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+            started = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - started
+
+        total = len(latencies) * size
+        return [summarize("firmware_download", elapsed, latencies, errors=len(errors),
+                          mb_per_sec=round(total / elapsed / 1e6, 1))]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Concurrent firmware download benchmark")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--size", type=int, default=1500000, help="image size in bytes")
+    parser.add_argument("--resume-share", type=float, default=0.2, help="fraction of clients that resume")
+    args = parser.parse_args()
+
+    for result in run(args.clients, args.size, args.resume_share):
+        print("  ".join(f"{k}={v}" for k, v in result.items()))
@@ -0,0 +1,205 @@
+"""
+Concurrency limits of the async device gateway (SERVER_MODE=gateway)
+against the threaded servers, each as its own `python -m server`:
+
+- idle: opens --idle keep-alive connections the way parked ESP32s hold
+  them (one manifest request each, then nothing), and reports the
+  server's memory and thread count per idle connection, whether scans
+  still get through while they are open, and how many of them the server
+  kept open after answering and after the scans
+- scan_card: POST /scan_card throughput and latency at each --clients
+  level, to see where each server stops scaling and starts queueing
+- slow: scans while --slow devices download a firmware image over a slow
+  link (4 KB every 50 ms); a threaded server holds a thread per download
+
+Memory and threads are summed over the server's process tree (Linux /proc).
+
+    python benchmarks/bench_gateway.py --configs dev,gunicorn:1x8,gateway:1x8 --idle 500 --slow 16
+"""
+import http.client
+import json
+import os
+import select
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from common import summarize
+from bench_servers import ServerProcess, gunicorn_available
+from bench_startup import create_database
+from bench_web import drive_scan_card
+
+CONFIGS = ("dev", "gunicorn:1x8", "gateway:1x8")
+CLIENTS = (8, 32, 128)
+
+
+def process_tree(pid):
+    pids = [pid]
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/task/{p}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def usage(pid):
+    """Resident memory (KB) and threads of a process and its children"""
+    rss_kb = threads = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss_kb += int(line.split()[1])
+                    elif line.startswith("Threads:"):
+                        threads += int(line.split()[1])
+        except OSError:
+            pass
+    return rss_kb, threads
+
+
+def open_idle(port, count):
+    """`count` connections that each made one request and then stay open"""
+    connections = []
+    for _ in range(count):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        conn.request("GET", "/firmware/manifest.json")
+        conn.getresponse().read()
+        connections.append(conn)
+    return connections
+
+
+def still_open(connections):
+    """How many connections the server has not closed (http.client would silently reconnect)"""
+    alive = 0
+    for conn in connections:
+        if conn.sock is None:
+            continue
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+        try:
+            alive += not readable or conn.sock.recv(1, socket.MSG_PEEK) != b""
+        except OSError:
+            pass
+    return alive
+
+
+def upload(port, size):
+    """Upload a random image through /upload_firmware; returns its catalog name"""
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"firmware\"; filename=\"bench.bin\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode()
+    body += b"\xe9" + os.urandom(size - 1) + f"\r\n--{boundary}--\r\n".encode()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    conn.request("POST", "/upload_firmware", body=body,
+                 headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    response = conn.getresponse()
+    result = json.loads(response.read())
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"upload failed: {result}")
+    return result["filename"]
+
+
+def slow_download(port, path, done):
+    """Read a download 4 KB every 50 ms through a small receive buffer, like an ESP32 on weak Wi-Fi"""
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8192)
+    # Wi-Fi sized segments; with loopback's 64 KB ones the kernel would buffer the whole image
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_MAXSEG, 1460)
+    sock.settimeout(60)
+    try:
+        sock.connect(("127.0.0.1", port))
+        sock.sendall(f"GET {path} HTTP/1.1\r\nHost: bench\r\nX-Device-Id: slow\r\n\r\n".encode())
+        while not done.is_set() and sock.recv(4096):
+            time.sleep(0.05)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+def run(configs=CONFIGS, idle=500, clients=CLIENTS, requests=30, slow=16, size=1000000, cards=2000):
+    if not gunicorn_available():
+        skipped = [c for c in configs if c != "dev"]
+        if skipped:
+            print(f"✗ gunicorn is not installed; skipping {', '.join(skipped)}", file=sys.stderr)
+        configs = [c for c in configs if c == "dev"]
+    results = []
+    for config in configs:
+        work_dir = tempfile.mkdtemp(prefix="laundry-gateway-")
+        try:
+            db_dir = os.path.join(work_dir, "database")
+            os.makedirs(db_dir)
+            create_database(os.path.join(db_dir, "laundry.db"), cards, 0)
+            # Idle connections must outlive the measurement
+            with ServerProcess(config, db_dir, env={"WEB_KEEPALIVE": "300"}) as server:
+                name = f"gw_{server.mode}" + (f"_{server.workers}x{server.threads}" if server.threads else "")
+                drive_scan_card(server.url, 8, 5, cards)
+                for level in clients:
+                    elapsed, latencies, errors = drive_scan_card(server.url, level, requests, cards)
+                    results.append(summarize(f"{name}_scan_card_c{level}", elapsed, latencies, errors=errors))
+
+                rss_before, threads_before = usage(server.proc.pid)
+                started = time.perf_counter()
+                try:
+                    connections = open_idle(server.port, idle)
+                except OSError as e:
+                    results.append({"name": f"{name}_idle{idle}", "error": str(e)})
+                    continue
+                opened_s = time.perf_counter() - started
+                kept = still_open(connections)
+                rss_idle, threads_idle = usage(server.proc.pid)
+                elapsed, latencies, errors = drive_scan_card(server.url, 8, requests, cards)
+                results.append(summarize(f"{name}_scan_card_idle{idle}", elapsed, latencies, errors=errors))
+                results.append({"name": f"{name}_idle{idle}", "connections": idle,
+                                "open_s": round(opened_s, 2),
+                                "kb_per_connection": round((rss_idle - rss_before) / idle, 1),
+                                "threads": [threads_before, threads_idle],
+                                "rss_mb": [round(rss_before / 1024, 1), round(rss_idle / 1024, 1)],
+                                "kept": kept, "survived": still_open(connections)})
+                for conn in connections:
+                    conn.close()
+
+                if slow:
+                    path = f"/firmware/{upload(server.port, size)}"
+                    done = threading.Event()
+                    downloads = [threading.Thread(target=slow_download, args=(server.port, path, done))
+                                 for _ in range(slow)]
+                    for d in downloads:
+                        d.start()
+                    time.sleep(0.5)
+                    _, threads_slow = usage(server.proc.pid)
+                    elapsed, latencies, errors = drive_scan_card(server.url, 8, requests, cards)
+                    results.append(summarize(f"{name}_scan_card_slow{slow}", elapsed, latencies, errors=errors,
+                                             threads=threads_slow))
+                    done.set()
+                    for d in downloads:
+                        d.join()
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Device gateway vs threaded servers: idle connections and scan load")
+    parser.add_argument("--configs", default=",".join(CONFIGS),
+                        help="comma separated: dev, gunicorn:<workers>x<threads>, gateway:<workers>x<threads>")
+    parser.add_argument("--idle", type=int, default=500, help="idle keep-alive connections to hold")
+    parser.add_argument("--clients", default=",".join(str(c) for c in CLIENTS),
+                        help="comma separated concurrent scan clients")
+    parser.add_argument("--requests", type=int, default=30, help="scans per client")
+    parser.add_argument("--slow", type=int, default=16, help="slow firmware downloads during the last scan run")
+    parser.add_argument("--size", type=int, default=1000000, help="firmware image size for the slow downloads")
+    args = parser.parse_args()
+
+    for result in run(args.configs.split(","), args.idle, [int(c) for c in args.clients.split(",")],
+                      args.requests, args.slow, args.size):
+        print("  ".join(f"{k}={v}" for k, v in result.items()))
@@ -0,0 +1,165 @@
+"""
+Throughput and latency of web.py under each server mode of server.py:
+the Werkzeug development server, gunicorn with several worker x
+thread layouts, and the async device gateway (worker x DB threads). Every configuration runs as its own `python -m server`
+process on a seeded throwaway database and gets the same load from
+concurrent keep-alive clients:
+
+- scan_card: POST /scan_card (debits; SQLite serializes the writes)
+- manifest: GET /firmware/manifest.json (in-memory, CPU bound)
+
+    python benchmarks/bench_servers.py --configs dev,gunicorn:2x8,gateway:2x8 --clients 32
+"""
+import http.client
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from common import ROOT, summarize
+from bench_startup import create_database
+from bench_web import drive_scan_card
+
+CONFIGS = ("dev", "gunicorn:1x8", "gunicorn:2x8", "gunicorn:4x8", "gateway:1x8", "gateway:2x8")
+
+
+def parse_config(config):
+    """"dev", "gunicorn:<workers>x<threads>" or "gateway:<workers>x<DB threads>" -> (mode, workers, threads)"""
+    mode, _, layout = config.partition(":")
+    if mode == "dev":
+        return mode, 1, None
+    workers, threads = (int(n) for n in (layout or "2x8").split("x"))
+    return mode, workers, threads
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class ServerProcess:
+    """`python -m server` in the given mode on a free local port"""
+
+    def __init__(self, config, db_dir, env=None):
+        self.mode, self.workers, self.threads = parse_config(config)
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        env = dict(os.environ, SERVER_MODE=self.mode, WEB_BIND=f"127.0.0.1:{self.port}",
+                   WEB_WORKERS=str(self.workers), WEB_THREADS=str(self.threads or 1),
+                   GATEWAY_DB_THREADS=str(self.threads or 1), DB_DIR=db_dir,
+                   FIRMWARE_DIR=os.path.join(os.path.dirname(db_dir), "firmware"), LOG_STDOUT="0",
+                   LOG_FILE=os.path.join(db_dir, "logs", "laundry.jsonl"), PREWARM_DELAY="0", **(env or {}))
+        self.output = open(os.path.join(db_dir, f"server-{self.port}.out"), "w")
+        self.proc = subprocess.Popen([sys.executable, "-m", "server"], cwd=ROOT, env=env,
+                                     stdout=self.output, stderr=subprocess.STDOUT)
+
+    def __enter__(self):
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"server exited with {self.proc.returncode}; see {self.output.name}")
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=5)
+                conn.request("GET", "/firmware/manifest.json")
+                if conn.getresponse().status == 200:
+                    conn.close()
+                    return self
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f"server did not come up; see {self.output.name}")
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.output.close()
+
+
+def drive_get(url, clients, requests, path):
+    """`requests` GETs per client over keep-alive connections"""
+    port = int(url.rsplit(":", 1)[1])
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        local = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise ValueError(f"GET {path} returned {response.status}")
+                local.append(time.perf_counter() - started)
+            except Exception as e:
+                conn.close()
+                with lock:
+                    errors.append(str(e))
+        conn.close()
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.perf_counter() - started, latencies, len(errors)
+
+
+def gunicorn_available():
+    try:
+        import gunicorn  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def run(configs=CONFIGS, clients=32, requests=50, cards=2000):
+    if not gunicorn_available():
+        skipped = [c for c in configs if c != "dev"]
+        if skipped:
+            print(f"✗ gunicorn is not installed; skipping {', '.join(skipped)}", file=sys.stderr)
+        configs = [c for c in configs if c == "dev"]
+    results = []
+    for config in configs:
+        work_dir = tempfile.mkdtemp(prefix="laundry-serve-")
+        try:
+            db_dir = os.path.join(work_dir, "database")
+            os.makedirs(db_dir)
+            create_database(os.path.join(db_dir, "laundry.db"), cards, 0)
+            with ServerProcess(config, db_dir) as server:
+                name = f"serve_{server.mode}" + (f"_{server.workers}x{server.threads}" if server.threads else "")
+                # Warm every worker before measuring
+                drive_scan_card(server.url, clients, 5, cards)
+                elapsed, latencies, errors = drive_scan_card(server.url, clients, requests, cards)
+                results.append(summarize(f"{name}_scan_card", elapsed, latencies, errors=errors))
+                elapsed, latencies, errors = drive_get(server.url, clients, requests, "/firmware/manifest.json")
+                results.append(summarize(f"{name}_manifest", elapsed, latencies, errors=errors))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="web.py under each server mode")
+    parser.add_argument("--configs", default=",".join(CONFIGS),
+                        help="comma separated: dev, gunicorn:<workers>x<threads>, gateway:<workers>x<threads>")
+    parser.add_argument("--clients", type=int, default=32, help="concurrent keep-alive clients")
+    parser.add_argument("--requests", type=int, default=50, help="requests per client and workload")
+    args = parser.parse_args()
+
+    for result in run(args.configs.split(","), args.clients, args.requests):
+        print("  ".join(f"{k}={v}" for k, v in result.items()))
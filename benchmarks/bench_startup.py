@@ -0,0 +1,164 @@
+"""
+How long web.py takes from a (re)start until it can approve coins.
+
+Each measurement runs in a fresh interpreter, as after a container
+restart:
+
+- imports: `python -X importtime -c "import web"`, per module
+- startup: web.startup() (init_db and the rest of __main__) on a large
+  database, once on a database created by an older version (the first
+  start after an upgrade runs the migrations) and then on restarts
+- first_scan: from spawning the process until the first POST /scan_card
+  has been answered, checked against --budget-ms (STARTUP_BUDGET_MS)
+
+The server processes inherit the environment, so e.g. BALANCE_ENGINE=1
+measures a start that loads every card into the balance engine.
+
+    python benchmarks/bench_startup.py --users 20000 --logs 1000000 --restarts 3
+"""
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import ROOT
+
+# The first /scan_card after a restart should be answered within this
+STARTUP_BUDGET_MS = float(os.environ.get("STARTUP_BUDGET_MS", 3000))
+
+
+def import_times(top=15):
+    """Import time (ms) of web.py's direct imports and of our own modules, slowest first"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import web"], cwd=ROOT,
+                            capture_output=True, text=True, env=dict(os.environ, LOG_STDOUT="0"))
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append({"module": name.strip(), "depth": (len(name) - len(name.lstrip())) // 2,
+                        "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+    ours = {os.path.splitext(name)[0] for name in os.listdir(ROOT) if name.endswith(".py")}
+    direct = [m for m in modules if m["depth"] == 1]
+    return {
+        "total_ms": round(sum(m["self_ms"] for m in modules), 1),
+        "slowest": sorted(direct, key=lambda m: -m["cumulative_ms"])[:top],
+        "project": sorted((m for m in modules if m["module"] in ours), key=lambda m: -m["self_ms"])[:top]
+    }
+
+
+def create_database(path, users, logs):
+    """A database with only the original USERS and logs tables, as an older version left it"""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute('''CREATE TABLE USERS (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL,
+                    card_id TEXT UNIQUE NOT NULL, balance INTEGER DEFAULT 0)''')
+    conn.execute('''CREATE TABLE logs (id INTEGER PRIMARY KEY AUTOINCREMENT, card_id TEXT, username TEXT,
+                    action TEXT, balance INTEGER, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+    conn.executemany("INSERT INTO USERS (username, card_id, balance) VALUES (?, ?, ?)",
+                     ((f"user{i}", f"CARD{i:06d}", 10 ** 9) for i in range(users)))
+    conn.executemany("INSERT INTO logs (card_id, username, action, balance, timestamp) "
+                     "VALUES (?, ?, ?, ?, datetime('now', ?))",
+                     ((f"CARD{i % users:06d}", f"user{i % users}", "Machine m1 used 1 coin(s)", 10 ** 9,
+                       f"-{(logs - i) * 60 // max(1, logs // 1000)} seconds") for i in range(logs)))
+    conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+
+def child(cards):
+    """Run inside the measured process: start web.py and send the first /scan_card"""
+    sys.path.insert(0, ROOT)
+    started = time.perf_counter()
+    import web
+    from common import ServerThread
+    import http.client
+
+    imported = time.perf_counter()
+    timings = web.startup()
+    with ServerThread(web.app) as server:
+        listening = time.perf_counter()
+        latencies = []
+        for i in range(5):
+            conn = http.client.HTTPConnection("127.0.0.1", server.server.server_port, timeout=30)
+            sent = time.perf_counter()
+            conn.request("POST", "/scan_card", headers={"Content-Type": "application/json"},
+                         body=json.dumps({"card_id": f"CARD{(i * 7919) % cards:06d}", "coins": 1,
+                                          "machine_id": "m1"}))
+            response = json.loads(conn.getresponse().read())
+            latencies.append(time.perf_counter() - sent)
+            conn.close()
+            if not response.get("activate_machine"):
+                raise SystemExit(f"scan was not approved: {response}")
+            if i == 0:
+                first_scan_at = time.time()
+    web.scheduler.stop()
+    print(json.dumps({"import_ms": round((imported - started) * 1000, 1), "startup": timings,
+                      "listen_ms": round((listening - imported) * 1000 - timings["total"], 1),
+                      "first_request_ms": round(latencies[0] * 1000, 1),
+                      "next_requests_ms": round(statistics.median(latencies[1:]) * 1000, 1),
+                      "first_scan_at": first_scan_at}))
+
+
+def start(db_dir, cards, env=None):
+    """Spawn a server process; its timings plus the time from spawn to the first approved scan"""
+    spawned = time.time()
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", str(cards)],
+                            capture_output=True, text=True, timeout=600,
+                            env=dict(os.environ, DB_DIR=db_dir, LOG_STDOUT="0",
+                                     LOG_FILE=os.path.join(db_dir, "laundry.jsonl"), **(env or {})))
+    if result.returncode != 0:
+        raise RuntimeError(f"server process failed:\n{result.stderr[-2000:]}")
+    measured = json.loads(result.stdout.strip().splitlines()[-1])
+    measured["first_scan_ms"] = round((measured.pop("first_scan_at") - spawned) * 1000, 1)
+    return measured
+
+
+def run(users=20000, logs=1000000, restarts=3, budget_ms=STARTUP_BUDGET_MS, env=None):
+    work_dir = tempfile.mkdtemp(prefix="laundry-startup-")
+    try:
+        db_dir = os.path.join(work_dir, "database")
+        os.makedirs(db_dir)
+        generating = time.perf_counter()
+        create_database(os.path.join(db_dir, "laundry.db"), users, logs)
+        size = os.path.getsize(os.path.join(db_dir, "laundry.db"))
+        print(f"✓ Created {users} users and {logs} log rows ({size // 2 ** 20} MB) "
+              f"in {time.perf_counter() - generating:.1f}s", file=sys.stderr)
+        upgrade = start(db_dir, users, env)
+        runs = [start(db_dir, users, env) for _ in range(restarts)]
+        restart = min(runs, key=lambda r: r["first_scan_ms"])
+        first_scan = statistics.median(r["first_scan_ms"] for r in runs)
+        return {"users": users, "logs": logs, "db_mb": size // 2 ** 20, "imports": import_times(),
+                "first_start": upgrade, "restart": restart,
+                "restart_first_scan_ms": [r["first_scan_ms"] for r in runs],
+                "budget_ms": budget_ms, "within_budget": first_scan <= budget_ms}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="web.py startup time and first /scan_card latency")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--logs", type=int, default=1000000)
+    parser.add_argument("--restarts", type=int, default=3)
+    parser.add_argument("--budget-ms", type=float, default=STARTUP_BUDGET_MS)
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args.child)
+        sys.exit(0)
+    result = run(args.users, args.logs, args.restarts, args.budget_ms)
+    print(json.dumps(result, indent=2))
+    first_scan = statistics.median(result["restart_first_scan_ms"])
+    if not result["within_budget"]:
+        print(f"✗ First /scan_card after a restart took {first_scan} ms (budget {args.budget_ms} ms)")
+        sys.exit(1)
+    print(f"✓ First /scan_card after a restart in {first_scan} ms (budget {args.budget_ms} ms)")
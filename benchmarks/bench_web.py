@@ -0,0 +1,164 @@
+"""
+Benchmarks of the server paths a change to web.py or cloneWep.py is most
+likely to slow down:
+
+- db_ops: web.py's find_user(), debit_card() and log_action() called directly
+- index_render: GET / (every user and the last 100 logs through the template)
+- scan_card: POST /scan_card over real HTTP from concurrent clients, against
+  web.py or cloneWep.py
+- scan_card_backup: the same web.py load on a larger database, first alone
+  and then while backup.py snapshots it back to back, to see whether scan
+  latency stays flat during a backup
+
+    python benchmarks/bench_web.py --threads 8 --requests 200
+"""
+import http.client
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+from common import prepare_web, prepare_clone, seed_users, ServerThread, summarize
+
+
+def timed(fn, count):
+    latencies = []
+    started = time.perf_counter()
+    for i in range(count):
+        t0 = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - t0)
+    return time.perf_counter() - started, latencies
+
+
+def db_ops(ops=1000, cards=500):
+    work_dir = tempfile.mkdtemp(prefix="laundry-bench-")
+    try:
+        web = prepare_web(work_dir)
+        seed_users(web.DB_PATH, cards)
+        card = lambda i: f"CARD{(i * 7919) % cards:06d}"
+        return [summarize("db_find_user", *timed(lambda i: web.find_user(card(i)), ops)),
+                summarize("db_debit", *timed(lambda i: web.debit_card(card(i), 1), ops)),
+                summarize("db_log_action",
+                          *timed(lambda i: web.log_action(card(i), "user", "Machine m1 used 1 coin(s)", 1), ops))]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def index_render(requests=100, cards=300, logs=5000):
+    work_dir = tempfile.mkdtemp(prefix="laundry-bench-")
+    try:
+        web = prepare_web(work_dir)
+        seed_users(web.DB_PATH, cards, logs=logs)
+        client = web.app.test_client()
+
+        def render(_):
+            response = client.get("/")
+            if response.status_code != 200:
+                raise ValueError(f"GET / returned {response.status_code}")
+
+        return [summarize("index_render", *timed(render, requests))]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def drive_scan_card(url, threads, requests, cards):
+    """`requests` debits per client thread over keep-alive connections"""
+    parsed = urlparse(url)
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def client(n):
+        conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=30)
+        local = []
+        for i in range(requests):
+            body = json.dumps({"card_id": f"CARD{(n * 7919 + i) % cards:06d}", "coins": 1,
+                               "machine_id": f"machine{n}"})
+            started = time.perf_counter()
+            try:
+                conn.request("POST", "/scan_card", body=body, headers={"Content-Type": "application/json"})
+                response = conn.getresponse()
+                if not json.loads(response.read()).get("activate_machine"):
+                    raise ValueError("scan was not approved")
+                local.append(time.perf_counter() - started)
+            except Exception as e:
+                conn.close()
+                with lock:
+                    errors.append(str(e))
+        conn.close()
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=client, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.perf_counter() - started, latencies, len(errors)
+
+
+def scan_card(app="web", threads=8, requests=100, cards=500):
+    work_dir = tempfile.mkdtemp(prefix="laundry-bench-")
+    try:
+        module = prepare_web(work_dir) if app == "web" else prepare_clone(work_dir)
+        seed_users(module.DB_PATH, cards)
+        with ServerThread(module.app) as server:
+            elapsed, latencies, errors = drive_scan_card(server.url, threads, requests, cards)
+        return [summarize(f"scan_card_{app}", elapsed, latencies, errors=errors)]
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def scan_card_backup(threads=8, requests=100, cards=500, logs=200000):
+    import backup
+
+    work_dir = tempfile.mkdtemp(prefix="laundry-bench-")
+    try:
+        web = prepare_web(work_dir)
+        seed_users(web.DB_PATH, cards, logs=logs)
+        size_mb = round(os.path.getsize(web.DB_PATH) / 1e6, 1)
+        with ServerThread(web.app) as server:
+            drive_scan_card(server.url, threads, 10, cards)
+            results = [summarize("scan_card_no_backup", *drive_scan_card(server.url, threads, requests, cards)[:2],
+                                 db_mb=size_mb)]
+
+            done, snapshots = threading.Event(), []
+
+            def backups():
+                while not done.is_set():
+                    snapshots.append(backup.create_backup(web.DB_PATH, os.path.join(work_dir, "backups"), keep=1))
+
+            thread = threading.Thread(target=backups)
+            thread.start()
+            try:
+                elapsed, latencies, errors = drive_scan_card(server.url, threads, requests, cards)
+            finally:
+                done.set()
+                thread.join()
+        results.append(summarize("scan_card_during_backup", elapsed, latencies, errors=errors, db_mb=size_mb,
+                                 backups=len(snapshots)))
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run(threads=8, requests=100, ops=1000):
+    return (db_ops(ops) + index_render(max(10, requests)) +
+            scan_card("web", threads, requests) + scan_card("clone", threads, requests))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="web.py / cloneWep.py server benchmarks")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="requests per client thread")
+    parser.add_argument("--ops", type=int, default=1000, help="calls per database operation")
+    args = parser.parse_args()
+
+    for result in run(args.threads, args.requests, args.ops):
+        print("  ".join(f"{k}={v}" for k, v in result.items()))
@@ -0,0 +1,108 @@
+"""
+Helpers shared by the benchmark scripts: a throwaway copy of web.py's
+data directories, a threaded HTTP server for it and latency summaries.
+"""
+import os
+import sys
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def prepare_web(work_dir):
+    """
+    Import web.py with its database and firmware folder in work_dir. The
+    paths go into the environment first, so everything web.py builds at
+    import (catalog, rollouts, scheduler, replica) is wired to them; a
+    later call in the same process re-imports web.py for its own work_dir.
+    """
+    import importlib
+
+    db_dir = os.path.join(work_dir, "database")
+    firmware_dir = os.path.join(work_dir, "firmware")
+    os.makedirs(db_dir, exist_ok=True)
+    os.makedirs(firmware_dir, exist_ok=True)
+    os.environ.update(DB_DIR=db_dir, FIRMWARE_DIR=firmware_dir, LOG_STDOUT="0",
+                      LOG_FILE=os.path.join(work_dir, "logs", "laundry.jsonl"),
+                      TRACE_FILE=os.path.join(work_dir, "logs", "traces.jsonl"))
+
+    import applog
+    import tracing
+    if "web" in sys.modules:
+        web = importlib.reload(sys.modules["web"])
+    else:
+        import web
+
+    # Set up by modules web.py imports, which read their settings only once
+    applog.configure(log_file=os.path.join(work_dir, "logs", "laundry.jsonl"), stdout=False)
+    web.profiler.folder = os.path.join(work_dir, "profiles")
+    web.tracer.exporter = tracing.JsonlExporter(os.path.join(work_dir, "logs", "traces.jsonl"))
+    web.init_db()
+    return web
+
+
+def prepare_clone(work_dir):
+    """Import cloneWep.py and point its database at work_dir"""
+    import cloneWep
+    import applog
+
+    applog.configure(log_file=os.path.join(work_dir, "logs", "laundry.jsonl"), stdout=False)
+    cloneWep.DB_DIR = os.path.join(work_dir, "database")
+    cloneWep.DB_PATH = os.path.join(cloneWep.DB_DIR, "laundry.db")
+    cloneWep.init_db()
+    return cloneWep
+
+
+def seed_users(db_path, cards, balance=10 ** 9, logs=0):
+    """CARD000000... users with a large balance, plus `logs` old log rows"""
+    import sqlite3
+
+    conn = sqlite3.connect(db_path)
+    conn.executemany("INSERT OR REPLACE INTO USERS (username, card_id, balance) VALUES (?, ?, ?)",
+                     [(f"user{i}", f"CARD{i:06d}", balance) for i in range(cards)])
+    conn.executemany("INSERT INTO logs (card_id, username, action, balance) VALUES (?, ?, ?, ?)",
+                     [(f"CARD{i % cards:06d}", f"user{i % cards}", "Balance added +1", balance)
+                      for i in range(logs)])
+    conn.commit()
+    conn.close()
+
+
+class ServerThread:
+    """Serve a WSGI app with Werkzeug's threaded server on a free local port"""
+
+    def __init__(self, app, host="127.0.0.1"):
+        import logging
+        from werkzeug.serving import make_server
+
+        # One access-log line per request would dominate short requests
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        self.server = make_server(host, 0, app, threaded=True)
+        self.url = f"http://{host}:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.thread.join()
+
+
+def summarize(name, elapsed, latencies, **extra):
+    """ops/s and latency percentiles (ms) for a list of per-operation seconds"""
+    latencies = sorted(latencies)
+    count = len(latencies)
+    if not count:
+        return dict({"name": name, "ops": 0}, **extra)
+    return dict({
+        "name": name,
+        "ops": count,
+        "ops_per_sec": round(count / elapsed, 1) if elapsed else None,
+        "p50_ms": round(latencies[count // 2] * 1000, 3),
+        "p95_ms": round(latencies[min(count - 1, int(count * 0.95))] * 1000, 3),
+        "p99_ms": round(latencies[min(count - 1, int(count * 0.99))] * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3)
+    }, **extra)
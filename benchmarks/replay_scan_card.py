@@ -0,0 +1,194 @@
+"""
+Replay captured /scan_card traffic (see capture.py) against a server.
+
+Requests keep their recorded spacing divided by --speed (1, 10, ... or
+"max" for no waiting). Each machine gets its own client thread, so the
+requests of one machine are sent in their recorded order while
+different machines overlap as they did in production.
+
+Without --url the replay runs against a throwaway copy of web.py whose
+USERS table is seeded from the captured responses (each card with the
+balance it had before its first captured scan), so responses can be
+compared with the recorded ones. The report has the latency
+distribution, how late requests were sent against the schedule, and the
+responses that diverged from the capture.
+
+    python benchmarks/replay_scan_card.py captures/scan_card.jsonl* --day 2025-06-14 --speed 10
+"""
+import glob
+import gzip
+import http.client
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from urllib.parse import urlparse
+
+from common import prepare_web, ServerThread, summarize
+
+
+def load(paths, day=None):
+    """Captured entries from .jsonl and rotated .jsonl.N.gz files, oldest first"""
+    entries = []
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                if day and datetime.fromtimestamp(entry["t"]).strftime("%Y-%m-%d") != day:
+                    continue
+                entries.append(entry)
+    entries.sort(key=lambda entry: entry["t"])
+    return entries
+
+
+def initial_users(entries):
+    """card_id -> (username, balance before its first captured scan)"""
+    users = {}
+    for entry in entries:
+        response = entry.get("r")
+        if not isinstance(response, dict) or not response.get("user_exists"):
+            continue
+        card_id = response.get("card_id") or (entry.get("q") or {}).get("card_id", "").strip()
+        if not card_id or card_id in users or "balance" not in response:
+            continue
+        balance = response["balance"] + (response.get("coins_used", 0) if response.get("activate_machine") else 0)
+        users[card_id] = (response.get("username") or card_id, balance)
+    return users
+
+
+def seed(db_path, users):
+    conn = sqlite3.connect(db_path)
+    conn.executemany("INSERT OR REPLACE INTO USERS (username, card_id, balance) VALUES (?, ?, ?)",
+                     [(name, card_id, balance) for card_id, (name, balance) in users.items()])
+    conn.commit()
+    conn.close()
+
+
+def divergence(recorded, status, body):
+    """Fields that differ from the recorded response, or None"""
+    if status != recorded["s"]:
+        return {"status": [recorded["s"], status]}
+    expected = recorded.get("r")
+    if not isinstance(expected, dict) or not isinstance(body, dict):
+        return None if expected == body else {"body": [expected, body]}
+    changed = {key: [expected.get(key), body.get(key)] for key in sorted(set(expected) | set(body))
+               if expected.get(key) != body.get(key)}
+    return changed or None
+
+
+def replay(entries, url, speed=1.0):
+    """Send every entry; returns one result dict per entry"""
+    parsed = urlparse(url)
+    by_machine = {}
+    for entry in entries:
+        by_machine.setdefault(entry.get("m", "unknown"), []).append(entry)
+    results = []
+    lock = threading.Lock()
+    first = entries[0]["t"] if entries else 0
+    start = time.perf_counter() + 0.2
+
+    def machine(queue):
+        conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=30)
+        local = []
+        for entry in queue:
+            due = start + (entry["t"] - first) / speed if speed else start
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            body = json.dumps(entry["q"]) if isinstance(entry["q"], dict) else (entry["q"] or "")
+            sent = time.perf_counter()
+            try:
+                conn.request("POST", "/scan_card", body=body, headers={"Content-Type": "application/json"})
+                response = conn.getresponse()
+                raw = response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                local.append({"entry": entry, "error": str(e), "lag": max(0.0, sent - due)})
+                continue
+            elapsed = time.perf_counter() - sent
+            try:
+                payload = json.loads(raw)
+            except ValueError:
+                payload = raw.decode("utf-8", "replace")
+            local.append({"entry": entry, "status": status, "body": payload, "latency": elapsed,
+                          "lag": max(0.0, sent - due)})
+        conn.close()
+        with lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=machine, args=(queue,)) for queue in by_machine.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def report(results, elapsed, speed, examples=10):
+    ok = [r for r in results if "error" not in r]
+    lags = sorted(r["lag"] for r in results)
+    diverged = []
+    for r in ok:
+        changed = divergence(r["entry"], r["status"], r["body"])
+        if changed:
+            diverged.append({"t": r["entry"]["t"], "machine": r["entry"].get("m"),
+                             "card_id": (r["entry"].get("q") or {}).get("card_id"), "changed": changed})
+    fields = Counter(key for d in diverged for key in d["changed"])
+    recorded = sorted(r["entry"]["ms"] / 1000 for r in results if r["entry"].get("ms") is not None)
+    return {
+        "speed": "max" if not speed else speed,
+        "replayed": summarize("replayed", elapsed, [r["latency"] for r in ok]),
+        "recorded": summarize("recorded", None, recorded),
+        "errors": len(results) - len(ok),
+        "send_lag_p99_ms": round(lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000, 3) if lags else None,
+        "machines": len({r["entry"].get("m") for r in results}),
+        "diverged": len(diverged),
+        "diverged_fields": dict(fields.most_common()),
+        "examples": sorted(diverged, key=lambda d: d["t"])[:examples]
+    }
+
+
+def run(paths, speed=1.0, url=None, day=None):
+    entries = load(paths, day)
+    if not entries:
+        raise SystemExit("no captured requests to replay")
+    if url:
+        started = time.perf_counter()
+        results = replay(entries, url, speed)
+        return report(results, time.perf_counter() - started, speed)
+
+    work_dir = tempfile.mkdtemp(prefix="laundry-replay-")
+    try:
+        web = prepare_web(work_dir)
+        seed(web.DB_PATH, initial_users(entries))
+        with ServerThread(web.app) as server:
+            started = time.perf_counter()
+            results = replay(entries, server.url, speed)
+            return report(results, time.perf_counter() - started, speed)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replay captured /scan_card traffic")
+    parser.add_argument("files", nargs="+", help="capture files (.jsonl, .jsonl.N.gz); globs are expanded")
+    parser.add_argument("--speed", default="1", help="time compression: 1, 10, ... or max")
+    parser.add_argument("--day", help="only replay requests captured on this date (YYYY-MM-DD)")
+    parser.add_argument("--url", help="target server; default: a seeded throwaway copy of web.py")
+    args = parser.parse_args()
+
+    paths = sorted({path for pattern in args.files for path in (glob.glob(pattern) or [pattern])})
+    result = run(paths, 0 if args.speed == "max" else float(args.speed), args.url, args.day)
+    print(json.dumps(result, indent=2, default=str))
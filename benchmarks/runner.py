@@ -0,0 +1,224 @@
+"""
+Benchmark runner with a stored baseline.
+
+`run` executes the suites below with warmup and repetitions and writes
+the results, with the environment they ran in, to a JSON file. For each
+benchmark the median over the repetitions is kept (and the p95 spread,
+to judge noise). `compare` exits non-zero when p95 latency or throughput
+regressed past a threshold; `check` runs and compares in one go.
+
+    python benchmarks/runner.py run --save-baseline        # on the commit you trust
+    python benchmarks/runner.py check                      # after a change to web.py / cloneWep.py
+    python benchmarks/runner.py compare base.json new.json --p95 0.15 --throughput 0.10
+
+Compare results only from the same machine; the environment block is
+there to notice when they are not.
+"""
+import json
+import os
+import platform
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from common import ROOT
+
+import bench_balance_engine
+import bench_firmware_download
+import bench_gateway
+import bench_servers
+import bench_web
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+BASELINE = os.path.join(RESULTS_DIR, "baseline.json")
+# Allowed relative regressions before `compare` fails
+P95_THRESHOLD = 0.15
+THROUGHPUT_THRESHOLD = 0.10
+
+SUITES = {
+    "db_ops": lambda: bench_web.db_ops(ops=1000),
+    "index_render": lambda: bench_web.index_render(requests=100),
+    "scan_card": lambda: bench_web.scan_card("web", threads=8, requests=100),
+    "scan_card_clone": lambda: bench_web.scan_card("clone", threads=8, requests=100),
+    "scan_card_backup": lambda: bench_web.scan_card_backup(threads=8, requests=100),
+    "firmware_download": lambda: bench_firmware_download.run(clients=20, size=500000),
+    "balance_engine": lambda: [dict(r, name="balance_" + r["name"])
+                               for r in bench_balance_engine.run(threads=8, debits=500, cards=2000)
+                               if "ops_per_sec" in r],
+    "server_modes": lambda: bench_servers.run(("dev", "gunicorn:2x8"), clients=16, requests=30),
+    "gateway": lambda: [r for r in bench_gateway.run(("gateway:1x8",), idle=200, clients=(32,), requests=30,
+                                                     slow=16) if "ops_per_sec" in r],
+}
+
+
+def environment():
+    def version(package):
+        try:
+            from importlib.metadata import version as package_version
+            return package_version(package)
+        except Exception:
+            return None
+
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True,
+                                  timeout=10).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    return {"host": socket.gethostname(), "platform": platform.platform(), "machine": platform.machine(),
+            "cpus": os.cpu_count(), "python": platform.python_version(),
+            "implementation": platform.python_implementation(), "sqlite": sqlite3.sqlite_version,
+            "flask": version("flask"), "werkzeug": version("werkzeug"),
+            "load_avg": [round(x, 2) for x in os.getloadavg()] if hasattr(os, "getloadavg") else None,
+            "commit": git("rev-parse", "--short", "HEAD"),
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def aggregate(runs):
+    """Median of each metric over the repetitions of one benchmark"""
+    result = {"reps": len(runs)}
+    for key in ("ops_per_sec", "p50_ms", "p95_ms", "p99_ms", "max_ms"):
+        values = [r[key] for r in runs if r.get(key) is not None]
+        if values:
+            result[key] = round(statistics.median(values), 3)
+    p95 = [r["p95_ms"] for r in runs if r.get("p95_ms") is not None]
+    if len(p95) > 1:
+        result["p95_spread"] = round((max(p95) - min(p95)) / statistics.median(p95), 3)
+    errors = sum(r.get("errors", 0) for r in runs)
+    if errors:
+        result["errors"] = errors
+    return result
+
+
+def run(suites=None, reps=3, warmup=1, log=print):
+    names = suites or list(SUITES)
+    unknown = [name for name in names if name not in SUITES]
+    if unknown:
+        raise SystemExit(f"unknown suite(s): {', '.join(unknown)}; choose from {', '.join(SUITES)}")
+    results = {}
+    for name in names:
+        for i in range(warmup):
+            log(f"  {name}: warmup {i + 1}/{warmup}")
+            SUITES[name]()
+        runs = {}
+        for i in range(reps):
+            started = time.perf_counter()
+            for result in SUITES[name]():
+                runs.setdefault(result["name"], []).append(result)
+            log(f"  {name}: rep {i + 1}/{reps} ({time.perf_counter() - started:.1f}s)")
+        for bench, bench_runs in runs.items():
+            results[bench] = dict(aggregate(bench_runs), suite=name)
+    return {"created": datetime.now().isoformat(timespec="seconds"), "environment": environment(),
+            "reps": reps, "warmup": warmup, "results": results}
+
+
+def compare(base, new, p95_threshold=P95_THRESHOLD, throughput_threshold=THROUGHPUT_THRESHOLD):
+    """Per-benchmark changes; a benchmark regressed if p95 grew or throughput fell past the threshold"""
+    rows = []
+    for name, old in base["results"].items():
+        cur = new["results"].get(name)
+        if cur is None:
+            rows.append({"name": name, "status": "missing"})
+            continue
+        row = {"name": name, "status": "ok"}
+        if old.get("p95_ms") and cur.get("p95_ms") is not None:
+            row["p95_change"] = round(cur["p95_ms"] / old["p95_ms"] - 1, 3)
+            if row["p95_change"] > p95_threshold:
+                row["status"] = "regressed"
+        if old.get("ops_per_sec") and cur.get("ops_per_sec") is not None:
+            row["throughput_change"] = round(cur["ops_per_sec"] / old["ops_per_sec"] - 1, 3)
+            if row["throughput_change"] < -throughput_threshold:
+                row["status"] = "regressed"
+        if cur.get("errors", 0) > old.get("errors", 0):
+            row["status"] = "regressed"
+            row["errors"] = cur["errors"]
+        row.update(p95_ms=[old.get("p95_ms"), cur.get("p95_ms")],
+                   ops_per_sec=[old.get("ops_per_sec"), cur.get("ops_per_sec")])
+        rows.append(row)
+    rows.extend({"name": name, "status": "new"} for name in new["results"] if name not in base["results"])
+    return rows
+
+
+def environment_changes(base, new):
+    keys = ("host", "cpus", "python", "implementation", "sqlite", "flask", "werkzeug")
+    return {key: [base["environment"].get(key), new["environment"].get(key)] for key in keys
+            if base["environment"].get(key) != new["environment"].get(key)}
+
+
+def print_comparison(rows, base, new):
+    print(f"baseline {base['environment'].get('commit')} ({base['created']}) -> "
+          f"{new['environment'].get('commit')}{' (dirty)' if new['environment'].get('dirty') else ''}")
+    for key, (old, cur) in environment_changes(base, new).items():
+        print(f"✗ environment differs: {key} {old} -> {cur}; numbers are not comparable")
+    for row in rows:
+        if row["status"] in ("missing", "new"):
+            print(f"  {row['name']:<24} {row['status']}")
+            continue
+        mark = "✗" if row["status"] == "regressed" else "✓"
+        p95_old, p95_new = row["p95_ms"]
+        ops_old, ops_new = row["ops_per_sec"]
+        print(f"{mark} {row['name']:<24} p95 {p95_old} -> {p95_new} ms ({row.get('p95_change', 0):+.1%})  "
+              f"ops/s {ops_old} -> {ops_new} ({row.get('throughput_change', 0):+.1%})"
+              f"{'  errors ' + str(row['errors']) if row.get('errors') else ''}")
+
+
+def save(result, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"✓ Results written to {path}")
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark runner and regression check")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command in ("run", "check"):
+        sub = commands.add_parser(command)
+        sub.add_argument("--suite", action="append", help=f"one of {', '.join(SUITES)} (repeatable)")
+        sub.add_argument("--reps", type=int, default=3)
+        sub.add_argument("--warmup", type=int, default=1)
+        sub.add_argument("--out", help="results file (default: results/<timestamp>.json)")
+    commands.choices["run"].add_argument("--save-baseline", action="store_true",
+                                         help=f"also write the results to {BASELINE}")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    for sub in (commands.choices["check"], compare_parser):
+        sub.add_argument("--baseline", default=BASELINE, help="baseline for check")
+        sub.add_argument("--p95", type=float, default=P95_THRESHOLD, help="allowed p95 increase (0.15 = 15%%)")
+        sub.add_argument("--throughput", type=float, default=THROUGHPUT_THRESHOLD,
+                         help="allowed throughput drop (0.10 = 10%%)")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        base, new = load(args.base), load(args.new)
+    else:
+        if args.command == "check" and not os.path.exists(args.baseline):
+            raise SystemExit(f"no baseline at {args.baseline}; run `runner.py run --save-baseline` first")
+        new = run(args.suite, args.reps, args.warmup)
+        save(new, args.out or os.path.join(RESULTS_DIR, datetime.now().strftime("%Y%m%d_%H%M%S") + ".json"))
+        if args.command == "run":
+            if args.save_baseline:
+                save(new, BASELINE)
+            sys.exit(0)
+        base = load(args.baseline)
+
+    rows = compare(base, new, args.p95, args.throughput)
+    print_comparison(rows, base, new)
+    regressed = [row["name"] for row in rows if row["status"] == "regressed"]
+    if regressed:
+        print(f"✗ Regressed: {', '.join(regressed)}")
+        sys.exit(1)
+    print("✓ No regressions")
@@ -0,0 +1,128 @@
+"""
+Opt-in capture of /scan_card traffic, for replay as a benchmark.
+
+With SCAN_CAPTURE=1 (or POST /api/capture) every /scan_card request is
+appended to captures/scan_card.jsonl as one compact JSON line:
+
+    {"t": unix time, "m": machine id, "q": request body, "s": status,
+     "r": response body, "ms": handler latency}
+
+The request thread only queues the raw bodies; decoding and writing
+happen on a QueueListener thread, and a full queue drops entries instead
+of blocking a scan. The file rotates at SCAN_CAPTURE_MAX_BYTES into
+gzip-compressed backups (scan_card.jsonl.1.gz is the newest), keeping
+SCAN_CAPTURE_BACKUPS of them. benchmarks/replay_scan_card.py replays them.
+"""
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import time
+
+import applog
+
+# Capture configuration
+CAPTURE_ENABLED = os.environ.get("SCAN_CAPTURE", "0") == "1"
+CAPTURE_FILE = os.environ.get("SCAN_CAPTURE_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                "captures", "scan_card.jsonl"))
+CAPTURE_MAX_BYTES = int(os.environ.get("SCAN_CAPTURE_MAX_BYTES", 50 * 1024 * 1024))
+CAPTURE_BACKUPS = int(os.environ.get("SCAN_CAPTURE_BACKUPS", 14))
+CAPTURE_QUEUE_SIZE = 10000
+
+
+def _body(raw):
+    """Raw request/response bytes as JSON where possible, else text"""
+    if not raw:
+        return None
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw.decode("utf-8", "replace")
+
+
+class CaptureFormatter(logging.Formatter):
+    def format(self, record):
+        entry = dict(record.msg)
+        entry["q"] = _body(entry["q"])
+        entry["r"] = _body(entry["r"])
+        if entry.get("m") is None and isinstance(entry["q"], dict):
+            entry["m"] = entry["q"].get("machine_id", "unknown")
+        return json.dumps(entry, separators=(",", ":"), ensure_ascii=False)
+
+
+def _gzip_rotate(source, dest):
+    with open(source, "rb") as raw, gzip.open(dest, "wb") as gz:
+        shutil.copyfileobj(raw, gz)
+    os.remove(source)
+
+
+class ScanRecorder:
+    def __init__(self, path=CAPTURE_FILE, max_bytes=CAPTURE_MAX_BYTES, backups=CAPTURE_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.logger = logging.getLogger("laundry.capture")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = None
+        self.listener = None
+
+    @property
+    def enabled(self):
+        return self.listener is not None
+
+    def start(self):
+        if self.listener is not None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=self.max_bytes,
+                                                            backupCount=self.backups, encoding="utf-8")
+        file_handler.namer = lambda name: name + ".gz"
+        file_handler.rotator = _gzip_rotate
+        file_handler.setFormatter(CaptureFormatter())
+        self.handler = applog.DroppingQueueHandler(queue.Queue(CAPTURE_QUEUE_SIZE))
+        self.logger.addHandler(self.handler)
+        self.listener = logging.handlers.QueueListener(self.handler.queue, file_handler)
+        self.listener.start()
+        print(f"✓ Capturing /scan_card traffic to {self.path}")
+
+    def stop(self):
+        """Flush queued entries and close the file"""
+        if self.listener is None:
+            return
+        listener, self.listener = self.listener, None
+        self.logger.removeHandler(self.handler)
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+    def record(self, body, status, response_body, latency_ms):
+        self.logger.info({"t": round(time.time(), 3), "m": None, "q": body,
+                          "s": status, "r": response_body, "ms": latency_ms})
+
+    def status(self):
+        files = []
+        folder = os.path.dirname(self.path)
+        if os.path.isdir(folder):
+            base = os.path.basename(self.path)
+            files = [{"name": name, "size": os.path.getsize(os.path.join(folder, name))}
+                     for name in sorted(os.listdir(folder)) if name.startswith(base)]
+        return {"enabled": self.enabled, "file": self.path, "max_bytes": self.max_bytes,
+                "backups": self.backups, "dropped": self.handler.dropped if self.handler else 0,
+                "files": files}
+
+
+def instrument(app, recorder, endpoints=("scan_card",)):
+    """Record requests to `endpoints` while the recorder is running"""
+    from flask import request
+
+    @app.after_request
+    def _capture(response):
+        if recorder.enabled and request.endpoint in endpoints:
+            recorder.record(request.get_data(), response.status_code, response.get_data(), applog.elapsed_ms())
+        return response
+
+    return app
@@ -2,13 +2,24 @@ from flask import Flask, g, request, render_template_string, redirect, jsonify
 import sqlite3
 import os
 from datetime import datetime
-import threading
 import time
+import maintenance
+import metrics
+import querylog
+import applog
+import logging
 
 app = Flask(__name__)
+# JSON events with a request id, written by a background thread (LOG_LEVEL, LOG_FILE)
+applog.configure()
+applog.instrument(app)
+log = applog.get_logger("clone")
 
-# Thread lock for database operations
-db_lock = threading.Lock()
+# Request, database and lock wait metrics at /metrics
+metrics.instrument(app)
+
+# Thread lock for database operations (wait and hold times per call site go to /metrics and /api/locks)
+db_lock = metrics.TimedLock("db_lock")
 
 # Database configuration
 DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database")
@@ -17,6 +28,9 @@ DB_PATH = os.path.join(DB_DIR, "laundry.db")
 # Server-side cache for last scanned RFID data
 LAST_RFID = None
 
+# WAL checkpoints, ANALYZE and incremental vacuum in the background
+scheduler = maintenance.create_scheduler(DB_PATH)
+
 # HTML template (same as before, keeping it intact)
 template = """
 <!DOCTYPE html>
@@ -451,6 +465,8 @@ def init_db():
         conn = sqlite3.connect(DB_PATH, timeout=30.0)
         c = conn.cursor()
         
+        # Only applies to a new database; allows incremental vacuum
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")
         # Enable WAL mode for better concurrency
         c.execute("PRAGMA journal_mode=WAL")
         c.execute("PRAGMA synchronous=NORMAL")
@@ -479,7 +495,7 @@ def init_db():
 
 def get_db_connection():
     """Get a fresh database connection with timeout"""
-    return sqlite3.connect(DB_PATH, timeout=10.0)
+    return metrics.connect(DB_PATH, timeout=10.0)
 
 def log_action(card_id, username, action, balance):
     """Thread-safe log action with retry mechanism"""
@@ -493,16 +509,23 @@ def log_action(card_id, username, action, balance):
                          (card_id, username, action, balance))
                 conn.commit()
                 conn.close()
+            if attempt:
+                metrics.DB_RETRIES.inc(op="log_action", outcome="succeeded")
             return True
         except sqlite3.OperationalError as e:
-            if "locked" in str(e) and attempt < max_attempts - 1:
-                print(f"Database locked, retrying logging ({attempt + 1}/{max_attempts})...")
+            busy = "locked" in str(e)
+            if busy:
+                metrics.DB_BUSY.inc(op="log_action")
+            if busy and attempt < max_attempts - 1:
+                applog.event(log, logging.DEBUG, "db_locked_retry", op="log_action", attempt=attempt + 1)
                 time.sleep(0.1 * (attempt + 1))
             else:
-                print(f"Failed to log after {max_attempts} attempts: {e}")
+                if busy:
+                    metrics.DB_RETRIES.inc(op="log_action", outcome="exhausted")
+                applog.event(log, logging.ERROR, "log_action_failed", attempts=max_attempts, error=str(e))
                 return False
         except Exception as e:
-            print(f"Logging error: {e}")
+            log.error("log_action_failed", exc_info=True)
             return False
     return False
 
@@ -525,17 +548,29 @@ def execute_db_query(query, params=(), fetchone=False, fetchall=False):
                 
                 conn.commit()
                 conn.close()
+                if attempt:
+                    metrics.DB_RETRIES.inc(op="query", outcome="succeeded")
                 return result
                 
         except sqlite3.OperationalError as e:
-            if "locked" in str(e) and attempt < max_attempts - 1:
-                print(f"Database locked, retrying query ({attempt + 1}/{max_attempts})...")
+            busy = "locked" in str(e)
+            if busy:
+                metrics.DB_BUSY.inc(op="query")
+            if busy and attempt < max_attempts - 1:
+                applog.event(log, logging.DEBUG, "db_locked_retry", op="query", attempt=attempt + 1)
                 time.sleep(0.1 * (attempt + 1))
             else:
+                if busy:
+                    metrics.DB_RETRIES.inc(op="query", outcome="exhausted")
                 raise e
         except Exception as e:
             raise e
 
+@app.before_request
+def track_request_rate():
+    """Feed the maintenance scheduler's quiet-window detection"""
+    scheduler.note_request()
+
 @app.route("/")
 def index():
     """Main dashboard page"""
@@ -690,6 +725,7 @@ def scan_card():
         try:
             data = request.get_json(silent=True)
             if not data:
+                metrics.SCAN_OUTCOMES.inc(outcome="invalid")
                 return jsonify({
                     "success": False,
                     "message": "No JSON data received"
@@ -701,12 +737,14 @@ def scan_card():
             machine_id = data.get("machine_id", "laundry_machine_1")
             
             if not card_id:
+                metrics.SCAN_OUTCOMES.inc(outcome="invalid")
                 return jsonify({
                     "success": False,
                     "message": "Card ID is required"
                 }), 400
             
             if coins_requested <= 0:
+                metrics.SCAN_OUTCOMES.inc(outcome="invalid")
                 return jsonify({
                     "success": False,
                     "message": "Coins must be greater than 0"
@@ -728,6 +766,7 @@ def scan_card():
             )
             
             if not user:
+                metrics.SCAN_OUTCOMES.inc(outcome="unregistered")
                 return jsonify({
                     "success": False,
                     "user_exists": False,
@@ -740,6 +779,7 @@ def scan_card():
             
             # Check if user has sufficient balance
             if balance < coins_requested:
+                metrics.SCAN_OUTCOMES.inc(outcome="insufficient")
                 return jsonify({
                     "success": False,
                     "user_exists": True,
@@ -764,7 +804,11 @@ def scan_card():
                 balance=new_balance
             )
             
-            print(f"✓ Transaction successful: {username} used {coins_requested} coin(s). New balance: {new_balance}")
+            metrics.SCAN_OUTCOMES.inc(outcome="approved")
+            applog.event(log, logging.INFO, "scan_card", outcome="approved", card_id=card_id,
+                         machine_id=machine_id, username=username, coins=coins_requested,
+                         balance=new_balance, latency_ms=applog.elapsed_ms())
+            metrics.COINS_DEBITED.inc(coins_requested)
             
             return jsonify({
                 "success": True,
@@ -778,11 +822,13 @@ def scan_card():
             })
             
         except ValueError:
+            metrics.SCAN_OUTCOMES.inc(outcome="invalid")
             return jsonify({
                 "success": False,
                 "message": "Invalid data format. Coins must be a number."
             }), 400
         except Exception as e:
+            metrics.SCAN_OUTCOMES.inc(outcome="error")
             return jsonify({
                 "success": False,
                 "message": f"Server error: {str(e)}"
@@ -814,6 +860,20 @@ def spend_api():
         "message": "This endpoint is deprecated. Use /scan_card instead."
     }), 410  # 410 Gone
 
+@app.route("/api/slow_queries", methods=["GET"])
+def api_slow_queries():
+    """Statements over SLOW_QUERY_MS with their query plans (localhost only)"""
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(querylog.SLOW_QUERIES.report(int(request.args.get("limit", 50))))
+
+@app.route("/api/locks", methods=["GET"])
+def api_locks():
+    """Most contended db_lock call sites, SQLITE_BUSY counts and retry outcomes (localhost only)"""
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(metrics.lock_report(int(request.args.get("limit", 20))))
+
 @app.teardown_appcontext
 def close_db(error):
     """Close any remaining database connections"""
@@ -823,6 +883,8 @@ if __name__ == "__main__":
     print("=== Laundry Management System ===")
     print("Initializing database...")
     init_db()
+    scheduler.start()
+    print("Maintenance scheduler started:", ", ".join(scheduler.jobs))
     print("Starting Flask server on http://0.0.0.0:5000")
     print("Press Ctrl+C to stop")
     app.run(host="0.0.0.0", port=5000, debug=False, threaded=True)
\ No newline at end of file
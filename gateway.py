@@ -0,0 +1,351 @@
+"""
+Async gateway for the ESP32-facing endpoints (SERVER_MODE=gateway).
+
+An ASGI app that gunicorn's asyncio worker serves. An open connection
+costs the event loop a few kilobytes instead of a thread, so hundreds of
+machines can keep theirs open between scans and update checks. Anything
+that blocks (SQLite, firmware files, Flask views) runs on a small thread
+pool, the DB executor, of GATEWAY_DB_THREADS threads per worker:
+
+- POST /scan_card: the body is read on the loop, web.process_scan() runs
+  on the executor, and the answer is written from the loop
+- GET /firmware/manifest.json: the catalog's cached JSON, with ETag
+  revalidation
+- everything else (firmware version checks and downloads, the admin UI)
+  goes to web.app through a WSGI bridge: the Flask view runs on the
+  executor and its body is read there in 64 KB blocks, so a device on a
+  slow link holds a thread only while a block is read, not while it is sent
+
+At most GATEWAY_MAX_INFLIGHT requests per worker wait for or use the
+executor (a download stops counting once its view has returned); the
+next ones wait up to GATEWAY_QUEUE_TIMEOUT seconds for a slot and then
+get 503 with Retry-After. A request that raises is logged and answered
+with the 500 Flask would give (the scan's JSON error body for
+/scan_card) if nothing was sent yet. Scans are logged, traced, captured and
+counted in /metrics as under Flask, and every request counts toward the
+maintenance scheduler's quiet window. Idle connections are closed after
+WEB_KEEPALIVE seconds; gunicorn's asyncio worker does not enforce
+worker_connections.
+
+    SERVER_MODE=gateway WEB_WORKERS=2 GATEWAY_DB_THREADS=8 python -m server
+
+benchmarks/bench_gateway.py compares it with the threaded server.
+"""
+import asyncio
+import io
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import InternalServerError
+from werkzeug.http import parse_etags
+from werkzeug.wsgi import FileWrapper
+
+import applog
+import metrics
+import tracing
+import web
+
+# Gateway configuration
+GATEWAY_DB_THREADS = int(os.environ.get("GATEWAY_DB_THREADS", 8))
+GATEWAY_MAX_INFLIGHT = int(os.environ.get("GATEWAY_MAX_INFLIGHT", 64))
+GATEWAY_QUEUE_TIMEOUT = float(os.environ.get("GATEWAY_QUEUE_TIMEOUT", 5))
+# An ESP32 scan is well under 200 bytes
+SCAN_MAX_BODY = 16 * 1024
+BLOCK_SIZE = 64 * 1024
+
+log = applog.get_logger("gateway")
+executor = ThreadPoolExecutor(GATEWAY_DB_THREADS, thread_name_prefix="gateway-db")
+_inflight = None    # (event loop, semaphore)
+
+
+class FileBlocks(FileWrapper):
+    """wsgi.file_wrapper that reads BLOCK_SIZE at a time (Werkzeug asks for 8 KB)"""
+
+    def __init__(self, file, buffer_size=BLOCK_SIZE):
+        super().__init__(file, max(buffer_size, BLOCK_SIZE))
+
+
+class Busy(Exception):
+    """No in-flight slot freed up within GATEWAY_QUEUE_TIMEOUT"""
+
+
+def inflight_slots():
+    """The in-flight semaphore, created inside the running loop (and again if the loop changed)"""
+    global _inflight
+    loop = asyncio.get_running_loop()
+    if _inflight is None or _inflight[0] is not loop:
+        _inflight = (loop, asyncio.Semaphore(GATEWAY_MAX_INFLIGHT))
+    return _inflight[1]
+
+
+def offload(fn, *args):
+    """Run a blocking call on the DB executor"""
+    return asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+async def run(fn, *args):
+    """offload() holding an in-flight slot while the call waits and runs"""
+    started = time.perf_counter()
+    inflight = inflight_slots()
+    try:
+        await asyncio.wait_for(inflight.acquire(), GATEWAY_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        metrics.GATEWAY_REJECTED.inc()
+        raise Busy()
+    metrics.GATEWAY_WAIT_SECONDS.observe(time.perf_counter() - started)
+    try:
+        return await offload(fn, *args)
+    finally:
+        inflight.release()
+
+
+def header(scope, name):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def read_body(receive, limit):
+    """The request body; None if the client went away, or ValueError past `limit` bytes"""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            raise ValueError(f"Request body larger than {limit} bytes")
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def respond(send, status, body=b"", headers=()):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-length", str(len(body)).encode()), *headers]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def json_body(data):
+    """Encoded like Flask's jsonify(), so devices see the same bytes"""
+    return (json.dumps(data, sort_keys=True, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def busy(send):
+    return respond(send, 503, json_body({"error": "Server busy", "retry_after": 1}),
+                   [(b"content-type", b"application/json"), (b"retry-after", b"1")])
+
+
+def failed(scope, handler, e):
+    """The 500 for a request that raised `e` (call from its except block): (status, body, headers)"""
+    if handler is scan_card:
+        result, status = web.scan_failed(e)
+        return status, json_body(result), [(b"content-type", b"application/json")]
+    applog.event(log, logging.ERROR, "gateway_error", method=scope["method"], path=scope["path"],
+                 error=f"{type(e).__name__}: {e}")
+    error = InternalServerError()
+    return error.code, error.get_body().encode("utf-8"), [(b"content-type", b"text/html; charset=utf-8")]
+
+
+def record(route, method, status, started):
+    metrics.REQUESTS.inc(route=route, method=method, status=status)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=method)
+
+
+def _scan(body, is_json, rid, started):
+    """/scan_card on an executor thread, with the request id, trace and capture Flask would give it"""
+    applog.request_id.set(rid)
+    applog.request_started.set(started)
+    root = web.tracer.start("POST /scan_card", request_id=rid, method="POST")
+    status = 500
+    try:
+        with tracing.span("json_parse"):
+            try:
+                data = json.loads(body) if is_json else None
+            except ValueError:
+                data = None
+        result, status = web.process_scan(data or {})
+        with tracing.span("serialize"):
+            payload = json_body(result)
+    finally:
+        if root:
+            root.set(status=status)
+            web.tracer.finish(root)
+    if web.scan_recorder.enabled:
+        web.scan_recorder.record(body, status, payload, applog.elapsed_ms())
+    return status, payload
+
+
+async def scan_card(scope, receive, send, started):
+    try:
+        body = await read_body(receive, SCAN_MAX_BODY)
+    except ValueError as e:
+        await respond(send, 413, json_body({"error": str(e)}), [(b"content-type", b"application/json")])
+        record("/scan_card", "POST", 413, started)
+        return
+    if body is None:
+        return
+    rid = header(scope, b"x-request-id") or uuid.uuid4().hex[:16]
+    content_type = (header(scope, b"content-type") or "").split(";")[0].strip().lower()
+    is_json = content_type == "application/json" or content_type.endswith("+json")
+    status, payload = await run(_scan, body, is_json, rid, started)
+    await respond(send, status, payload, [(b"content-type", b"application/json"),
+                                          (b"x-request-id", rid.encode("latin-1"))])
+    record("/scan_card", "POST", status, started)
+
+
+async def firmware_manifest(scope, receive, send, started):
+    body, etag = await run(web.firmware_catalog.manifest_json)
+    etag_header = (b"etag", f'"{etag}"'.encode())
+    if parse_etags(header(scope, b"if-none-match")).contains(etag):
+        await respond(send, 304, headers=[etag_header])
+        status = 304
+    else:
+        await respond(send, 200, body, [(b"content-type", b"application/json"), etag_header,
+                                        (b"cache-control", b"no-cache")])
+        status = 200
+    record("/firmware/manifest.json", "GET", status, started)
+
+
+ROUTES = {
+    ("POST", "/scan_card"): scan_card,
+    ("GET", "/firmware/manifest.json"): firmware_manifest,
+}
+
+
+def wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "wsgi.file_wrapper": FileBlocks,
+        # app() already fed it to the maintenance scheduler's request rate
+        "gateway.request_noted": True,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        key = name if name in ("CONTENT_TYPE", "CONTENT_LENGTH") else "HTTP_" + name
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _call_wsgi(environ):
+    """Run web.app up to its first body block: (status, headers, body iterable, iterator, block)"""
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    body = web.app(environ, start_response)
+    iterator = iter(body)
+    block = next(iterator, None)
+    status, headers = started
+    return int(status.split(" ", 1)[0]), headers, body, iterator, block
+
+
+async def bridge(scope, receive, send):
+    """Any other route, answered by the Flask app"""
+    limit = web.app.config["MAX_CONTENT_LENGTH"]
+    try:
+        request_body = await read_body(receive, limit)
+    except ValueError as e:
+        await respond(send, 413, json_body({"error": str(e)}), [(b"content-type", b"application/json")])
+        return
+    if request_body is None:
+        return
+    status, headers, body, iterator, block = await run(_call_wsgi, wsgi_environ(scope, request_body))
+    # A send to a device that went away never completes, so watch for the disconnect
+    disconnected = asyncio.ensure_future(receive())
+    try:
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]})
+        while block is not None:
+            # Read the next block while this one is written
+            pending = offload(next, iterator, None)
+            sending = asyncio.ensure_future(send({"type": "http.response.body", "body": block,
+                                                  "more_body": True}))
+            while not sending.done():
+                await asyncio.wait((sending, disconnected), return_when=asyncio.FIRST_COMPLETED)
+                if not disconnected.done():
+                    continue
+                if disconnected.result()["type"] == "http.disconnect":
+                    sending.cancel()
+                    await pending
+                    return
+                # Any other message (e.g. a pipelined request) is not a disconnect: keep watching
+                disconnected = asyncio.ensure_future(receive())
+            sending.result()
+            block = await pending
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        disconnected.cancel()
+        # Releases e.g. the rollout download slot, also after a dropped download
+        if hasattr(body, "close"):
+            await offload(body.close)
+
+
+async def lifespan(receive, send):
+    # web.startup() already ran in server.py's post_worker_init hook
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            executor.shutdown(wait=False, cancel_futures=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    started = time.perf_counter()
+    web.scheduler.note_request()
+    handler = ROUTES.get((scope["method"], scope["path"]))
+    responded = []
+
+    async def tracked_send(message):
+        if message["type"] == "http.response.start":
+            responded.append(message["status"])
+        await send(message)
+
+    try:
+        if handler:
+            await handler(scope, receive, tracked_send, started)
+        else:
+            await bridge(scope, receive, tracked_send)
+    except Busy:
+        await busy(send)
+    except Exception as e:
+        status, body, headers = failed(scope, handler, e)
+        if not responded:
+            await respond(send, status, body, headers)
+        if handler:
+            # Bridged requests are counted by web.app's own metrics
+            record(scope["path"], scope["method"], status, started)
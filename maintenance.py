@@ -0,0 +1,353 @@
+"""
+Background maintenance for the laundry database.
+
+A single daemon thread runs jobs on cron-like schedules:
+
+    wal_checkpoint(PASSIVE)   every 5 minutes
+    wal_checkpoint(TRUNCATE)  nightly, quiet window only
+    PRAGMA optimize           hourly
+    ANALYZE                   weekly, quiet window only
+    incremental_vacuum        nightly, quiet window only
+
+"Quiet" is measured from the request rate the Flask app reports through
+note_request(); web.py counts it in shared memory (shared.py), so under
+gunicorn it covers the requests of every worker. Quiet-only jobs wait
+for a quiet minute, but never longer than QUIET_MAX_DEFER. Every run is
+kept in a short history with its duration and effect (WAL size, freed
+pages, ...) and counted in /metrics; successful runs are logged at
+DEBUG, failures at WARNING.
+
+    python maintenance.py list                 # show built-in jobs
+    python maintenance.py run checkpoint       # run one job now
+    python maintenance.py enable-incremental-vacuum
+"""
+import logging
+import sqlite3
+import os
+import struct
+import time
+import threading
+from collections import deque
+from datetime import datetime
+
+import applog
+import metrics
+
+# Database configuration
+DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database")
+DB_PATH = os.path.join(DB_DIR, "laundry.db")
+
+# Scheduler configuration
+QUIET_RPS = float(os.environ.get("MAINTENANCE_QUIET_RPS", 0.2))
+QUIET_WINDOW = int(os.environ.get("MAINTENANCE_QUIET_WINDOW", 60))
+QUIET_MAX_DEFER = int(os.environ.get("MAINTENANCE_QUIET_MAX_DEFER", 6 * 3600))
+VACUUM_PAGES = int(os.environ.get("MAINTENANCE_VACUUM_PAGES", 2000))
+HISTORY_SIZE = 200
+
+log = applog.get_logger("maintenance")
+
+
+class CronSchedule:
+    """
+    Minimal five-field cron expression: minute hour day-of-month month day-of-week.
+    Each field accepts '*', '*/n', 'a', 'a-b', 'a-b/n' and comma lists.
+    Day-of-week uses 0 = Sunday like cron. As in cron, when both
+    day-of-month and day-of-week are restricted (neither starts with '*')
+    a day matching either one matches.
+    """
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron expression needs 5 fields: {expr!r}")
+        self.expr = expr
+        self.fields = [self._parse(field, lo, hi) for field, (lo, hi) in zip(fields, self.RANGES)]
+        self.either_day = not fields[2].startswith("*") and not fields[4].startswith("*")
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/", 1)
+                step = int(step)
+            if part == "*":
+                start, end = lo, hi
+            elif "-" in part:
+                start, end = (int(v) for v in part.split("-", 1))
+            else:
+                start = end = int(part)
+            if start < lo or end > hi or step < 1:
+                raise ValueError(f"cron field out of range: {field!r}")
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+
+    def matches(self, dt):
+        minute, hour, dom, month, dow = self.fields
+        day_of_month, day_of_week = dt.day in dom, (dt.weekday() + 1) % 7 in dow
+        day = (day_of_month or day_of_week) if self.either_day else (day_of_month and day_of_week)
+        return dt.minute in minute and dt.hour in hour and dt.month in month and day
+
+    def __repr__(self):
+        return f"CronSchedule({self.expr!r})"
+
+
+class RequestRate:
+    """
+    Requests per second over a sliding window of one-second buckets. The
+    buckets live in `buffer` (e.g. shared memory guarded by a process-wide
+    `lock`, see shared.request_counts()), or in a private one by default.
+    """
+
+    BUCKET = struct.Struct("qq")    # second, requests in that second
+
+    def __init__(self, window=QUIET_WINDOW, buffer=None, lock=None):
+        self.window = window
+        self.buffer = buffer if buffer is not None else bytearray(self.BUCKET.size * window)
+        self.lock = lock or threading.Lock()
+
+    def hit(self):
+        now = int(time.time())
+        offset = now % self.window * self.BUCKET.size
+        with self.lock:
+            stamp, count = self.BUCKET.unpack_from(self.buffer, offset)
+            self.BUCKET.pack_into(self.buffer, offset, now, count + 1 if stamp == now else 1)
+
+    def rate(self):
+        oldest = int(time.time()) - self.window
+        with self.lock:
+            buckets = list(self.BUCKET.iter_unpack(self.buffer[:self.BUCKET.size * self.window]))
+        return sum(count for stamp, count in buckets if stamp > oldest) / self.window
+
+
+class Job:
+    def __init__(self, name, func, schedule, quiet_only=False):
+        self.name = name
+        self.func = func
+        self.schedule = CronSchedule(schedule)
+        self.quiet_only = quiet_only
+        self.due_since = None
+        self.last_marked = None
+        self.last_run = None
+        self.runs = 0
+        self.failures = 0
+
+
+class MaintenanceScheduler:
+    """Runs registered jobs one at a time on a single background thread"""
+
+    def __init__(self, quiet_rps=QUIET_RPS, max_defer=QUIET_MAX_DEFER, rate=None):
+        self.jobs = {}
+        self.rate = rate or RequestRate()
+        self.quiet_rps = quiet_rps
+        self.max_defer = max_defer
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def add_job(self, name, func, schedule, quiet_only=False):
+        """Register func() under a cron schedule. func may return a dict describing its effect."""
+        with self.lock:
+            self.jobs[name] = Job(name, func, schedule, quiet_only)
+
+    def note_request(self):
+        """Called once per HTTP request to feed quiet-window detection"""
+        self.rate.hit()
+
+    def is_quiet(self):
+        return self.rate.rate() <= self.quiet_rps
+
+    def run_job(self, name):
+        """Run a job immediately on the calling thread and record its metrics"""
+        job = self.jobs[name]
+        started = time.time()
+        record = {"job": name, "started": datetime.fromtimestamp(started).isoformat(timespec="seconds")}
+        try:
+            record["effect"] = job.func() or {}
+            record["status"] = "ok"
+        except Exception as e:
+            job.failures += 1
+            record["status"] = "error"
+            record["error"] = str(e)
+        record["duration_ms"] = round((time.time() - started) * 1000, 1)
+        job.runs += 1
+        job.last_run = started
+        job.due_since = None
+        self.history.append(record)
+
+        metrics.MAINTENANCE_RUNS.inc(job=name, status=record["status"])
+        metrics.MAINTENANCE_SECONDS.observe(record["duration_ms"] / 1000, job=name)
+        if record["status"] == "ok":
+            # Some jobs run every minute; stay out of the log unless asked for
+            applog.event(log, logging.DEBUG, "maintenance_run", job=name, duration_ms=record["duration_ms"],
+                         effect=record["effect"])
+        else:
+            applog.event(log, logging.WARNING, "maintenance_failed", job=name,
+                         duration_ms=record["duration_ms"], error=record["error"])
+        return record
+
+    def tick(self, now=None):
+        """Mark jobs due for this minute and run whatever may run now"""
+        now = now or datetime.now().replace(second=0, microsecond=0)
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            if job.last_marked != now and job.schedule.matches(now):
+                job.last_marked = now
+                if job.due_since is None:
+                    job.due_since = time.time()
+
+        quiet = None
+        for job in jobs:
+            if job.due_since is None:
+                continue
+            if job.quiet_only:
+                if quiet is None:
+                    quiet = self.is_quiet()
+                if not quiet and time.time() - job.due_since < self.max_defer:
+                    continue
+            self.run_job(job.name)
+
+    def _loop(self):
+        while not self.stop_event.is_set():
+            # Deferred quiet-only jobs get another chance on every wake-up
+            self.tick(datetime.now().replace(second=0, microsecond=0))
+            self.stop_event.wait(5.0)
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return self.thread
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._loop, name="db-maintenance", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=10)
+
+    def status(self):
+        """Job summary plus recent runs, for the admin API"""
+        return {
+            "request_rate": round(self.rate.rate(), 3),
+            "quiet": self.is_quiet(),
+            "jobs": [{
+                "name": job.name,
+                "schedule": job.schedule.expr,
+                "quiet_only": job.quiet_only,
+                "runs": job.runs,
+                "failures": job.failures,
+                "pending": job.due_since is not None,
+                "last_run": datetime.fromtimestamp(job.last_run).isoformat(timespec="seconds") if job.last_run else None
+            } for job in self.jobs.values()],
+            "history": list(self.history)[-50:]
+        }
+
+
+def _wal_size(db_path):
+    wal = db_path + "-wal"
+    return os.path.getsize(wal) if os.path.exists(wal) else 0
+
+
+def wal_checkpoint(db_path=DB_PATH, mode="PASSIVE"):
+    """Checkpoint the WAL; TRUNCATE also shrinks the -wal file to zero bytes"""
+    if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+        raise ValueError(f"Unknown checkpoint mode: {mode}")
+    before = _wal_size(db_path)
+    conn = sqlite3.connect(db_path, timeout=10.0)
+    try:
+        busy, log_frames, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    finally:
+        conn.close()
+    return {"mode": mode, "busy": busy, "wal_frames": log_frames, "checkpointed": checkpointed,
+            "wal_bytes_before": before, "wal_bytes_after": _wal_size(db_path)}
+
+
+def optimize(db_path=DB_PATH):
+    """PRAGMA optimize: cheap, only re-analyzes tables whose stats went stale"""
+    conn = sqlite3.connect(db_path, timeout=10.0)
+    try:
+        conn.execute("PRAGMA optimize")
+    finally:
+        conn.close()
+    return {}
+
+
+def analyze(db_path=DB_PATH):
+    """Full ANALYZE so the planner sees current table sizes"""
+    conn = sqlite3.connect(db_path, timeout=10.0)
+    try:
+        conn.execute("ANALYZE")
+        conn.commit()
+        tables = conn.execute("SELECT COUNT(DISTINCT tbl) FROM sqlite_stat1").fetchone()[0]
+    finally:
+        conn.close()
+    return {"tables": tables}
+
+
+def incremental_vacuum(db_path=DB_PATH, pages=VACUUM_PAGES):
+    """Release up to `pages` free pages back to the filesystem"""
+    conn = sqlite3.connect(db_path, timeout=10.0)
+    try:
+        mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if mode != 2:
+            return {"skipped": "auto_vacuum is not INCREMENTAL", "free_pages": free_before}
+        # execute() steps the pragma only once (one page); executescript runs it to completion
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        free_after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    finally:
+        conn.close()
+    return {"pages_freed": free_before - free_after, "bytes_freed": (free_before - free_after) * page_size,
+            "free_pages": free_after}
+
+
+def enable_incremental_vacuum(db_path=DB_PATH):
+    """Switch an existing database to auto_vacuum=INCREMENTAL (needs a full VACUUM once)"""
+    conn = sqlite3.connect(db_path, timeout=30.0, isolation_level=None)
+    try:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    finally:
+        conn.close()
+
+
+def create_scheduler(db_path=DB_PATH, rate=None):
+    """Scheduler with the standard SQLite housekeeping jobs registered"""
+    scheduler = MaintenanceScheduler(rate=rate)
+    scheduler.add_job("checkpoint", lambda: wal_checkpoint(db_path, "PASSIVE"), "*/5 * * * *")
+    scheduler.add_job("checkpoint_truncate", lambda: wal_checkpoint(db_path, "TRUNCATE"), "0 3 * * *",
+                      quiet_only=True)
+    scheduler.add_job("optimize", lambda: optimize(db_path), "17 * * * *")
+    scheduler.add_job("analyze", lambda: analyze(db_path), "30 3 * * 0", quiet_only=True)
+    scheduler.add_job("incremental_vacuum", lambda: incremental_vacuum(db_path), "45 3 * * *",
+                      quiet_only=True)
+    return scheduler
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Laundry database maintenance")
+    parser.add_argument("command", choices=["list", "run", "enable-incremental-vacuum"])
+    parser.add_argument("job", nargs="?", help="job to run")
+    parser.add_argument("--db", default=DB_PATH, help="database file")
+    args = parser.parse_args()
+
+    scheduler = create_scheduler(args.db)
+    if args.command == "list":
+        for job in scheduler.jobs.values():
+            print(f"{job.name:20} {job.schedule.expr:15} {'quiet only' if job.quiet_only else ''}")
+    elif args.command == "run":
+        if args.job not in scheduler.jobs:
+            parser.error(f"job must be one of: {', '.join(scheduler.jobs)}")
+        print(json.dumps(scheduler.run_job(args.job), indent=2))
+    else:
+        print("auto_vacuum=INCREMENTAL" if enable_incremental_vacuum(args.db) else "Could not enable incremental vacuum")
@@ -0,0 +1,160 @@
+"""
+Memory diagnostics with tracemalloc.
+
+Off by default: tracing every allocation slows the interpreter down and
+costs memory of its own, so an operator starts it (see web.py's
+/api/memory), takes snapshots some time apart, diffs them grouped by
+file and line, and stops it again. Snapshots stay in memory; only the
+newest MEMORY_SNAPSHOTS are kept.
+
+Independently of tracemalloc, watch(name, fn) registers a callable that
+returns the current size of one of our own structures (queues, caches,
+buffers). status() reports them with the process RSS, and type_counts()
+counts live objects by type through the garbage collector.
+"""
+import gc
+import os
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+# Memory diagnostics configuration
+MEMORY_SNAPSHOTS = int(os.environ.get("MEMORY_SNAPSHOTS", 5))
+# Frames stored per allocation; 1 is enough to group by file and line
+MEMORY_FRAMES = int(os.environ.get("MEMORY_FRAMES", 1))
+KEY_TYPES = ("lineno", "filename", "traceback")
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Allocations made by the diagnostics themselves are noise
+_FILTERS = (tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, "<unknown>"))
+
+
+def rss_bytes():
+    """Resident set size of this process (peak RSS where /proc is missing)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _where(frame):
+    filename = frame.filename
+    if filename.startswith(ROOT + os.sep):
+        filename = os.path.relpath(filename, ROOT)
+    return f"{filename}:{frame.lineno}"
+
+
+def _describe(stat, key_type):
+    traceback = stat.traceback
+    if key_type == "filename":
+        return _where(traceback[0]).rsplit(":", 1)[0]
+    if key_type == "traceback":
+        return " <- ".join(_where(frame) for frame in reversed(traceback))
+    return _where(traceback[0])
+
+
+class MemoryProfiler:
+    def __init__(self, keep=MEMORY_SNAPSHOTS, frames=MEMORY_FRAMES):
+        self.keep = keep
+        self.frames = frames
+        self.snapshots = []      # [{id, label, taken, traced_bytes, rss_bytes, snapshot}], oldest first
+        self.next_id = 1
+        self.started_at = None
+        self.watched = {}
+
+    def start(self, frames=None):
+        if frames is not None:
+            if int(frames) < 1:
+                raise ValueError("frames must be at least 1")
+            self.frames = int(frames)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.started_at = datetime.now().isoformat(timespec="seconds")
+        return self.status()
+
+    def stop(self):
+        """Stop tracing; snapshots already taken stay available"""
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.started_at = None
+        return self.status()
+
+    def snapshot(self, label=None):
+        if not tracemalloc.is_tracing():
+            raise ValueError("tracemalloc is not running; start it first")
+        snapshot = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+        entry = {"id": self.next_id, "label": label, "taken": datetime.now().isoformat(timespec="seconds"),
+                 "traced_bytes": tracemalloc.get_traced_memory()[0], "rss_bytes": rss_bytes(),
+                 "snapshot": snapshot}
+        self.next_id += 1
+        self.snapshots.append(entry)
+        del self.snapshots[:-self.keep]
+        return self._info(entry)
+
+    def _get(self, snapshot_id):
+        for entry in self.snapshots:
+            if entry["id"] == int(snapshot_id):
+                return entry
+        raise KeyError(f"no snapshot {snapshot_id}")
+
+    @staticmethod
+    def _key_type(key_type):
+        if key_type not in KEY_TYPES:
+            raise ValueError(f"key must be one of: {', '.join(KEY_TYPES)}")
+        return key_type
+
+    @staticmethod
+    def _info(entry):
+        return {key: value for key, value in entry.items() if key != "snapshot"}
+
+    def top(self, snapshot_id, key_type="lineno", limit=20):
+        """Largest allocators in one snapshot"""
+        entry = self._get(snapshot_id)
+        stats = entry["snapshot"].statistics(self._key_type(key_type))
+        return dict(self._info(entry), total_bytes=sum(stat.size for stat in stats),
+                    top=[{"where": _describe(stat, key_type), "size": stat.size, "count": stat.count}
+                         for stat in stats[:limit]])
+
+    def diff(self, old_id, new_id, key_type="lineno", limit=20):
+        """What grew (or shrank) the most between two snapshots"""
+        old, new = self._get(old_id), self._get(new_id)
+        stats = new["snapshot"].compare_to(old["snapshot"], self._key_type(key_type))
+        return {"old": self._info(old), "new": self._info(new),
+                "size_diff": sum(stat.size_diff for stat in stats),
+                "rss_diff": new["rss_bytes"] - old["rss_bytes"],
+                "top": [{"where": _describe(stat, key_type), "size_diff": stat.size_diff,
+                         "count_diff": stat.count_diff, "size": stat.size, "count": stat.count}
+                        for stat in stats[:limit]]}
+
+    def watch(self, name, size):
+        """Report size() under `name`, e.g. the length of a queue or cache"""
+        self.watched[name] = size
+
+    def sizes(self):
+        result = {}
+        for name, size in self.watched.items():
+            try:
+                result[name] = size()
+            except Exception as e:
+                result[name] = f"error: {e}"
+        return result
+
+    @staticmethod
+    def type_counts(limit=30):
+        """Live objects tracked by the garbage collector, by type, most common first"""
+        counts = Counter(type(obj).__name__ for obj in gc.get_objects())
+        return [{"type": name, "count": count} for name, count in counts.most_common(limit)]
+
+    def status(self):
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        return {"tracing": tracing, "frames": self.frames, "started_at": self.started_at,
+                "traced_bytes": current, "traced_peak_bytes": peak,
+                "overhead_bytes": tracemalloc.get_tracemalloc_memory() if tracing else 0,
+                "rss_bytes": rss_bytes(), "snapshots": [self._info(entry) for entry in self.snapshots],
+                "structures": self.sizes()}
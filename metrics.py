@@ -0,0 +1,416 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Counters and histograms keep plain dicts keyed by label values behind a
+short lock, so threaded servers can update them from every request.
+instrument(app) adds per-route request counts and latency histograms to
+a Flask app and serves everything at /metrics. Under a pre-forked server
+each worker also writes its series to a shared folder (EXCHANGE, started
+by server.py), and /metrics adds the other workers' latest copies to its
+own, so any worker answers for all of them.
+
+Database timing comes from connect(), a drop-in for sqlite3.connect()
+whose cursors time each statement and whose commits are timed as well;
+TimedLock is a threading.Lock that records how long callers waited and
+held it, per call site; lock_report() ranks the sites by time waited.
+Statements over the slow-query threshold also go to querylog.SLOW_QUERIES.
+"""
+import bisect
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import querylog
+
+# Seconds between the snapshots a worker writes for the other workers' /metrics
+METRICS_SYNC_INTERVAL = float(os.environ.get("METRICS_SYNC_INTERVAL", 5))
+# Seconds; covers a cached lookup up to a slow fsync or a firmware transfer
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(tuple(labels.get(name, "") for name in self.labelnames), 0)
+
+    def items(self):
+        with self.lock:
+            return list(self.values.items())
+
+    def render(self, others=()):
+        """`others`: snapshots of other processes (Registry.snapshot()) to add in"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        values = dict(self.items())
+        for snapshot in others:
+            for key, value in snapshot.get(self.name, ()):
+                values[tuple(key)] = values.get(tuple(key), 0) + value
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}         # label values -> [bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, **labels):
+        series = self.values.get(tuple(labels.get(name, "") for name in self.labelnames))
+        return sum(series[:-1]) if series else 0
+
+    def items(self):
+        with self.lock:
+            return [(key, list(series)) for key, series in self.values.items()]
+
+    def render(self, others=()):
+        """`others`: snapshots of other processes (Registry.snapshot()) to add in"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        values = dict(self.items())
+        for snapshot in others:
+            for key, series in snapshot.get(self.name, ()):
+                mine = values.get(tuple(key))
+                values[tuple(key)] = [a + b for a, b in zip(mine, series)] if mine else series
+        for key, series in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.metrics.get(name) or self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.metrics.get(name) or self.register(Histogram(name, help, labelnames, buckets))
+
+    def snapshot(self):
+        """Every series as JSON-friendly data: {name: [[label values, value or series], ...]}"""
+        return {name: [[list(key), value] for key, value in metric.items()]
+                for name, metric in list(self.metrics.items())}
+
+    def render(self, others=()):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render(others))
+        return "\n".join(lines) + "\n"
+
+
+class Exchange:
+    """
+    Registry snapshots the worker processes of one server share through
+    `<folder>/<name>.json` files, rewritten every METRICS_SYNC_INTERVAL
+    seconds. A restarted worker takes over its predecessor's file, so its
+    counts start over as they would in a single process.
+    """
+
+    def __init__(self, registry, interval=METRICS_SYNC_INTERVAL):
+        self.registry = registry
+        self.interval = interval
+        self.folder = None
+        self.path = None
+        self.thread = None
+
+    def start(self, folder, name):
+        self.folder = folder
+        self.path = os.path.join(folder, f"{name}.json")
+        self.write()
+        self.thread = threading.Thread(target=self._run, name="metrics-exchange", daemon=True)
+        self.thread.start()
+
+    def write(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.registry.snapshot(), f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+    def others(self):
+        """The latest snapshots of the other workers ([] until start())"""
+        if not self.folder:
+            return []
+        snapshots = []
+        for entry in sorted(os.listdir(self.folder)):
+            path = os.path.join(self.folder, entry)
+            if entry.endswith(".json") and path != self.path:
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return snapshots
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except OSError:
+                pass
+
+
+REGISTRY = Registry()
+EXCHANGE = Exchange(REGISTRY)
+
+REQUESTS = REGISTRY.counter("http_requests_total", "HTTP requests by route, method and status",
+                            ("route", "method", "status"))
+REQUEST_SECONDS = REGISTRY.histogram("http_request_duration_seconds", "Time spent handling a request",
+                                     ("route", "method"))
+DB_CONNECT_SECONDS = REGISTRY.histogram("db_connect_seconds", "Time to open a SQLite connection")
+DB_QUERY_SECONDS = REGISTRY.histogram("db_query_seconds", "SQLite statement execution time", ("operation",))
+DB_SLOW_QUERIES = REGISTRY.counter("db_slow_queries_total", "SQLite statements over the slow-query threshold",
+                                   ("operation",))
+DB_COMMIT_SECONDS = REGISTRY.histogram("db_commit_seconds", "SQLite commit time (includes the WAL write)")
+LOCK_WAIT_SECONDS = REGISTRY.histogram("lock_wait_seconds", "Time spent waiting to acquire a lock",
+                                       ("lock", "site"))
+LOCK_HELD_SECONDS = REGISTRY.histogram("lock_held_seconds", "Time a lock was held", ("lock", "site"))
+LOCK_CONTENDED = REGISTRY.counter("lock_contended_total", "Acquisitions that found the lock already held",
+                                  ("lock", "site"))
+DB_BUSY = REGISTRY.counter("db_busy_total", "SQLITE_BUSY (database is locked) errors", ("op",))
+DB_RETRIES = REGISTRY.counter("db_retries_total", "Busy-retry loops that needed a retry, by outcome",
+                              ("op", "outcome"))
+SCAN_OUTCOMES = REGISTRY.counter("scan_card_total", "Card scans by outcome", ("outcome",))
+COINS_DEBITED = REGISTRY.counter("coins_debited_total", "Coins deducted from card balances")
+FIRMWARE_BYTES = REGISTRY.counter("firmware_bytes_served_total", "Firmware bytes sent to devices",
+                                  ("kind",))
+MAINTENANCE_RUNS = REGISTRY.counter("maintenance_runs_total", "Maintenance job runs by job and status",
+                                    ("job", "status"))
+MAINTENANCE_SECONDS = REGISTRY.histogram("maintenance_duration_seconds", "Maintenance job run time", ("job",))
+GATEWAY_WAIT_SECONDS = REGISTRY.histogram("gateway_wait_seconds",
+                                          "Time a gateway request waited for an in-flight slot")
+GATEWAY_REJECTED = REGISTRY.counter("gateway_rejected_total",
+                                    "Gateway requests answered 503 because every in-flight slot stayed taken")
+
+
+class TimedCursor(sqlite3.Cursor):
+    slow = None          # slow-query occurrence of the last statement; fetches add their rows
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._observe(sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._observe(sql, None, time.perf_counter() - started, many=True)
+
+    def _observe(self, sql, parameters, seconds, many=False):
+        operation = _operation(sql)
+        DB_QUERY_SECONDS.observe(seconds, operation=operation)
+        self.slow = querylog.SLOW_QUERIES.observe(self, sql, parameters, seconds, many)
+        if self.slow is not None:
+            DB_SLOW_QUERIES.inc(operation=operation)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if self.slow is not None and row is not None:
+            self.slow["rows"] += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if self.slow is not None:
+            self.slow["rows"] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if self.slow is not None:
+            self.slow["rows"] += len(rows)
+        return rows
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # The C shortcuts create a plain cursor, so route them through a timed one
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+
+def _operation(sql):
+    word = sql.lstrip().split(None, 1)[0].lower() if sql.strip() else ""
+    return word if word in ("select", "insert", "update", "delete", "pragma", "begin", "create") else "other"
+
+
+def connect(database, **kwargs):
+    """sqlite3.connect() with connection, statement and commit timing"""
+    started = time.perf_counter()
+    conn = sqlite3.connect(database, factory=TimedConnection, **kwargs)
+    DB_CONNECT_SECONDS.observe(time.perf_counter() - started)
+    return conn
+
+
+LOCKS = []
+
+
+def _call_site(depth):
+    frame = sys._getframe(depth + 1)
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}:{frame.f_lineno}"
+
+
+class TimedLock:
+    """
+    threading.Lock that records wait and hold times under `name`, labelled
+    with the call site (file:function:line) that acquired it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquired_at = 0.0
+        self.site = None
+        # call site -> [acquisitions, contended, wait total, wait max, hold total, hold max]
+        self.sites = {}
+        LOCKS.append(self)
+
+    def acquire(self, blocking=True, timeout=-1):
+        site = _call_site(1)
+        started = time.perf_counter()
+        contended = not self.lock.acquire(False)
+        acquired = not contended or (blocking and self.lock.acquire(True, timeout))
+        now = time.perf_counter()
+        waited = now - started
+        LOCK_WAIT_SECONDS.observe(waited, lock=self.name, site=site)
+        if contended:
+            LOCK_CONTENDED.inc(lock=self.name, site=site)
+        if acquired:
+            self.acquired_at = now
+            self.site = site
+            # Updated while holding the lock, so no extra locking is needed
+            stats = self.sites.get(site)
+            if stats is None:
+                stats = self.sites[site] = [0, 0, 0.0, 0.0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += contended
+            stats[2] += waited
+            stats[3] = max(stats[3], waited)
+        return acquired
+
+    def release(self):
+        held = time.perf_counter() - self.acquired_at
+        LOCK_HELD_SECONDS.observe(held, lock=self.name, site=self.site)
+        stats = self.sites.get(self.site)
+        if stats is not None:
+            stats[4] += held
+            stats[5] = max(stats[5], held)
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    # An alias, not a wrapper, so the recorded call site is the `with` statement
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def report(self):
+        sites = []
+        for site, (count, contended, wait, wait_max, hold, hold_max) in list(self.sites.items()):
+            sites.append({"lock": self.name, "site": site, "acquisitions": count, "contended": contended,
+                          "contention_rate": round(contended / count, 3) if count else 0,
+                          "wait_total_ms": round(wait * 1000, 3), "wait_max_ms": round(wait_max * 1000, 3),
+                          "hold_total_ms": round(hold * 1000, 3), "hold_max_ms": round(hold_max * 1000, 3),
+                          "hold_avg_ms": round(hold * 1000 / count, 3) if count else 0})
+        return sites
+
+
+def lock_report(limit=20):
+    """Call sites of every TimedLock, most time spent waiting first"""
+    sites = [site for lock in LOCKS for site in lock.report()]
+    sites.sort(key=lambda site: (site["wait_total_ms"], site["contended"]), reverse=True)
+    return {"sites": sites[:limit],
+            "busy": {key[0]: value for key, value in sorted(DB_BUSY.values.items())},
+            "retries": [{"op": op, "outcome": outcome, "count": value}
+                        for (op, outcome), value in sorted(DB_RETRIES.values.items())]}
+
+
+def instrument(app, registry=REGISTRY, exchange=EXCHANGE):
+    """Per-route request metrics for a Flask app, plus the /metrics endpoint"""
+    from flask import request
+
+    @app.before_request
+    def _start_timer():
+        request.environ["metrics.started"] = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        started = request.environ.get("metrics.started")
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method)
+        return response
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        body = registry.render(exchange.others())
+        return body, 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+    return app
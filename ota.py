@@ -0,0 +1,412 @@
+"""
+Firmware storage for ESP32 OTA updates.
+
+Uploads are streamed straight from the multipart body into a temporary
+file inside the firmware folder, hashing and counting bytes as they
+arrive. An image that is too large or does not start with the ESP32
+magic byte is rejected while it is still being received. Accepted images
+are renamed into place atomically under a name that carries the start of
+their SHA-256, so two images uploaded under one name in the same second
+stay apart. An upload whose SHA-256 matches a stored image is not stored
+again, also when the same image arrives on two workers at once.
+
+FirmwareCatalog keeps name, size, hash, upload time, version and target
+board of every image so page renders and the device manifest never list
+the folder.
+"""
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import struct
+import tempfile
+import threading
+from datetime import datetime
+
+from werkzeug.formparser import FormDataParser
+from werkzeug.utils import secure_filename
+
+import applog
+
+# OTA Upload configuration
+UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "firmware")
+MAX_FIRMWARE_SIZE = int(os.environ.get("MAX_FIRMWARE_SIZE", 4 * 1024 * 1024))
+CHUNK_SIZE = 64 * 1024
+
+# First byte of every ESP32 application image (esp_image_header_t.magic)
+ESP_IMAGE_MAGIC = 0xE9
+# esp_app_desc_t follows the 24 byte image header and the 8 byte first segment header
+APP_DESC_OFFSET = 32
+APP_DESC_MAGIC = 0xABCD5432
+# esp_image_header_t.chip_id values
+CHIP_IDS = {0: "esp32", 2: "esp32s2", 5: "esp32c3", 9: "esp32s3", 12: "esp32c2", 13: "esp32c6", 16: "esp32h2"}
+
+CATALOG_FIELDS = ("filename", "size", "sha256", "uploaded_at", "version", "target_board")
+
+log = applog.get_logger("ota")
+
+
+class FirmwareRejected(Exception):
+    """Raised while streaming an upload that must not be stored"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class HashingUpload:
+    """
+    Write target handed to Werkzeug's multipart parser. Checks the magic
+    byte and the size limit as data arrives and hashes it on the way.
+    """
+
+    def __init__(self, folder, max_size=MAX_FIRMWARE_SIZE):
+        fd, self.path = tempfile.mkstemp(prefix=".upload-", suffix=".tmp", dir=folder)
+        self.file = os.fdopen(fd, "w+b")
+        self.max_size = max_size
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        if not self.size and data and data[0] != ESP_IMAGE_MAGIC:
+            raise FirmwareRejected("Not an ESP32 firmware image (bad magic byte)")
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise FirmwareRejected(f"Firmware larger than {self.max_size} bytes", 413)
+        self.sha256.update(data)
+        return self.file.write(data)
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        # seek/read/tell/close/flush are the temp file's own
+        return getattr(self.file, name)
+
+
+def receive_upload(environ_stream, mimetype, content_length, options, folder=UPLOAD_FOLDER,
+                   field="firmware", max_size=MAX_FIRMWARE_SIZE):
+    """
+    Parse a multipart body, streaming the `field` file into a HashingUpload.
+    Returns (original_filename, upload). The caller must store or discard
+    the upload.
+    """
+    if content_length is not None and content_length > max_size + CHUNK_SIZE:
+        raise FirmwareRejected(f"Firmware larger than {max_size} bytes", 413)
+
+    uploads = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        if filename and not filename.lower().endswith(".bin"):
+            raise FirmwareRejected("Only .bin files allowed")
+        upload = HashingUpload(folder, max_size)
+        uploads.append(upload)
+        return upload
+
+    parser = FormDataParser(stream_factory=stream_factory, max_content_length=max_size + CHUNK_SIZE,
+                            silent=False)
+    try:
+        _stream, _form, files = parser.parse(environ_stream, mimetype, content_length, options)
+    except Exception:
+        for upload in uploads:
+            upload.discard()
+        raise
+
+    storage = files.get(field)
+    for upload in uploads:
+        if storage is None or upload is not storage.stream:
+            upload.discard()
+    if storage is None or not storage.filename:
+        if storage is not None:
+            storage.stream.discard()
+        raise FirmwareRejected("No file provided")
+    if storage.stream.size == 0:
+        storage.stream.discard()
+        raise FirmwareRejected("Empty firmware file")
+    return storage.filename, storage.stream
+
+
+class BackgroundWorker:
+    """
+    One daemon thread working through a queue of items with `handler`.
+    The thread starts on demand and exits after a few idle seconds.
+    """
+
+    def __init__(self, name, handler, idle_timeout=5):
+        self.name = name
+        self.handler = handler
+        self.idle_timeout = idle_timeout
+        self.pending = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, item):
+        self.pending.put(item)
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._work, name=self.name, daemon=True)
+                self.thread.start()
+
+    def join(self):
+        """Wait until every queued item has been handled"""
+        self.pending.join()
+
+    def _work(self):
+        while True:
+            try:
+                item = self.pending.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                return
+            try:
+                self.handler(item)
+            except Exception as e:
+                applog.event(log, logging.ERROR, "background_job_failed", worker=self.name, item=item,
+                             error=f"{type(e).__name__}: {e}")
+            finally:
+                self.pending.task_done()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_image_info(path):
+    """
+    Read (version, target_board) from an ESP32 app image: the chip id sits
+    in the image header and the version string in esp_app_desc_t, which
+    follows the first segment header.
+    """
+    with open(path, "rb") as f:
+        head = f.read(APP_DESC_OFFSET + 48)
+    board = None
+    if len(head) >= 14 and head[0] == ESP_IMAGE_MAGIC:
+        chip_id = struct.unpack_from("<H", head, 12)[0]
+        board = CHIP_IDS.get(chip_id, f"chip-{chip_id}")
+    version = None
+    if len(head) >= APP_DESC_OFFSET + 48 and struct.unpack_from("<I", head, APP_DESC_OFFSET)[0] == APP_DESC_MAGIC:
+        version = head[APP_DESC_OFFSET + 16:APP_DESC_OFFSET + 48].split(b"\0", 1)[0].decode("ascii", "replace") or None
+    return version, board
+
+
+def format_size(size):
+    return f"{size / 1024:.1f} KB" if size < 1024*1024 else f"{size / (1024*1024):.1f} MB"
+
+
+class FirmwareCatalog:
+    """
+    Metadata for every stored image, kept in the `firmware` table and
+    mirrored in memory. Pages and the manifest read the in-memory copy;
+    the filesystem is only scanned once, when the catalog is first loaded.
+    With a shared `generation` (shared.py) a change made by another
+    worker process makes this one reload.
+    """
+
+    def __init__(self, db_path, folder=UPLOAD_FOLDER, generation=None):
+        self.db_path = db_path
+        self.folder = folder
+        self.generation = generation
+        self.seen = None
+        self.lock = threading.Lock()
+        self.entries = None
+        self.manifest = None
+        self.etag = None
+        # Called with each newly added entry (background artifact builders)
+        self.on_add = []
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10.0)
+        conn.execute('''CREATE TABLE IF NOT EXISTS firmware (
+            filename TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            uploaded_at TEXT NOT NULL,
+            version TEXT,
+            target_board TEXT
+        )''')
+        return conn
+
+    def _load(self):
+        """Read the table and reconcile it with the firmware folder. Caller holds the lock."""
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT filename, size, sha256, uploaded_at, version, target_board FROM firmware")
+            entries = {row[0]: dict(zip(CATALOG_FIELDS, row)) for row in rows}
+
+            on_disk = {name for name in os.listdir(self.folder) if name.endswith(".bin")}
+            for name in set(entries) - on_disk:
+                conn.execute("DELETE FROM firmware WHERE filename = ?", (name,))
+                del entries[name]
+            for name in sorted(on_disk - set(entries)):
+                path = os.path.join(self.folder, name)
+                stat = os.stat(path)
+                entry = self._describe(name, path, stat.st_size, file_sha256(path),
+                                       datetime.fromtimestamp(stat.st_mtime))
+                self._insert(conn, entry)
+                entries[name] = entry
+            conn.commit()
+        finally:
+            conn.close()
+        self.entries = entries
+        self._rebuild_manifest()
+
+    def _describe(self, name, path, size, sha256, uploaded_at):
+        version, board = parse_image_info(path)
+        return {"filename": name, "size": size, "sha256": sha256,
+                "uploaded_at": uploaded_at.isoformat(timespec="seconds"),
+                "version": version, "target_board": board}
+
+    @staticmethod
+    def _insert(conn, entry):
+        conn.execute("INSERT OR REPLACE INTO firmware (filename, size, sha256, uploaded_at, version, target_board) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", tuple(entry[field] for field in CATALOG_FIELDS))
+
+    def _rebuild_manifest(self):
+        files = [dict(entry, url=f"/firmware/{entry['filename']}")
+                 for entry in sorted(self.entries.values(), key=lambda e: (e["uploaded_at"], e["filename"]),
+                                     reverse=True)]
+        body = json.dumps({"firmware": files, "latest": files[0] if files else None},
+                          sort_keys=True, separators=(",", ":")).encode("utf-8")
+        self.manifest = body
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+
+    def _ensure_loaded(self):
+        stale = self.generation is not None and self.seen != self.generation.value
+        if self.entries is None or stale:
+            with self.lock:
+                seen = self.generation.value if self.generation is not None else None
+                if self.entries is None or seen != self.seen:
+                    self._load()
+                    self.seen = seen
+
+    def _changed(self):
+        """Tell the other processes; caller holds the lock"""
+        if self.generation is not None:
+            self.seen = self.generation.bump(self.seen)
+
+    def list(self):
+        """Entries, newest first"""
+        self._ensure_loaded()
+        return sorted(self.entries.values(), key=lambda e: (e["uploaded_at"], e["filename"]), reverse=True)
+
+    def get(self, filename):
+        self._ensure_loaded()
+        return self.entries.get(filename)
+
+    def find_sha256(self, sha256):
+        self._ensure_loaded()
+        for entry in self.entries.values():
+            if entry["sha256"] == sha256:
+                return entry
+        return None
+
+    def find_version(self, version):
+        """Newest entry carrying `version`"""
+        for entry in self.list():
+            if entry["version"] == version:
+                return entry
+        return None
+
+    def manifest_json(self):
+        """(body bytes, etag) of the JSON manifest, rebuilt only when the catalog changes"""
+        self._ensure_loaded()
+        return self.manifest, self.etag
+
+    def add(self, filename, size, sha256, version=None):
+        """Record a file that was just written into the firmware folder"""
+        self._ensure_loaded()
+        entry = self._describe(filename, os.path.join(self.folder, filename), size, sha256, datetime.now())
+        if version:
+            entry["version"] = version
+        with self.lock:
+            conn = self._connect()
+            try:
+                self._insert(conn, entry)
+                conn.commit()
+            finally:
+                conn.close()
+            self.entries[filename] = entry
+            self._rebuild_manifest()
+            self._changed()
+        for callback in self.on_add:
+            callback(entry)
+        return entry
+
+    def add_upload(self, filename, path, size, sha256, version=None):
+        """
+        Move the received file at `path` into the folder as `filename` and
+        record it, in one transaction with the check that no process has
+        stored an image with this sha256 yet. Returns (entry, duplicate);
+        on a duplicate the file is left at `path`.
+        """
+        self._ensure_loaded()
+        entry = self._describe(filename, path, size, sha256, datetime.now())
+        if version:
+            entry["version"] = version
+        with self.lock:
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute(f"SELECT {', '.join(CATALOG_FIELDS)} FROM firmware WHERE sha256 = ?",
+                                   (sha256,)).fetchone()
+                if row is None:
+                    os.replace(path, os.path.join(self.folder, filename))
+                    self._insert(conn, entry)
+                conn.commit()
+            finally:
+                conn.close()
+            if row is not None:
+                existing = dict(zip(CATALOG_FIELDS, row))
+                self.entries.setdefault(existing["filename"], existing)
+                return existing, True
+            self.entries[filename] = entry
+            self._rebuild_manifest()
+            self._changed()
+        for callback in self.on_add:
+            callback(entry)
+        return entry, False
+
+    def remove(self, filename):
+        """Forget a deleted file"""
+        self._ensure_loaded()
+        with self.lock:
+            conn = self._connect()
+            try:
+                conn.execute("DELETE FROM firmware WHERE filename = ?", (filename,))
+                conn.commit()
+            finally:
+                conn.close()
+            self.entries.pop(filename, None)
+            self._rebuild_manifest()
+            self._changed()
+
+
+def store_upload(original_filename, upload, catalog, version=None):
+    """
+    Move a received upload into the firmware folder and record it.
+    `version` overrides the one read from the image. Returns (catalog entry, duplicate).
+    """
+    digest = upload.sha256.hexdigest()
+    existing = catalog.find_sha256(digest)
+    if existing:
+        upload.discard()
+        return existing, True
+
+    base_name = secure_filename(original_filename).rsplit('.', 1)[0] or "firmware"
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"{base_name}_{timestamp}_{digest[:8]}.bin"
+
+    upload.file.flush()
+    os.fsync(upload.file.fileno())
+    upload.file.close()
+    entry, duplicate = catalog.add_upload(filename, upload.path, upload.size, digest, version)
+    if duplicate:
+        upload.discard()
+    return entry, duplicate
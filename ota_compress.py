@@ -0,0 +1,101 @@
+"""
+Precompressed firmware artifacts.
+
+Each stored image is gzip-compressed once, on a background worker, into
+firmware/compressed/<name>.bin.gz. download_firmware() sends that file
+with Content-Encoding: gzip to clients whose Accept-Encoding includes
+gzip; everyone else gets the raw image. The archive is written with a
+zero mtime, so the same image always gives the same bytes.
+"""
+import gzip
+import logging
+import os
+import shutil
+
+import applog
+import ota
+
+# Compression configuration
+COMPRESS_ENABLED = os.environ.get("FIRMWARE_GZIP", "1") == "1"
+COMPRESS_LEVEL = int(os.environ.get("FIRMWARE_GZIP_LEVEL", 9))
+# Keep the artifact only if it saves at least this share of the image
+COMPRESS_MIN_SAVING = float(os.environ.get("FIRMWARE_GZIP_MIN_SAVING", 0.05))
+
+log = applog.get_logger("compress")
+
+
+def gzip_file(src, dest, level=COMPRESS_LEVEL):
+    """Compress src into dest atomically; returns the compressed size"""
+    tmp_path = dest + ".tmp"
+    with open(src, "rb") as raw, open(tmp_path, "wb") as out:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=out, compresslevel=level, mtime=0) as gz:
+            shutil.copyfileobj(raw, gz, ota.CHUNK_SIZE)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, dest)
+    return os.path.getsize(dest)
+
+
+class CompressedArtifacts:
+    """gzip copies of catalog images, built by a background worker"""
+
+    def __init__(self, catalog, folder=None, enabled=COMPRESS_ENABLED, min_saving=COMPRESS_MIN_SAVING):
+        self.catalog = catalog
+        self.folder = folder or os.path.join(catalog.folder, "compressed")
+        self.enabled = enabled
+        self.min_saving = min_saving
+        self.worker = ota.BackgroundWorker("firmware-gzip", self._compress)
+
+    def path(self, filename):
+        return os.path.join(self.folder, filename + ".gz")
+
+    def schedule(self, entry):
+        """Queue compression of a newly stored image"""
+        if self.enabled:
+            self.worker.put(entry["filename"])
+
+    def backfill(self):
+        """Queue every catalog image that has no artifact yet (after a restart or upgrade)"""
+        for entry in self.catalog.list():
+            if not os.path.exists(self.path(entry["filename"])):
+                self.schedule(entry)
+
+    def _compress(self, filename):
+        entry = self.catalog.get(filename)
+        if entry is None or os.path.exists(self.path(filename)):
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        size = gzip_file(os.path.join(self.catalog.folder, filename), self.path(filename))
+        if size > entry["size"] * (1 - self.min_saving):
+            # Not worth a second representation; leave an empty marker so backfill skips it
+            open(self.path(filename), "wb").close()
+            applog.event(log, logging.INFO, "firmware_not_compressible", filename=filename, size=size,
+                         full_size=entry["size"])
+            return
+        applog.event(log, logging.INFO, "firmware_compressed", filename=filename, size=size, full_size=entry["size"])
+
+    def get(self, filename):
+        """(artifact filename, size) of a usable gzip artifact, or None"""
+        if not self.enabled:
+            return None
+        try:
+            size = os.path.getsize(self.path(filename))
+        except OSError:
+            return None
+        return (filename + ".gz", size) if size else None
+
+    def forget(self, filename):
+        """Remove the artifact of a deleted image; returns the bytes freed"""
+        try:
+            freed = os.path.getsize(self.path(filename))
+            os.remove(self.path(filename))
+        except OSError:
+            return 0
+        return freed
+
+    def orphans(self):
+        """Artifacts whose image is no longer in the catalog"""
+        if not os.path.isdir(self.folder):
+            return []
+        return [os.path.join(self.folder, name) for name in os.listdir(self.folder)
+                if name.endswith(".bin.gz") and self.catalog.get(name[:-len(".gz")]) is None]
@@ -0,0 +1,216 @@
+"""
+Binary delta (patch) updates between firmware images.
+
+When an image is stored, patches from the previous DELTA_SOURCES images
+for the same board are generated in the background with bsdiff and
+cached in firmware/deltas/. A device that reports the SHA-256 (or
+version) of the image it runs gets the patch instead of the full image;
+without a cached patch, or when the patch would not save enough, it
+downloads the full image as before.
+
+Patches are standard BSDIFF40 files, so the device applies them with any
+bsdiff patcher and checks the result against the target's SHA-256.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+try:
+    import bsdiff4
+except ImportError:  # deltas are optional; devices fall back to full images
+    bsdiff4 = None
+
+import applog
+import ota
+
+# Delta configuration
+DELTA_ENABLED = os.environ.get("FIRMWARE_DELTAS", "1") == "1" and bsdiff4 is not None
+DELTA_SOURCES = int(os.environ.get("DELTA_SOURCES", 3))
+# A patch is only served when it is at most this share of the full image
+DELTA_MAX_RATIO = float(os.environ.get("DELTA_MAX_RATIO", 0.7))
+
+DELTA_FIELDS = ("from_sha256", "to_sha256", "to_filename", "filename", "size", "full_size",
+                "sha256", "generation_ms", "created_at")
+
+log = applog.get_logger("delta")
+
+
+def make_patch(old_path, new_path, patch_path):
+    """Write a BSDIFF40 patch turning old into new; returns (size, sha256, milliseconds)"""
+    started = time.perf_counter()
+    with open(old_path, "rb") as f:
+        old = f.read()
+    with open(new_path, "rb") as f:
+        new = f.read()
+    patch = bsdiff4.diff(old, new)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    tmp_path = patch_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(patch)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, patch_path)
+    return len(patch), hashlib.sha256(patch).hexdigest(), elapsed_ms
+
+
+class DeltaStore:
+    """
+    Cached patches, recorded in the `firmware_delta` table. Generation
+    runs on a background worker fed by schedule().
+    """
+
+    def __init__(self, catalog, folder=None, enabled=DELTA_ENABLED, sources=DELTA_SOURCES,
+                 max_ratio=DELTA_MAX_RATIO):
+        self.catalog = catalog
+        self.folder = folder or os.path.join(catalog.folder, "deltas")
+        self.enabled = enabled
+        self.sources = sources
+        self.max_ratio = max_ratio
+        self.worker = ota.BackgroundWorker("firmware-deltas", self._generate)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.catalog.db_path, timeout=10.0)
+        conn.execute('''CREATE TABLE IF NOT EXISTS firmware_delta (
+            from_sha256 TEXT NOT NULL,
+            to_sha256 TEXT NOT NULL,
+            to_filename TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            full_size INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            generation_ms REAL NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (from_sha256, to_sha256)
+        )''')
+        return conn
+
+    def sources_for(self, entry):
+        """The images uploaded before `entry` for the same board, newest first"""
+        older = [e for e in self.catalog.list()
+                 if e["sha256"] != entry["sha256"]
+                 and (e["uploaded_at"], e["filename"]) < (entry["uploaded_at"], entry["filename"])
+                 and e["target_board"] == entry["target_board"]]
+        return older[:self.sources]
+
+    def build(self, from_entry, to_entry):
+        """Generate (or regenerate) one patch and record it; returns its row"""
+        os.makedirs(self.folder, exist_ok=True)
+        filename = f"{from_entry['sha256'][:16]}_{to_entry['sha256'][:16]}.bsdiff"
+        size, sha256, generation_ms = make_patch(os.path.join(self.catalog.folder, from_entry["filename"]),
+                                                 os.path.join(self.catalog.folder, to_entry["filename"]),
+                                                 os.path.join(self.folder, filename))
+        row = dict(zip(DELTA_FIELDS, (from_entry["sha256"], to_entry["sha256"], to_entry["filename"],
+                                      filename, size, to_entry["size"], sha256, round(generation_ms, 1),
+                                      datetime.now().isoformat(timespec="seconds"))))
+        conn = self._connect()
+        try:
+            conn.execute(f"INSERT OR REPLACE INTO firmware_delta ({', '.join(DELTA_FIELDS)}) "
+                         f"VALUES ({', '.join('?' * len(DELTA_FIELDS))})", tuple(row[f] for f in DELTA_FIELDS))
+            conn.commit()
+        finally:
+            conn.close()
+        return row
+
+    def build_for(self, entry):
+        """Patches into `entry` from its predecessors that are not cached yet"""
+        built = []
+        for source in self.sources_for(entry):
+            if self.get(source["sha256"], entry["sha256"]) is None:
+                row = self.build(source, entry)
+                applog.event(log, logging.INFO, "delta_built", source=source["filename"], target=entry["filename"],
+                             size=row["size"], full_size=row["full_size"], generation_ms=row["generation_ms"])
+                built.append(row)
+        return built
+
+    def schedule(self, entry, from_sha256=None):
+        """Queue patch generation into a newly stored image (or from one given source)"""
+        if not self.enabled:
+            return
+        self.worker.put((entry["filename"], from_sha256))
+
+    def _generate(self, item):
+        filename, from_sha256 = item
+        entry = self.catalog.get(filename)
+        source = self.catalog.find_sha256(from_sha256) if from_sha256 else None
+        if entry and source:
+            if self.get(source["sha256"], entry["sha256"]) is None:
+                self.build(source, entry)
+        elif entry:
+            self.build_for(entry)
+
+    def get(self, from_sha256, to_sha256):
+        conn = self._connect()
+        try:
+            row = conn.execute(f"SELECT {', '.join(DELTA_FIELDS)} FROM firmware_delta "
+                               "WHERE from_sha256 = ? AND to_sha256 = ?", (from_sha256, to_sha256)).fetchone()
+        finally:
+            conn.close()
+        if row is None or not os.path.exists(os.path.join(self.folder, row[3])):
+            return None
+        return dict(zip(DELTA_FIELDS, row))
+
+    def find(self, current_sha256, target):
+        """
+        The patch a device running `current_sha256` should fetch to reach
+        the `target` catalog entry, or None for a full download.
+        """
+        if not self.enabled or not current_sha256 or current_sha256 == target["sha256"]:
+            return None
+        row = self.get(current_sha256, target["sha256"])
+        if row is None:
+            # Known source image without a patch yet: generate it for the next check-in
+            if self.catalog.find_sha256(current_sha256):
+                self.schedule(target, current_sha256)
+            return None
+        if row["size"] > row["full_size"] * self.max_ratio:
+            return None
+        return row
+
+    def forget(self, sha256):
+        """Drop every patch from or to an image that was deleted; returns the bytes freed"""
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT filename FROM firmware_delta WHERE from_sha256 = ? OR to_sha256 = ?",
+                                (sha256, sha256)).fetchall()
+            conn.execute("DELETE FROM firmware_delta WHERE from_sha256 = ? OR to_sha256 = ?", (sha256, sha256))
+            conn.commit()
+        finally:
+            conn.close()
+        freed = 0
+        for (filename,) in rows:
+            path = os.path.join(self.folder, filename)
+            if os.path.exists(path):
+                freed += os.path.getsize(path)
+                os.remove(path)
+        return freed
+
+    def orphans(self):
+        """Patch files in the folder that no table row refers to"""
+        if not os.path.isdir(self.folder):
+            return []
+        conn = self._connect()
+        try:
+            known = {name for (name,) in conn.execute("SELECT filename FROM firmware_delta")}
+        finally:
+            conn.close()
+        return [os.path.join(self.folder, name) for name in os.listdir(self.folder)
+                if name.endswith(".bsdiff") and name not in known]
+
+    def report(self):
+        """Every cached patch with its savings, newest first"""
+        conn = self._connect()
+        try:
+            rows = conn.execute(f"SELECT {', '.join(DELTA_FIELDS)} FROM firmware_delta "
+                                "ORDER BY created_at DESC").fetchall()
+        finally:
+            conn.close()
+        report = []
+        for row in rows:
+            row = dict(zip(DELTA_FIELDS, row))
+            row["ratio"] = round(row["size"] / row["full_size"], 3) if row["full_size"] else None
+            report.append(row)
+        return report
@@ -0,0 +1,209 @@
+"""
+Local mirror of the firmware releases published on GitHub.
+
+Instead of every ESP32 asking api.github.com for the latest release and
+downloading the asset itself, the server checks the release once
+(conditionally, with the ETag GitHub returned last time), downloads new
+.bin assets once into the firmware catalog and answers devices from the
+LAN through /firmware/latest. Assets that are not app images (e.g.
+partitions.bin or bootloader.bin next to the app) are logged and skipped.
+
+GITHUB_API can point at any stand-in server that speaks the same two
+endpoints:
+
+    GET {api}/repos/{owner}/{repo}/releases/latest
+    GET {api}/repos/{owner}/{repo}/releases/assets/{id}   (Accept: application/octet-stream)
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import urllib.error
+import urllib.request
+from datetime import datetime
+from urllib.parse import urlparse
+
+import applog
+import ota
+
+# Mirror configuration
+GITHUB_MIRROR_ENABLED = os.environ.get("GITHUB_MIRROR", "0") == "1"
+GITHUB_API = os.environ.get("GITHUB_API", "https://api.github.com").rstrip("/")
+GITHUB_OWNER = os.environ.get("GITHUB_OWNER", "Fase2507")
+GITHUB_REPO = os.environ.get("GITHUB_REPO", "ESP32-projects-OTA-for-firmwares")
+GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN", "")
+MIRROR_SCHEDULE = os.environ.get("MIRROR_SCHEDULE", "*/15 * * * *")
+MIRROR_TIMEOUT = 30
+
+log = applog.get_logger("mirror")
+
+
+class _DropAuthOnRedirect(urllib.request.HTTPRedirectHandler):
+    """Asset downloads redirect to a signed storage URL that rejects a second credential"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if new is not None and urlparse(newurl).netloc != urlparse(req.full_url).netloc:
+            new.remove_header("Authorization")
+        return new
+
+
+class ReleaseMirror:
+    def __init__(self, catalog, api=GITHUB_API, owner=GITHUB_OWNER, repo=GITHUB_REPO, token=GITHUB_TOKEN):
+        self.catalog = catalog
+        self.api = api.rstrip("/")
+        self.owner = owner
+        self.repo = repo
+        self.token = token
+        self.opener = urllib.request.build_opener(_DropAuthOnRedirect)
+        self.lock = threading.Lock()
+        self.etag = None
+        self.rejected = {}       # asset id -> why the catalog refused it
+        self.release = None
+        self.checked_at = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.catalog.db_path, timeout=10.0)
+        conn.execute('''CREATE TABLE IF NOT EXISTS release_mirror (
+            asset_id INTEGER PRIMARY KEY,
+            tag TEXT NOT NULL,
+            asset_name TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            fetched_at TEXT NOT NULL
+        )''')
+        return conn
+
+    def _request(self, url, accept, etag=None):
+        req = urllib.request.Request(url, headers={"Accept": accept, "User-Agent": "laundry-ota-mirror"})
+        if self.token:
+            req.add_header("Authorization", f"token {self.token}")
+        if etag:
+            req.add_header("If-None-Match", etag)
+        return self.opener.open(req, timeout=MIRROR_TIMEOUT)
+
+    def mirrored_assets(self):
+        """asset_id -> (tag, asset_name, filename) for everything downloaded so far"""
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT asset_id, tag, asset_name, filename FROM release_mirror").fetchall()
+        finally:
+            conn.close()
+        return {row[0]: row[1:] for row in rows}
+
+    def sync(self):
+        """
+        Check the latest release and mirror any .bin asset not seen before.
+        Returns a dict describing what happened (for the maintenance log).
+        """
+        with self.lock:
+            url = f"{self.api}/repos/{self.owner}/{self.repo}/releases/latest"
+            self.checked_at = datetime.now().isoformat(timespec="seconds")
+            try:
+                response = self._request(url, "application/vnd.github+json", self.etag)
+            except urllib.error.HTTPError as e:
+                if e.code == 304:
+                    return {"release": self.release["tag"] if self.release else None, "changed": False}
+                raise
+            with response:
+                data = json.load(response)
+                etag = response.headers.get("ETag")
+
+            tag = data.get("tag_name")
+            if not tag:
+                raise ValueError("Release has no tag_name")
+
+            known = self.mirrored_assets()
+            assets, skipped, fetched = [], [], 0
+            for asset in data.get("assets", []):
+                name = asset.get("name", "")
+                if not name.endswith(".bin"):
+                    continue
+                if asset["id"] in self.rejected:
+                    skipped.append(name)
+                    continue
+                if asset["id"] in known and self.catalog.get(known[asset["id"]][2]):
+                    filename = known[asset["id"]][2]
+                else:
+                    try:
+                        filename = self._fetch_asset(asset, tag)
+                    except ota.FirmwareRejected as e:
+                        self.rejected[asset["id"]] = str(e)
+                        skipped.append(name)
+                        applog.event(log, logging.WARNING, "mirror_asset_skipped", asset=name, tag=tag,
+                                     reason=str(e))
+                        continue
+                    fetched += 1
+                assets.append({"name": name, "filename": filename})
+
+            self.release = {"tag": tag, "assets": assets}
+            # Only trust the ETag once every asset is stored or refused
+            self.etag = etag
+            return {"release": tag, "changed": True, "assets": len(assets), "fetched": fetched,
+                    "skipped": skipped}
+
+    def _fetch_asset(self, asset, tag):
+        """Stream one asset into the catalog; returns the stored filename"""
+        url = f"{self.api}/repos/{self.owner}/{self.repo}/releases/assets/{asset['id']}"
+        upload = ota.HashingUpload(self.catalog.folder)
+        try:
+            with self._request(url, "application/octet-stream") as response:
+                for chunk in iter(lambda: response.read(ota.CHUNK_SIZE), b""):
+                    upload.write(chunk)
+            if asset.get("size") and upload.size != asset["size"]:
+                raise ValueError(f"{asset['name']}: got {upload.size} of {asset['size']} bytes")
+        except Exception:
+            upload.discard()
+            raise
+
+        base_name = asset["name"][:-len(".bin")]
+        entry, _duplicate = ota.store_upload(f"{base_name}_{tag}.bin", upload, self.catalog, version=tag)
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO release_mirror (asset_id, tag, asset_name, filename, fetched_at) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         (asset["id"], tag, asset["name"], entry["filename"],
+                          datetime.now().isoformat(timespec="seconds")))
+            conn.commit()
+        finally:
+            conn.close()
+        applog.event(log, logging.INFO, "mirror_asset_stored", asset=asset["name"], tag=tag,
+                     filename=entry["filename"])
+        return entry["filename"]
+
+    def current_release(self):
+        """{tag, assets} of the newest mirrored release, also after a restart"""
+        if self.release is not None:
+            return self.release
+        known = sorted(self.mirrored_assets().items(), reverse=True)
+        if not known:
+            return None
+        tag = known[0][1][0]
+        return {"tag": tag, "assets": [{"name": name, "filename": filename}
+                                       for _id, (t, name, filename) in known if t == tag]}
+
+    def latest(self, asset_name=None):
+        """
+        What a device should run: the mirrored release asset named
+        `asset_name` (or its first .bin), else the newest uploaded image.
+        Returns a small dict or None.
+        """
+        entry, version = None, None
+        release = self.current_release()
+        if release:
+            for asset in release["assets"]:
+                if asset_name in (None, asset["name"]):
+                    entry, version = self.catalog.get(asset["filename"]), release["tag"]
+                    break
+        if entry is None and asset_name is None:
+            files = self.catalog.list()
+            entry = files[0] if files else None
+            version = entry["version"] if entry else None
+        if entry is None:
+            return None
+        return {"version": version, "filename": entry["filename"], "url": f"/firmware/{entry['filename']}",
+                "size": entry["size"], "sha256": entry["sha256"]}
+
+    def status(self):
+        return {"api": self.api, "repo": f"{self.owner}/{self.repo}", "checked_at": self.checked_at,
+                "release": self.release}
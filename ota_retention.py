@@ -0,0 +1,94 @@
+"""
+Firmware retention and storage garbage collection.
+
+Keeps the newest FIRMWARE_KEEP images per target board, plus every image
+a device still depends on (rollout targets and bases, the image each
+device last moved to, the current mirrored release). Everything else is
+deleted together with its cached patches and gzip artifact. Patches and
+artifacts left without an image, and upload temp files abandoned by a
+crash, are swept as well.
+"""
+import logging
+import os
+import time
+
+import applog
+
+# Retention configuration
+FIRMWARE_KEEP = int(os.environ.get("FIRMWARE_KEEP", 3))
+FIRMWARE_GC_SCHEDULE = os.environ.get("FIRMWARE_GC_SCHEDULE", "15 4 * * *")
+# Upload temp files older than this are leftovers of an interrupted upload
+STALE_UPLOAD_SECONDS = 3600
+
+log = applog.get_logger("firmware_gc")
+
+
+class FirmwareRetention:
+    def __init__(self, catalog, deltas, artifacts, rollouts, mirror=None, keep=FIRMWARE_KEEP):
+        self.catalog = catalog
+        self.deltas = deltas
+        self.artifacts = artifacts
+        self.rollouts = rollouts
+        self.mirror = mirror
+        self.keep = keep
+
+    def remove(self, filename):
+        """Delete one image and everything derived from it; returns the bytes freed"""
+        entry = self.catalog.get(filename)
+        path = os.path.join(self.catalog.folder, filename)
+        freed = 0
+        if os.path.exists(path):
+            freed += os.path.getsize(path)
+            os.remove(path)
+        self.catalog.remove(filename)
+        freed += self.artifacts.forget(filename)
+        if entry:
+            freed += self.deltas.forget(entry["sha256"])
+        self.rollouts.forget(filename)
+        return freed
+
+    def protected(self):
+        """Filenames that must survive regardless of age"""
+        keep = set(self.rollouts.images_in_use())
+        release = self.mirror.current_release() if self.mirror else None
+        if release:
+            keep.update(asset["filename"] for asset in release["assets"])
+        return keep
+
+    def candidates(self):
+        """Catalog entries the policy would delete"""
+        protected = self.protected()
+        per_board = {}
+        for entry in self.catalog.list():
+            per_board.setdefault(entry["target_board"], []).append(entry)
+        expired = []
+        for entries in per_board.values():
+            expired.extend(e for e in entries[self.keep:] if e["filename"] not in protected)
+        return expired
+
+    def run(self, dry_run=False):
+        """Apply the policy; returns what was (or would be) removed and the bytes reclaimed"""
+        expired = self.candidates()
+        stale = self.deltas.orphans() + self.artifacts.orphans()
+        cutoff = time.time() - STALE_UPLOAD_SECONDS
+        stale += [os.path.join(self.catalog.folder, name) for name in os.listdir(self.catalog.folder)
+                  if name.startswith(".upload-") and os.path.getmtime(os.path.join(self.catalog.folder, name)) < cutoff]
+
+        if dry_run:
+            reclaimable = sum(e["size"] for e in expired) + sum(os.path.getsize(p) for p in stale)
+            return {"dry_run": True, "removed": [e["filename"] for e in expired],
+                    "stale_files": len(stale), "bytes_reclaimed": reclaimable}
+
+        reclaimed = 0
+        for entry in expired:
+            reclaimed += self.remove(entry["filename"])
+            applog.event(log, logging.INFO, "firmware_expired", filename=entry["filename"], size=entry["size"])
+        for path in stale:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                reclaimed += size
+            except OSError:
+                pass
+        return {"removed": [e["filename"] for e in expired], "stale_files": len(stale),
+                "bytes_reclaimed": reclaimed}
@@ -0,0 +1,395 @@
+"""
+Staged OTA rollouts.
+
+A rollout moves devices from a base image to a target image in
+percentage waves (ROLLOUT_WAVES, e.g. 5,25,50,100). Each device falls in
+a fixed bucket 0-99 derived from its id, so it stays in or out of a wave
+across check-ins. /firmware/latest answers devices outside the current
+wave with the base image, and every assignment is recorded in the
+`rollout_device` table.
+
+Only devices inside the current wave may download the target, and at
+most max_concurrent of them at the same time over all worker processes
+(shared.DOWNLOADS, shared.LEASE_COUNT slots for all rollouts together);
+the rest get 503 with a Retry-After spread over a few seconds per
+device. Devices report the result of their update; too many failures in
+the current wave pause the rollout until an operator resumes it, which
+starts the wave over. The maintenance scheduler calls advance() to move
+healthy rollouts to their next wave; once a last wave of 100% has run
+its course the rollout completes and the target is served like any
+other image. A rollout whose last wave is below 100% stays there.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import shared
+
+# Rollout configuration
+ROLLOUT_AUTO = os.environ.get("ROLLOUT_AUTO", "0") == "1"
+ROLLOUT_WAVES = os.environ.get("ROLLOUT_WAVES", "5,25,50,100")
+ROLLOUT_WAVE_MINUTES = float(os.environ.get("ROLLOUT_WAVE_MINUTES", 30))
+ROLLOUT_MAX_CONCURRENT = int(os.environ.get("ROLLOUT_MAX_CONCURRENT", 4))
+ROLLOUT_RETRY_AFTER = int(os.environ.get("ROLLOUT_RETRY_AFTER", 30))
+# Pause when this many devices failed, or this share of at least ROLLOUT_MIN_REPORTS reports,
+# counting the reports since the wave started or the rollout was last resumed
+ROLLOUT_MAX_FAILURES = int(os.environ.get("ROLLOUT_MAX_FAILURES", 5))
+ROLLOUT_MAX_FAILURE_RATE = float(os.environ.get("ROLLOUT_MAX_FAILURE_RATE", 0.2))
+ROLLOUT_MIN_REPORTS = int(os.environ.get("ROLLOUT_MIN_REPORTS", 3))
+# A download slot is reclaimed if its response never closes or its worker exits
+ROLLOUT_SLOT_TIMEOUT = float(os.environ.get("ROLLOUT_SLOT_TIMEOUT", 600))
+
+ROLLOUT_FIELDS = ("id", "target", "target_sha256", "base", "waves", "wave", "percent", "max_concurrent",
+                  "state", "reason", "created_at", "wave_started_at")
+DEVICE_STATES = ("assigned", "downloading", "succeeded", "failed")
+
+
+def device_bucket(rollout_id, device_id):
+    """Stable 0-99 bucket of a device within one rollout"""
+    digest = hashlib.sha256(f"{rollout_id}:{device_id}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") % 100
+
+
+class RolloutBusy(Exception):
+    """The download budget is used up or the rollout is paused; retry later"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RolloutController:
+    def __init__(self, catalog, max_concurrent=ROLLOUT_MAX_CONCURRENT, waves=ROLLOUT_WAVES,
+                 wave_minutes=ROLLOUT_WAVE_MINUTES, retry_after=ROLLOUT_RETRY_AFTER, generation=None,
+                 leases=None):
+        self.catalog = catalog
+        # Shared counter (shared.py): reload when another worker process changed a rollout
+        self.generation = generation
+        # Download slots; shared.DOWNLOADS caps them across worker processes
+        self.leases = leases if leases is not None else shared.Leases()
+        self.seen = None
+        self.max_concurrent = max_concurrent
+        self.waves = waves
+        self.wave_minutes = wave_minutes
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.rollouts = None     # target filename -> rollout dict (active and paused only)
+        self.assigned = {}       # rollout id -> device ids already recorded
+
+    def _connect(self):
+        conn = sqlite3.connect(self.catalog.db_path, timeout=10.0)
+        conn.execute('''CREATE TABLE IF NOT EXISTS rollout (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            target TEXT NOT NULL,
+            target_sha256 TEXT NOT NULL,
+            base TEXT,
+            waves TEXT NOT NULL,
+            wave INTEGER NOT NULL DEFAULT 0,
+            percent INTEGER NOT NULL,
+            max_concurrent INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            reason TEXT,
+            created_at TEXT NOT NULL,
+            wave_started_at TEXT NOT NULL
+        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS rollout_device (
+            rollout_id INTEGER NOT NULL,
+            device_id TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            detail TEXT,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (rollout_id, device_id)
+        )''')
+        return conn
+
+    def _ensure_loaded(self):
+        stale = self.generation is not None and self.seen != self.generation.value
+        if self.rollouts is None or stale:
+            with self.lock:
+                seen = self.generation.value if self.generation is not None else None
+                if self.rollouts is None or seen != self.seen:
+                    conn = self._connect()
+                    try:
+                        rows = conn.execute(f"SELECT {', '.join(ROLLOUT_FIELDS)} FROM rollout "
+                                            "WHERE state IN ('active', 'paused')").fetchall()
+                        rollouts, assigned = {}, {}
+                        for row in rows:
+                            rollout = dict(zip(ROLLOUT_FIELDS, row))
+                            rollouts[rollout["target"]] = rollout
+                            assigned[rollout["id"]] = {device for (device,) in conn.execute(
+                                "SELECT device_id FROM rollout_device WHERE rollout_id = ?", (rollout["id"],))}
+                    finally:
+                        conn.close()
+                    self.rollouts = rollouts
+                    self.assigned = assigned
+                    self.seen = seen
+
+    def _changed(self):
+        """Tell the other processes after a commit; caller holds the lock"""
+        if self.generation is not None:
+            self.seen = self.generation.bump(self.seen)
+
+    def _save(self, conn, rollout):
+        conn.execute("UPDATE rollout SET wave = ?, percent = ?, state = ?, reason = ?, wave_started_at = ? "
+                     "WHERE id = ?", (rollout["wave"], rollout["percent"], rollout["state"], rollout["reason"],
+                                      rollout["wave_started_at"], rollout["id"]))
+
+    def start(self, target, waves=None, max_concurrent=None):
+        """
+        Begin rolling out the catalog image `target`. The base is the
+        newest older image for the same board. Earlier rollouts for that
+        board are superseded.
+        """
+        self._ensure_loaded()
+        entry = self.catalog.get(target)
+        if entry is None:
+            raise ValueError(f"Unknown firmware: {target}")
+        wave_list = [int(p) for p in str(waves or self.waves).split(",")]
+        if not wave_list or wave_list != sorted(wave_list) or not 0 < wave_list[-1] <= 100:
+            raise ValueError("Waves must be increasing percentages ending at most at 100")
+        base = next((e["filename"] for e in self.catalog.list()
+                     if e["target_board"] == entry["target_board"] and e["filename"] != target
+                     and (e["uploaded_at"], e["filename"]) < (entry["uploaded_at"], entry["filename"])), None)
+        now = datetime.now().isoformat(timespec="seconds")
+
+        with self.lock:
+            conn = self._connect()
+            try:
+                for old in list(self.rollouts.values()):
+                    old_entry = self.catalog.get(old["target"])
+                    if old_entry is None or old_entry["target_board"] == entry["target_board"]:
+                        old.update(state="superseded", reason=f"superseded by {target}")
+                        self._save(conn, old)
+                        del self.rollouts[old["target"]]
+                cur = conn.execute("INSERT INTO rollout (target, target_sha256, base, waves, wave, percent, "
+                                   "max_concurrent, state, created_at, wave_started_at) "
+                                   "VALUES (?, ?, ?, ?, 0, ?, ?, 'active', ?, ?)",
+                                   (target, entry["sha256"], base, ",".join(map(str, wave_list)), wave_list[0],
+                                    max_concurrent or self.max_concurrent, now, now))
+                conn.commit()
+                rollout = dict(zip(ROLLOUT_FIELDS, (cur.lastrowid, target, entry["sha256"], base,
+                                                    ",".join(map(str, wave_list)), 0, wave_list[0],
+                                                    max_concurrent or self.max_concurrent, "active", None,
+                                                    now, now)))
+            finally:
+                conn.close()
+            self.rollouts[target] = rollout
+            self.assigned[rollout["id"]] = set()
+            self._changed()
+        print(f"✓ Rollout {rollout['id']}: {target} to {wave_list[0]}% (base {base})")
+        return rollout
+
+    def get(self, rollout_id):
+        self._ensure_loaded()
+        for rollout in self.rollouts.values():
+            if rollout["id"] == rollout_id:
+                return rollout
+        return None
+
+    def _record(self, rollout, device_id, state, detail=None, force=False):
+        """Insert or move a device's assignment. Caller holds the lock."""
+        assigned = self.assigned.setdefault(rollout["id"], set())
+        if not force and device_id in assigned:
+            return
+        conn = self._connect()
+        try:
+            # Unforced, another worker process may have recorded a later state already
+            conn.execute("INSERT INTO rollout_device (rollout_id, device_id, bucket, state, detail, updated_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (rollout_id, device_id) DO " +
+                         ("UPDATE SET state = excluded.state, detail = excluded.detail, "
+                          "updated_at = excluded.updated_at" if force else "NOTHING"),
+                         (rollout["id"], device_id, device_bucket(rollout["id"], device_id), state, detail,
+                          datetime.now().isoformat(timespec="seconds")))
+            conn.commit()
+        finally:
+            conn.close()
+        assigned.add(device_id)
+
+    def resolve(self, filename, device_id):
+        """
+        Which image a device should be offered when `filename` is the
+        newest: the target if the device is inside the current wave of an
+        active rollout, otherwise the rollout's base (None if there is none).
+        """
+        self._ensure_loaded()
+        rollout = self.rollouts.get(filename)
+        if rollout is None:
+            return filename
+        if device_id and rollout["state"] == "active" \
+                and device_bucket(rollout["id"], device_id) < rollout["percent"]:
+            with self.lock:
+                self._record(rollout, device_id, "assigned")
+            return filename
+        return rollout["base"]
+
+    def admit(self, filename, device_id=None):
+        """
+        Reserve a download slot for `filename`. Returns a release callback,
+        None for images outside a rollout, or raises RolloutBusy (also for
+        devices outside the current wave, which are offered the base).
+        """
+        self._ensure_loaded()
+        rollout = self.rollouts.get(filename)
+        if rollout is None:
+            return None
+        # Spread retries so the waiting devices do not come back together
+        jitter = device_bucket(0, device_id or str(time.monotonic())) * self.retry_after // 100
+        if rollout["state"] == "paused":
+            raise RolloutBusy(f"Rollout paused: {rollout['reason']}", self.retry_after * 10 + jitter)
+        if not device_id or device_bucket(rollout["id"], device_id) >= rollout["percent"]:
+            raise RolloutBusy("Device is not in the current rollout wave", self.retry_after * 10 + jitter)
+        token = self.leases.acquire(rollout["id"], rollout["max_concurrent"], ROLLOUT_SLOT_TIMEOUT)
+        if token is None:
+            raise RolloutBusy("Too many devices downloading", self.retry_after + jitter)
+        with self.lock:
+            self._record(rollout, device_id, "downloading", force=True)
+        return lambda: self.leases.release(token)
+
+    def report(self, device_id, sha256, success, detail=None):
+        """Record a device's update result; pauses the rollout on too many failures"""
+        self._ensure_loaded()
+        rollout = next((r for r in self.rollouts.values() if r["target_sha256"] == sha256), None)
+        if rollout is None:
+            return None
+        with self.lock:
+            self._record(rollout, device_id, "succeeded" if success else "failed", detail, force=True)
+            if success or rollout["state"] != "active":
+                return rollout
+            counts = self._counts(rollout["id"], since=rollout["wave_started_at"])
+            reported = counts["succeeded"] + counts["failed"]
+            if (counts["failed"] >= ROLLOUT_MAX_FAILURES
+                    or (reported >= ROLLOUT_MIN_REPORTS
+                        and counts["failed"] / reported > ROLLOUT_MAX_FAILURE_RATE)):
+                rollout.update(state="paused", reason=f"{counts['failed']} of {reported} devices failed")
+                conn = self._connect()
+                try:
+                    self._save(conn, rollout)
+                    conn.commit()
+                finally:
+                    conn.close()
+                self._changed()
+                print(f"✗ Rollout {rollout['id']} paused: {rollout['reason']}")
+        return rollout
+
+    def _counts(self, rollout_id, since=None):
+        """Devices per state, only those updated at or after `since` when given"""
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT state, COUNT(*) FROM rollout_device WHERE rollout_id = ? "
+                                "AND updated_at >= ? GROUP BY state", (rollout_id, since or "")).fetchall()
+        finally:
+            conn.close()
+        counts = dict.fromkeys(DEVICE_STATES, 0)
+        counts.update(rows)
+        return counts
+
+    def set_state(self, rollout_id, action):
+        """Operator actions: pause, resume, advance or cancel"""
+        rollout = self.get(rollout_id)
+        if rollout is None:
+            raise ValueError(f"No active or paused rollout {rollout_id}")
+        with self.lock:
+            if action == "pause":
+                rollout.update(state="paused", reason="paused by operator")
+            elif action == "resume":
+                # Failures before the pause were dealt with; judge the wave afresh
+                rollout.update(state="active", reason=None,
+                               wave_started_at=datetime.now().isoformat(timespec="seconds"))
+            elif action == "advance":
+                self._next_wave(rollout)
+            elif action == "cancel":
+                rollout.update(state="cancelled", reason="cancelled by operator")
+                del self.rollouts[rollout["target"]]
+            else:
+                raise ValueError(f"Unknown action: {action}")
+            conn = self._connect()
+            try:
+                self._save(conn, rollout)
+                conn.commit()
+            finally:
+                conn.close()
+            self._changed()
+        return rollout
+
+    def images_in_use(self):
+        """
+        Filenames devices still depend on: target and base of every active
+        or paused rollout, and the image each device last moved to (the
+        target if it reported success in its latest rollout, else the base).
+        """
+        self._ensure_loaded()
+        in_use = set()
+        for rollout in self.rollouts.values():
+            in_use.update(name for name in (rollout["target"], rollout["base"]) if name)
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT r.target, r.base, d.state FROM rollout_device d "
+                                "JOIN rollout r ON r.id = d.rollout_id "
+                                "WHERE d.rollout_id = (SELECT MAX(rollout_id) FROM rollout_device "
+                                "WHERE device_id = d.device_id)").fetchall()
+        finally:
+            conn.close()
+        for target, base, state in rows:
+            running = target if state == "succeeded" else base
+            if running:
+                in_use.add(running)
+        return in_use
+
+    def forget(self, filename):
+        """Cancel the rollout of a deleted image"""
+        self._ensure_loaded()
+        rollout = self.rollouts.get(filename)
+        if rollout is not None:
+            self.set_state(rollout["id"], "cancel")
+
+    def _next_wave(self, rollout):
+        """Move to the next wave, or complete after a last wave of 100%; caller holds the lock"""
+        waves = [int(p) for p in rollout["waves"].split(",")]
+        if rollout["wave"] + 1 < len(waves):
+            rollout["wave"] += 1
+            rollout["percent"] = waves[rollout["wave"]]
+            rollout["wave_started_at"] = datetime.now().isoformat(timespec="seconds")
+        elif rollout["percent"] == 100:
+            rollout.update(state="completed", reason=None)
+            del self.rollouts[rollout["target"]]
+
+    def advance(self):
+        """
+        Scheduler job: move active rollouts whose wave ran long enough to
+        the next wave, and complete those whose last wave did
+        """
+        self._ensure_loaded()
+        advanced, completed = [], []
+        cutoff = (datetime.now() - timedelta(minutes=self.wave_minutes)).isoformat(timespec="seconds")
+        with self.lock:
+            for rollout in list(self.rollouts.values()):
+                if rollout["state"] == "active" and rollout["wave_started_at"] <= cutoff:
+                    percent = rollout["percent"]
+                    self._next_wave(rollout)
+                    if rollout["percent"] == percent and rollout["state"] == "active":
+                        continue
+                    conn = self._connect()
+                    try:
+                        self._save(conn, rollout)
+                        conn.commit()
+                    finally:
+                        conn.close()
+                    self._changed()
+                    if rollout["state"] == "completed":
+                        completed.append(rollout["id"])
+                        print(f"✓ Rollout {rollout['id']} completed: {rollout['target']}")
+                    else:
+                        advanced.append(f"{rollout['id']}:{rollout['percent']}%")
+        return {"advanced": advanced, "completed": completed}
+
+    def status(self):
+        self._ensure_loaded()
+        rollouts = []
+        for rollout in self.rollouts.values():
+            rollouts.append(dict(rollout, devices=self._counts(rollout["id"]),
+                                 downloading=self.leases.held(rollout["id"])))
+        return rollouts
@@ -0,0 +1,214 @@
+"""
+On-demand request profiling.
+
+Off by default; an operator switches it on at runtime (see web.py's
+/api/profiling) for a share of requests, optionally limited to some
+routes. Two methods:
+
+- "cprofile": deterministic cProfile of the request, saved as a pstats
+  file (.prof). Only one request is profiled at a time.
+- "sample": a background thread samples the request thread's stack every
+  SAMPLE_INTERVAL seconds and saves collapsed stacks (.folded), the
+  input format of flamegraph.pl and speedscope. Cheaper, less precise.
+
+With slow_ms set, a profile is only kept if the request took at least
+that long. The folder keeps the newest PROFILE_KEEP files. When
+profiling is off each request costs one attribute check.
+"""
+import io
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+# Profiling configuration
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 50))
+SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", 0.005))
+METHODS = ("cprofile", "sample")
+
+
+class StackSampler:
+    """One thread that samples the stacks of the threads registered with it"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.targets = {}        # thread ident -> Counter of collapsed stacks
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, ident):
+        stacks = Counter()
+        with self.lock:
+            self.targets[ident] = stacks
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+                self.thread.start()
+        return stacks
+
+    def stop(self, ident):
+        with self.lock:
+            return self.targets.pop(ident, Counter())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.targets:
+                    self.thread = None
+                    return
+                frames = sys._current_frames()
+                for ident, stacks in self.targets.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[collapse(frame)] += 1
+
+
+def collapse(frame):
+    """root;...;leaf for a frame, each entry as file:function:line"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class RequestProfiler:
+    def __init__(self, folder=PROFILE_DIR, keep=PROFILE_KEEP):
+        self.folder = folder
+        self.keep = keep
+        self.enabled = False
+        self.method = "sample"
+        self.fraction = 1.0
+        self.slow_ms = 0.0
+        self.routes = None       # None = every route; else URL rules and/or endpoint names
+        self.sampler = StackSampler()
+        self.cprofile_lock = threading.Lock()
+        self.saved = 0
+
+    def configure(self, enabled=None, method=None, fraction=None, slow_ms=None, routes=None):
+        if method is not None and method not in METHODS:
+            raise ValueError(f"method must be one of: {', '.join(METHODS)}")
+        if fraction is not None and not 0 <= float(fraction) <= 1:
+            raise ValueError("fraction must be between 0 and 1")
+        if method is not None:
+            self.method = method
+        if fraction is not None:
+            self.fraction = float(fraction)
+        if slow_ms is not None:
+            self.slow_ms = float(slow_ms)
+        if routes is not None:
+            self.routes = set(routes) or None
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        return self.settings()
+
+    def settings(self):
+        return {"enabled": self.enabled, "method": self.method, "fraction": self.fraction,
+                "slow_ms": self.slow_ms, "routes": sorted(self.routes) if self.routes else None,
+                "folder": self.folder, "keep": self.keep}
+
+    def begin(self, rule, endpoint):
+        """Start profiling the current request if it is selected; returns a handle or None"""
+        if self.routes is not None and rule not in self.routes and endpoint not in self.routes:
+            return None
+        if self.fraction < 1 and random.random() >= self.fraction:
+            return None
+        if self.method == "cprofile":
+            # cProfile cannot run on two threads at once under Python 3.12+
+            if not self.cprofile_lock.acquire(blocking=False):
+                return None
+            import cProfile  # only loaded once someone profiles; keeps it off the startup path
+            profile = cProfile.Profile()
+            profile.enable()
+            return ("cprofile", profile, time.perf_counter())
+        return ("sample", self.sampler.start(threading.get_ident()), time.perf_counter())
+
+    def end(self, handle, endpoint):
+        """Stop profiling; save the result if the request was slow enough"""
+        method, data, started = handle
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if method == "cprofile":
+            data.disable()
+            self.cprofile_lock.release()
+        else:
+            data = self.sampler.stop(threading.get_ident())
+        if elapsed_ms < self.slow_ms:
+            return None
+        return self._save(method, data, endpoint, elapsed_ms)
+
+    def _save(self, method, data, endpoint, elapsed_ms):
+        os.makedirs(self.folder, exist_ok=True)
+        name = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{endpoint}_{elapsed_ms:.0f}ms"
+        if method == "cprofile":
+            name += ".prof"
+            data.dump_stats(os.path.join(self.folder, name))
+        else:
+            name += ".folded"
+            with open(os.path.join(self.folder, name), "w") as f:
+                for stack, count in data.most_common():
+                    f.write(f"{stack} {count}\n")
+        self.saved += 1
+        self._prune()
+        return name
+
+    def _prune(self):
+        names = sorted(n for n in os.listdir(self.folder) if n.endswith((".prof", ".folded")))
+        for name in names[:-self.keep]:
+            os.remove(os.path.join(self.folder, name))
+
+    def list(self):
+        """Stored profiles, newest first"""
+        if not os.path.isdir(self.folder):
+            return []
+        profiles = []
+        for name in sorted(os.listdir(self.folder), reverse=True):
+            if name.endswith((".prof", ".folded")):
+                stem, _ext = name.rsplit(".", 1)
+                parts = stem.split("_")
+                profiles.append({"name": name, "endpoint": "_".join(parts[3:-1]),
+                                 "duration_ms": float(parts[-1][:-2]),
+                                 "created": datetime.strptime("_".join(parts[:3]), "%Y%m%d_%H%M%S_%f")
+                                 .isoformat(timespec="seconds"),
+                                 "size": os.path.getsize(os.path.join(self.folder, name))})
+        return profiles
+
+    def path(self, name):
+        """Full path of a stored profile, or None for unknown names"""
+        if name not in {p["name"] for p in self.list()}:
+            return None
+        return os.path.join(self.folder, name)
+
+    def text_report(self, name, limit=40):
+        """Top functions by cumulative time of a .prof file"""
+        import pstats
+        out = io.StringIO()
+        pstats.Stats(self.path(name), stream=out).sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+
+def instrument(app, profiler):
+    """Profile selected requests of a Flask app while profiler.enabled is set"""
+    from flask import request
+
+    @app.before_request
+    def _start_profile():
+        if not profiler.enabled:
+            return
+        rule = request.url_rule
+        endpoint = rule.endpoint if rule else "unmatched"
+        handle = profiler.begin(rule.rule if rule else None, endpoint)
+        if handle:
+            request.environ["profiling.handle"] = (handle, endpoint)
+
+    @app.teardown_request
+    def _finish_profile(error=None):
+        pending = request.environ.pop("profiling.handle", None)
+        if pending:
+            profiler.end(*pending)
+
+    return app
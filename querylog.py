@@ -0,0 +1,152 @@
+"""
+SQLite slow-query log.
+
+metrics.TimedCursor hands every statement's execution time to
+SLOW_QUERIES. Statements slower than SLOW_QUERY_MS are recorded with the
+shape of their parameters (types only, never values), the rows they
+returned or changed and their EXPLAIN QUERY PLAN, so a full table scan or
+a temp B-tree sort shows up with the statement that caused it.
+
+The store is bounded: the SLOW_QUERY_KEEP most recent occurrences, and
+per-statement aggregates for the SLOW_QUERY_STATEMENTS most recently seen
+statements. The plan is captured on the connection that ran the slow
+statement, at most once per PLAN_REFRESH seconds per statement. Fast
+statements cost one comparison.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+# Slow-query configuration (SLOW_QUERY_MS=0 switches the log off)
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+SLOW_QUERY_KEEP = int(os.environ.get("SLOW_QUERY_KEEP", 200))
+SLOW_QUERY_STATEMENTS = 100
+PLAN_REFRESH = 300
+EXPLAINABLE = ("select", "insert", "update", "delete", "replace", "with")
+
+
+def parameter_shape(parameters):
+    """Types of the bound parameters, e.g. ["str", "int"] or {"card": "str"}"""
+    if parameters is None:
+        return None
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    return [type(value).__name__ for value in parameters]
+
+
+def explain(conn, sql, parameters):
+    """EXPLAIN QUERY PLAN as indented lines, or None if the statement cannot be explained"""
+    words = sql.lstrip().split(None, 1)
+    if not words or words[0].lower() not in EXPLAINABLE:
+        return None
+    # The plan does not depend on the values, only on their number
+    if isinstance(parameters, dict):
+        placeholders = dict.fromkeys(parameters)
+    else:
+        placeholders = (None,) * len(parameters or ())
+    try:
+        rows = sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, placeholders).fetchall()
+    except sqlite3.Error:
+        return None
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _unused, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return lines
+
+
+def plan_warnings(plan):
+    """Plan lines worth attention: table scans without an index and temp B-tree sorts"""
+    warnings = []
+    for line in plan or ():
+        detail = line.strip()
+        if detail.startswith("SCAN ") and " USING " not in detail:
+            warnings.append("full scan: " + detail[5:])
+        elif detail.startswith("USE TEMP B-TREE"):
+            warnings.append("temp b-tree: " + detail[len("USE TEMP B-TREE FOR "):])
+    return warnings
+
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, keep=SLOW_QUERY_KEEP, statements=SLOW_QUERY_STATEMENTS):
+        self.threshold_ms = threshold_ms
+        self.threshold = threshold_ms / 1000
+        self.max_statements = statements
+        self.recent = deque(maxlen=keep)
+        self.statements = OrderedDict()      # sql -> aggregate, least recently seen first
+        self.lock = threading.Lock()
+        self.recorded = 0
+
+    def configure(self, threshold_ms=None):
+        if threshold_ms is not None:
+            if float(threshold_ms) < 0:
+                raise ValueError("threshold_ms must not be negative")
+            self.threshold_ms = float(threshold_ms)
+            self.threshold = self.threshold_ms / 1000
+        return {"threshold_ms": self.threshold_ms, "keep": self.recent.maxlen,
+                "statements": self.max_statements}
+
+    def observe(self, cursor, sql, parameters, seconds, many=False):
+        """
+        Record a statement if it was slow. Returns the occurrence dict (the
+        cursor adds fetched rows to it) or None.
+        """
+        if seconds < self.threshold or not self.threshold:
+            return None
+        rows = cursor.rowcount if cursor.rowcount > 0 else 0
+        occurrence = {"time": datetime.now().isoformat(timespec="milliseconds"), "sql": sql,
+                      "duration_ms": round(seconds * 1000, 3), "rows": rows,
+                      "params": "executemany" if many else parameter_shape(parameters)}
+        now = time.monotonic()
+        with self.lock:
+            stats = self.statements.get(sql)
+            if stats is None:
+                stats = self.statements[sql] = {"sql": sql, "count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                                "plan": None, "plan_at": None}
+                if len(self.statements) > self.max_statements:
+                    self.statements.popitem(last=False)
+            else:
+                self.statements.move_to_end(sql)
+            stats["count"] += 1
+            stats["total_ms"] += occurrence["duration_ms"]
+            stats["max_ms"] = max(stats["max_ms"], occurrence["duration_ms"])
+            stats["last"] = occurrence
+            refresh_plan = not many and (stats["plan_at"] is None or now - stats["plan_at"] > PLAN_REFRESH)
+            if refresh_plan:
+                stats["plan_at"] = now
+            self.recent.append(occurrence)
+            self.recorded += 1
+        if refresh_plan:
+            stats["plan"] = explain(cursor.connection, sql, parameters)
+        return occurrence
+
+    def report(self, limit=50):
+        """Slowest statements by total time, plus the most recent occurrences"""
+        with self.lock:
+            statements = [dict(stats) for stats in self.statements.values()]
+            recent = list(self.recent)[-limit:]
+        report = []
+        for stats in sorted(statements, key=lambda s: s["total_ms"], reverse=True)[:limit]:
+            last = stats.pop("last")
+            stats.pop("plan_at")
+            stats["total_ms"] = round(stats["total_ms"], 3)
+            stats["avg_ms"] = round(stats["total_ms"] / stats["count"], 3)
+            stats["last_seen"] = last["time"]
+            stats["last_rows"] = last["rows"]
+            stats["params"] = last["params"]
+            stats["warnings"] = plan_warnings(stats["plan"])
+            report.append(stats)
+        return {"threshold_ms": self.threshold_ms, "recorded": self.recorded,
+                "statements": report, "recent": list(reversed(recent))}
+
+    def clear(self):
+        with self.lock:
+            self.statements.clear()
+            self.recent.clear()
+
+
+SLOW_QUERIES = SlowQueryLog()
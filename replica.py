@@ -0,0 +1,112 @@
+"""
+Read-only snapshot replica for dashboard and reporting reads.
+
+The replica is a copy of the live database taken with the SQLite backup
+API and swapped in atomically with os.replace(). Heavy admin reads
+(index(), log reports) go to the snapshot; writes and /scan_card keep
+using the primary.
+
+A snapshot older than REPLICA_MAX_STALENESS is never served: the read
+falls back to the primary while a refresh runs in the background. A
+request can always ask for fresh data (see web.py's read_source()).
+"""
+import sqlite3
+import os
+import time
+import threading
+
+import backup
+
+# Database configuration
+DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database")
+DB_PATH = os.path.join(DB_DIR, "laundry.db")
+REPLICA_PATH = os.path.join(DB_DIR, "replica.db")
+
+# Replica configuration
+REPLICA_ENABLED = os.environ.get("READ_REPLICA", "0") == "1"
+REPLICA_MAX_STALENESS = float(os.environ.get("REPLICA_MAX_STALENESS", 30))
+
+
+class ReadReplica:
+    def __init__(self, db_path=DB_PATH, replica_path=REPLICA_PATH,
+                 max_staleness=REPLICA_MAX_STALENESS, enabled=REPLICA_ENABLED, connect=sqlite3.connect):
+        self.db_path = db_path
+        self.replica_path = replica_path
+        self.max_staleness = max_staleness
+        self.enabled = enabled
+        self.opener = connect    # sqlite3.connect, or a drop-in such as metrics.connect
+        self.refreshed_at = 0.0
+        self.refreshes = 0
+        self.refresh_lock = threading.Lock()
+
+    def age(self):
+        """Seconds since the snapshot was taken (inf when there is none)"""
+        return time.time() - self.refreshed_at if self.refreshed_at else float("inf")
+
+    def refresh(self):
+        """Take a new snapshot and swap it in. Returns False if one is already running."""
+        if not self.refresh_lock.acquire(blocking=False):
+            return False
+        try:
+            started = time.time()
+            # Per process: under a multi-worker server two workers may refresh at once
+            tmp_path = f"{self.replica_path}.{os.getpid()}.tmp"
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            backup.copy_database(self.db_path, tmp_path)
+
+            # The copy inherits WAL mode; a rollback-journal file can be opened immutable
+            conn = sqlite3.connect(tmp_path)
+            conn.execute("PRAGMA journal_mode=DELETE")
+            conn.close()
+
+            os.replace(tmp_path, self.replica_path)
+            self.refreshed_at = started
+            self.refreshes += 1
+            return True
+        finally:
+            self.refresh_lock.release()
+
+    def refresh_async(self):
+        if self.refresh_lock.locked():
+            return
+        threading.Thread(target=self._refresh_quietly, name="replica-refresh", daemon=True).start()
+
+    def _refresh_quietly(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"✗ Replica refresh failed: {e}")
+
+    def source(self, fresh=False):
+        """
+        (database file, age of its data in seconds) for one read. Decided
+        once per request so the rows and their X-Data-Age agree. Kicks off
+        a background refresh once the snapshot is half way to stale.
+        """
+        if not self.enabled or fresh:
+            return self.db_path, 0.0
+        age = self.age()
+        if age > self.max_staleness / 2:
+            self.refresh_async()
+        if age <= self.max_staleness:
+            return self.replica_path, age
+        return self.db_path, 0.0
+
+    def connect(self, path):
+        """
+        Connection for reads of a file source() picked. Snapshot connections
+        are opened immutable: the file is never changed in place, so SQLite
+        skips all locking.
+        """
+        if path == self.replica_path:
+            return self.opener(f"file:{self.replica_path}?mode=ro&immutable=1", uri=True)
+        return self.opener(self.db_path, timeout=10.0)
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "age_seconds": None if not self.refreshed_at else round(self.age(), 1),
+            "max_staleness": self.max_staleness,
+            "refreshes": self.refreshes
+        }
@@ -0,0 +1,340 @@
+"""
+Log retention for the laundry database.
+
+Old rows are moved out of the hot ``logs`` table into monthly archive
+databases (``database/archive/logs_YYYY_MM.db``) and a per-card daily
+summary row is kept in ``log_daily_summary``. Archival runs in small
+batches with a pause between them so live debits never wait long on the
+write lock.
+
+Run once from the command line:
+
+    python retention.py              # archive logs older than LOG_RETENTION_DAYS
+    python retention.py --days 90    # custom age
+"""
+import sqlite3
+import os
+import re
+import glob
+import time
+from datetime import datetime
+
+# Database configuration
+DB_DIR = os.environ.get("DB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "database"))
+DB_PATH = os.path.join(DB_DIR, "laundry.db")
+
+# Retention configuration
+LOG_RETENTION_DAYS = int(os.environ.get("LOG_RETENTION_DAYS", 180))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", 500))
+ARCHIVE_BATCH_PAUSE = float(os.environ.get("ARCHIVE_BATCH_PAUSE", 0.05))
+ARCHIVE_SCHEDULE = os.environ.get("ARCHIVE_SCHEDULE", "0 4 * * *")
+
+# SQLite refuses more than 10 attached databases with the default build
+MAX_ATTACHED = 9
+
+LOG_COLUMNS = "id, card_id, username, action, balance, timestamp"
+
+COINS_USED_RE = re.compile(r"(\d+) coin", re.IGNORECASE)
+COINS_ADDED_RE = re.compile(r"(?:added \+|with balance )(\d+)", re.IGNORECASE)
+
+
+def init_summary_table(conn):
+    """Create the daily summary table and the timestamp index used by archival"""
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS log_daily_summary (
+        day TEXT NOT NULL,
+        card_id TEXT NOT NULL,
+        username TEXT,
+        entries INTEGER DEFAULT 0,
+        coins_used INTEGER DEFAULT 0,
+        coins_added INTEGER DEFAULT 0,
+        last_balance INTEGER,
+        PRIMARY KEY (day, card_id)
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs(timestamp)")
+
+
+def archive_dir(db_path=DB_PATH):
+    """Archives live in an 'archive' folder next to the database file"""
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), "archive")
+
+
+def archive_path(month, db_path=DB_PATH):
+    """Archive file for a 'YYYY-MM' month"""
+    return os.path.join(archive_dir(db_path), f"logs_{month.replace('-', '_')}.db")
+
+
+def list_archives(db_path=DB_PATH):
+    """Return (month, path) pairs for every archive file, oldest first"""
+    archives = []
+    for path in sorted(glob.glob(os.path.join(archive_dir(db_path), "logs_*.db"))):
+        name = os.path.basename(path)[len("logs_"):-len(".db")]
+        archives.append((name.replace("_", "-"), path))
+    return archives
+
+
+def _ensure_archive(path):
+    """Create an archive database with the same logs schema as the hot table"""
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE IF NOT EXISTS logs (
+        id INTEGER PRIMARY KEY,
+        card_id TEXT,
+        username TEXT,
+        action TEXT,
+        balance INTEGER,
+        timestamp DATETIME
+    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_card ON logs(card_id, timestamp)")
+    conn.commit()
+    conn.close()
+
+
+def coins_added(action):
+    """Coins a log action put on the card"""
+    added = COINS_ADDED_RE.search(action or "")
+    return int(added.group(1)) if added else 0
+
+
+def coins_used(action):
+    """Coins a log action took from the card"""
+    action = action or ""
+    if COINS_ADDED_RE.search(action):
+        return 0
+    used = COINS_USED_RE.search(action)
+    return int(used.group(1)) if used else 0
+
+
+def _summarize(rows):
+    """Fold log rows into {(day, card_id): [username, entries, used, added, last_balance]}"""
+    summary = {}
+    for _id, card_id, username, action, balance, timestamp in rows:
+        key = (str(timestamp)[:10], card_id)
+        entry = summary.setdefault(key, [username, 0, 0, 0, balance])
+        entry[0] = username or entry[0]
+        entry[1] += 1
+        entry[2] += coins_used(action)
+        entry[3] += coins_added(action)
+        entry[4] = balance
+    return summary
+
+
+def archive_batch(conn, cutoff, db_path=DB_PATH, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Move one batch of logs older than cutoff into the monthly archive.
+    Returns the number of rows moved (0 when nothing is left).
+
+    A batch never spans two months, so exactly one archive is attached.
+    Rows are copied with INSERT OR IGNORE before they are deleted, so a
+    batch interrupted half way is simply redone on the next run.
+    """
+    c = conn.cursor()
+    c.execute("SELECT MIN(timestamp) FROM logs WHERE timestamp < ?", (cutoff,))
+    oldest = c.fetchone()[0]
+    if not oldest:
+        return 0
+
+    month = str(oldest)[:7]
+    month_end = c.execute("SELECT date(?, 'start of month', '+1 month')", (oldest,)).fetchone()[0]
+    c.execute(f"SELECT {LOG_COLUMNS} FROM logs WHERE timestamp < ? AND timestamp < ? ORDER BY id LIMIT ?",
+              (cutoff, month_end, batch_size))
+    rows = c.fetchall()
+    if not rows:
+        return 0
+
+    path = archive_path(month, db_path)
+    _ensure_archive(path)
+
+    # ATTACH is not allowed inside a transaction
+    c.execute("ATTACH DATABASE ? AS arc", (path,))
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.executemany(f"INSERT OR IGNORE INTO arc.logs ({LOG_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+            for (day, card_id), (username, entries, used, added, last_balance) in _summarize(rows).items():
+                c.execute('''INSERT INTO log_daily_summary
+                                 (day, card_id, username, entries, coins_used, coins_added, last_balance)
+                             VALUES (?, ?, ?, ?, ?, ?, ?)
+                             ON CONFLICT(day, card_id) DO UPDATE SET
+                                 username = excluded.username,
+                                 entries = entries + excluded.entries,
+                                 coins_used = coins_used + excluded.coins_used,
+                                 coins_added = coins_added + excluded.coins_added,
+                                 last_balance = excluded.last_balance''',
+                          (day, card_id, username, entries, used, added, last_balance))
+
+            c.executemany("DELETE FROM logs WHERE id = ?", [(row[0],) for row in rows])
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+    finally:
+        c.execute("DETACH DATABASE arc")
+    return len(rows)
+
+
+def run_retention(db_path=DB_PATH, days=LOG_RETENTION_DAYS, batch_size=ARCHIVE_BATCH_SIZE,
+                  pause=ARCHIVE_BATCH_PAUSE):
+    """Archive every log row older than `days`, one small batch at a time"""
+    os.makedirs(archive_dir(db_path), exist_ok=True)
+    # isolation_level=None so BEGIN IMMEDIATE / ATTACH are under our control
+    conn = sqlite3.connect(db_path, timeout=10.0, isolation_level=None)
+    moved = 0
+    started = time.time()
+    try:
+        init_summary_table(conn)
+        cutoff = conn.execute("SELECT datetime('now', ?)", (f"-{int(days)} days",)).fetchone()[0]
+        while True:
+            count = archive_batch(conn, cutoff, db_path, batch_size)
+            if not count:
+                break
+            moved += count
+            # Give live transactions a chance at the write lock
+            time.sleep(pause)
+    finally:
+        conn.close()
+    if moved:
+        print(f"✓ Archived {moved} log rows older than {cutoff} in {time.time() - started:.1f}s")
+    return moved
+
+
+def connect_reporting(db_path=DB_PATH, archives=()):
+    """
+    Open a read-only connection with `archives` ((month, path) pairs, at
+    most MAX_ATTACHED of them) attached as arc0, arc1, ...
+    Returns (conn, schema_names) where schema_names includes 'main'.
+    """
+    if len(archives) > MAX_ATTACHED:
+        raise ValueError(f"At most {MAX_ATTACHED} archives can be attached at once")
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=10.0)
+    schemas = ["main"]
+    for i, (_month, path) in enumerate(archives):
+        name = f"arc{i}"
+        conn.execute("ATTACH DATABASE ? AS " + name, (f"file:{path}?mode=ro",))
+        schemas.append(name)
+    return conn, schemas
+
+
+def _months_between(start, end):
+    """'YYYY-MM' strings covering start..end (both 'YYYY-MM-DD...' strings)"""
+    year, month = int(start[:4]), int(start[5:7])
+    end_year, end_month = int(end[:4]), int(end[5:7])
+    months = []
+    while (year, month) <= (end_year, end_month):
+        months.append(f"{year:04d}-{month:02d}")
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+    return months
+
+
+def query_logs(db_path=DB_PATH, card_id=None, start=None, end=None, limit=100):
+    """
+    Return log rows (newest first) from the hot table and every archive
+    that overlaps the requested period, in the same column order as logs.
+
+    Archives are queried newest first, MAX_ATTACHED at a time, and the
+    batches are merged; older batches are skipped once `limit` rows newer
+    than them have been found.
+    """
+    archives = list_archives(db_path)
+    if start:
+        wanted = set(_months_between(start, end or datetime.utcnow().strftime("%Y-%m-%d")))
+        archives = [a for a in archives if a[0] in wanted]
+    archives.reverse()
+    batches = [archives[i:i + MAX_ATTACHED] for i in range(0, len(archives), MAX_ATTACHED)] or [[]]
+
+    where, params = [], []
+    if card_id:
+        where.append("card_id = ?")
+        params.append(card_id)
+    if start:
+        where.append("timestamp >= ?")
+        params.append(start)
+    if end:
+        where.append("timestamp < ?")
+        params.append(end)
+    clause = (" WHERE " + " AND ".join(where)) if where else ""
+
+    rows = []
+    for i, batch in enumerate(batches):
+        # Archive months hold only their own month's rows
+        if i and len(rows) >= limit and str(rows[-1][5])[:7] > batch[0][0]:
+            break
+        conn, schemas = connect_reporting(db_path, batch)
+        try:
+            # The hot table only goes with the first batch
+            schemas = schemas if i == 0 else schemas[1:]
+            parts = [f"SELECT {LOG_COLUMNS} FROM {schema}.logs{clause}" for schema in schemas]
+            sql = " UNION ALL ".join(parts) + " ORDER BY timestamp DESC, id DESC LIMIT ?"
+            rows.extend(conn.execute(sql, params * len(schemas) + [int(limit)]).fetchall())
+        finally:
+            conn.close()
+        rows.sort(key=lambda row: (str(row[5]), row[0]), reverse=True)
+        del rows[limit:]
+    return rows
+
+
+def daily_report(db_path=DB_PATH, card_id=None, start=None, end=None):
+    """
+    Per-day, per-card totals spanning archived days (from the summary table)
+    and days still in the hot table (grouped by SQLite on the fly, so only
+    one row per day and card leaves the database).
+    Returns rows of (day, card_id, username, entries, coins_used, coins_added, last_balance).
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=10.0)
+    conn.create_function("coins_used", 1, coins_used, deterministic=True)
+    conn.create_function("coins_added", 1, coins_added, deterministic=True)
+    try:
+        where, params = [], []
+        if card_id:
+            where.append("card_id = ?")
+            params.append(card_id)
+        if start:
+            where.append("day >= ?")
+            params.append(start[:10])
+        if end:
+            where.append("day < ?")
+            params.append(end[:10])
+        clause = (" WHERE " + " AND ".join(where)) if where else ""
+
+        report = {}
+        try:
+            for row in conn.execute(f'''SELECT day, card_id, username, entries, coins_used,
+                                               coins_added, last_balance
+                                        FROM log_daily_summary{clause}''', params):
+                report[(row[0], row[1])] = list(row[2:])
+        except sqlite3.OperationalError:
+            pass  # Summary table not created yet (retention never ran)
+
+        hot_where = [w.replace("day", "timestamp") for w in where]
+        hot_clause = (" WHERE " + " AND ".join(hot_where)) if hot_where else ""
+        # With MAX(id), SQLite takes username and balance from each group's newest row
+        hot = conn.execute(f'''SELECT substr(timestamp, 1, 10) AS day, card_id, username, COUNT(*),
+                                      SUM(coins_used(action)), SUM(coins_added(action)), balance, MAX(id)
+                               FROM logs{hot_clause}
+                               GROUP BY day, card_id''', params)
+        for day, card, username, entries, used, added, last_balance, _id in hot:
+            entry = report.setdefault((day, card), [username, 0, 0, 0, last_balance])
+            entry[0] = username or entry[0]
+            entry[1] += entries
+            entry[2] += used
+            entry[3] += added
+            entry[4] = last_balance
+
+        return [(day, card, *values) for (day, card), values in sorted(report.items(), reverse=True)]
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Archive old laundry logs")
+    parser.add_argument("--db", default=DB_PATH, help="database file")
+    parser.add_argument("--days", type=int, default=LOG_RETENTION_DAYS, help="keep this many days hot")
+    parser.add_argument("--batch", type=int, default=ARCHIVE_BATCH_SIZE, help="rows per batch")
+    args = parser.parse_args()
+
+    moved = run_retention(args.db, args.days, args.batch)
+    print(f"Done: {moved} rows archived, {len(list_archives(args.db))} archive file(s) in {archive_dir(args.db)}")
@@ -0,0 +1,150 @@
+"""
+Entry point that picks the HTTP server (SERVER_MODE):
+
+- dev: Werkzeug's development server, what `python web.py` runs
+- gunicorn: pre-forked gunicorn worker processes with a pool of threads
+  each (the gthread worker), for production
+- gateway: the same worker processes running gateway.py on an asyncio
+  event loop (gunicorn's asgi worker) instead of threads; the device
+  endpoints are async there and the admin UI is bridged to web.app
+
+    SERVER_MODE=gunicorn WEB_WORKERS=4 WEB_THREADS=8 python -m server
+
+The master process imports none of the app. It imports shared.py before
+forking, so every worker inherits the same last card scan, change
+counters, rollout download slots and request counts (for the quiet
+window), and each worker then imports web.py itself. Workers run
+web.startup() one at a time (the first one may still be migrating the
+database), and only the worker holding the leader lock runs the
+maintenance jobs. The files each process appends to (the log, scan
+captures, traces) get a per-worker name, e.g. logs/laundry.w0.jsonl.
+
+/metrics adds up the series of all workers: each one writes a snapshot
+to a temporary folder every METRICS_SYNC_INTERVAL seconds (metrics.py),
+so the other workers' share can lag by that much. The /api/profiling,
+/api/tracing and /api/memory switches answer for the worker that served
+the request. The balance engine keeps
+balances in one process, so BALANCE_ENGINE=1 needs WEB_WORKERS=1.
+benchmarks/bench_servers.py compares the modes, and
+benchmarks/bench_gateway.py their concurrency limits and the cost of idle
+device connections.
+"""
+import itertools
+import os
+import shutil
+import tempfile
+
+import shared
+
+# Server configuration
+SERVER_MODE = os.environ.get("SERVER_MODE", "dev")
+WEB_BIND = os.environ.get("WEB_BIND", "0.0.0.0:5000")
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", 2))
+WEB_THREADS = int(os.environ.get("WEB_THREADS", 8))
+# ESP32s keep their connection open between scans and downloads
+WEB_KEEPALIVE = int(os.environ.get("WEB_KEEPALIVE", 15))
+# A worker that stops answering its master's heartbeat this long is restarted
+WEB_TIMEOUT = int(os.environ.get("WEB_TIMEOUT", 60))
+WEB_GRACEFUL_TIMEOUT = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", 30))
+# Recycle a worker after this many requests (0 = never), staggered by the jitter
+WEB_MAX_REQUESTS = int(os.environ.get("WEB_MAX_REQUESTS", 0))
+WEB_MAX_REQUESTS_JITTER = int(os.environ.get("WEB_MAX_REQUESTS_JITTER", 0))
+MODES = ("dev", "gunicorn", "gateway")
+
+# Where the workers exchange their metrics; created by the master before it forks
+_metrics_dir = None
+
+
+def worker_path(path, slot):
+    """logs/laundry.jsonl -> logs/laundry.w<slot>.jsonl"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.w{slot}{ext}"
+
+
+def _pre_fork(arbiter, worker):
+    # Lowest slot no live worker uses, so file names survive worker restarts
+    taken = {getattr(w, "slot", None) for w in arbiter.WORKERS.values()}
+    worker.slot = next(slot for slot in itertools.count() if slot not in taken)
+
+
+def _post_worker_init(worker):
+    """In the worker, once it has imported web.py"""
+    import applog
+    import metrics
+    import tracing
+    import web
+
+    slot = worker.slot
+    metrics.EXCHANGE.start(_metrics_dir, f"w{slot}")
+    if applog.LOG_FILE:
+        applog.configure(log_file=worker_path(applog.LOG_FILE, slot))
+    web.scan_recorder.path = worker_path(web.scan_recorder.path, slot)
+    if isinstance(web.tracer.exporter, tracing.JsonlExporter):
+        web.tracer.exporter.path = worker_path(web.tracer.exporter.path, slot)
+    with shared.file_lock(os.path.join(web.DB_DIR, ".startup.lock")):
+        leader = shared.hold(os.path.join(web.DB_DIR, ".leader.lock"))
+        timings = web.startup(leader)
+    print(f"✓ Worker {slot} (pid {os.getpid()}) ready in {timings['total']} ms"
+          f"{', running the maintenance jobs' if leader else ''}", flush=True)
+
+
+def gunicorn_settings(bind=WEB_BIND, workers=WEB_WORKERS, threads=WEB_THREADS, mode="gunicorn"):
+    if mode == "gateway":
+        # One event loop per worker; gateway.py sizes its own DB executor (GATEWAY_DB_THREADS)
+        return dict(gunicorn_settings(bind, workers, 1), worker_class="asgi")
+    return {"bind": bind, "workers": workers, "worker_class": "gthread", "threads": threads,
+            "keepalive": WEB_KEEPALIVE, "timeout": WEB_TIMEOUT, "graceful_timeout": WEB_GRACEFUL_TIMEOUT,
+            "max_requests": WEB_MAX_REQUESTS, "max_requests_jitter": WEB_MAX_REQUESTS_JITTER,
+            "preload_app": False, "proc_name": "laundry", "pre_fork": _pre_fork,
+            "post_worker_init": _post_worker_init}
+
+
+def run_gunicorn(settings):
+    global _metrics_dir
+    import balance_engine
+    from gunicorn.app.base import BaseApplication
+
+    if balance_engine.BALANCE_ENGINE_ENABLED and settings["workers"] > 1:
+        raise SystemExit("✗ BALANCE_ENGINE=1 keeps balances in one process; set WEB_WORKERS=1")
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            if settings["worker_class"] == "asgi":
+                import gateway
+                return gateway.app
+            import web
+            return web.app
+
+    if settings["worker_class"] == "asgi":
+        print(f"✓ Starting the device gateway on {settings['bind']}: {settings['workers']} asyncio "
+              f"worker(s), keep-alive {settings['keepalive']}s", flush=True)
+    else:
+        print(f"✓ Starting gunicorn on {settings['bind']}: {settings['workers']} worker(s) x "
+              f"{settings['threads']} thread(s), keep-alive {settings['keepalive']}s", flush=True)
+    _metrics_dir = tempfile.mkdtemp(prefix="laundry-metrics-")
+    master = os.getpid()
+    try:
+        Server().run()
+    finally:
+        # Exiting workers unwind through here too
+        if os.getpid() == master:
+            shutil.rmtree(_metrics_dir, ignore_errors=True)
+
+
+def main(mode=SERVER_MODE):
+    if mode not in MODES:
+        raise SystemExit(f"✗ SERVER_MODE must be one of: {', '.join(MODES)}")
+    if mode != "dev":
+        run_gunicorn(gunicorn_settings(mode=mode))
+        return
+    import web
+    host, port = WEB_BIND.rsplit(":", 1)
+    web.main(host, int(port))
+
+
+if __name__ == "__main__":
+    main()
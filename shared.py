@@ -0,0 +1,259 @@
+"""
+State shared by the worker processes of a pre-forked server (server.py).
+
+The objects below are created when this module is first imported. In
+production that happens in the server's master process before it forks,
+so every worker inherits the same anonymous shared memory and lock; with
+the single-process development server they simply live in that process.
+The lock is a record lock on an inherited temporary file, which the
+kernel drops when its holder dies, so a worker killed mid-update cannot
+block the others; a live holder stuck for SHARED_LOCK_TIMEOUT seconds is
+logged and bypassed.
+
+- LAST_SCAN: the most recent card scan, for the admin page's "scan a
+  card" field (set by /scan_card on any worker, taken by /get_last_card
+  on any other)
+- generation(name): a counter a process bumps after changing a table it
+  also caches in memory (firmware catalog, rollouts); the other
+  processes see it move and reload their copy
+- DOWNLOADS: leases that cap a rollout's concurrent downloads across
+  all workers; a lease whose process died is taken back
+- request_counts(window): where maintenance.RequestRate counts the
+  requests of all workers, for the scheduler's quiet-window detection
+- file_lock()/hold(): flock-based locks, e.g. to run init_db one worker
+  at a time or to pick the one worker that runs the maintenance jobs
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import applog
+
+log = applog.get_logger("shared")
+
+# Longest wait for the shared lock before going ahead without it
+SHARED_LOCK_TIMEOUT = float(os.environ.get("SHARED_LOCK_TIMEOUT", 2.0))
+
+# Layout of the shared memory: generation counters, the last scan, download leases, request counts
+GENERATIONS = ("firmware", "rollout")
+_COUNTER = struct.Struct("q")
+_LENGTH = struct.Struct("I")
+_SCAN_OFFSET = 256
+SCAN_CAPACITY = 1024
+_LEASE = struct.Struct("qqd")    # key, owner pid, taken at (time.time())
+_LEASE_OFFSET = 2048
+LEASE_COUNT = 64
+_RATE_OFFSET = 4096
+_RATE_BUCKET_SIZE = 16           # maintenance.RequestRate.BUCKET
+RATE_CAPACITY = 3600             # one-second buckets
+
+
+class SharedLock:
+    """
+    Exclusive across processes (fcntl record lock on a file all of them
+    inherit) and across the threads of each one. The critical sections
+    are a few struct reads and writes, so a wait longer than `timeout`
+    means the holder is hung; the caller then logs it and goes ahead
+    unlocked rather than blocking every request behind it.
+    """
+
+    def __init__(self, timeout=SHARED_LOCK_TIMEOUT):
+        self.file = tempfile.TemporaryFile()
+        self.threads = threading.Lock()
+        self.timeout = timeout
+        self.bypassed = 0
+        self.held = threading.local()
+
+    def _lock_file(self, deadline):
+        delay = 0.0001
+        while True:
+            try:
+                fcntl.lockf(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except OSError:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(delay)
+                delay = min(delay * 2, 0.005)
+
+    def __enter__(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        threads = self.threads.acquire(timeout=self.timeout)
+        # Another thread of this process owns the file lock when `threads` timed out
+        locked = threads and self._lock_file(deadline)
+        self.held.locks = (threads, locked)
+        if not (threads and locked):
+            self.bypassed += 1
+            applog.event(log, logging.ERROR, "shared_lock_bypassed", pid=os.getpid(),
+                         waited_ms=round((time.monotonic() - started) * 1000),
+                         holder="thread" if not threads else "process")
+        return self
+
+    def __exit__(self, *exc):
+        threads, locked = self.held.locks
+        if locked:
+            fcntl.lockf(self.file, fcntl.LOCK_UN)
+        if threads:
+            self.threads.release()
+
+
+_memory = mmap.mmap(-1, _RATE_OFFSET + _RATE_BUCKET_SIZE * RATE_CAPACITY)
+_lock = SharedLock()
+_held = {}
+
+
+class Generation:
+    def __init__(self, index):
+        self.offset = index * _COUNTER.size
+
+    @property
+    def value(self):
+        return _COUNTER.unpack_from(_memory, self.offset)[0]
+
+    def bump(self, seen=None):
+        """
+        Count a change made by this process. Returns the value the caller
+        may remember as seen: the new one, unless another process changed
+        the table too since `seen`, in which case the caller should reload.
+        """
+        with _lock:
+            current = _COUNTER.unpack_from(_memory, self.offset)[0]
+            _COUNTER.pack_into(_memory, self.offset, current + 1)
+        return current + 1 if seen is None or current == seen else seen
+
+
+def generation(name):
+    return Generation(GENERATIONS.index(name))
+
+
+class LastScan:
+    """One JSON object in shared memory; pop() hands it to a single reader"""
+
+    def put(self, scan):
+        data = json.dumps(scan, separators=(",", ":")).encode("utf-8")
+        if len(data) > SCAN_CAPACITY:
+            return False
+        with _lock:
+            _memory[_SCAN_OFFSET + _LENGTH.size:_SCAN_OFFSET + _LENGTH.size + len(data)] = data
+            _LENGTH.pack_into(_memory, _SCAN_OFFSET, len(data))
+        return True
+
+    def pop(self):
+        with _lock:
+            length = _LENGTH.unpack_from(_memory, _SCAN_OFFSET)[0]
+            if not length:
+                return None
+            data = _memory[_SCAN_OFFSET + _LENGTH.size:_SCAN_OFFSET + _LENGTH.size + length]
+            _LENGTH.pack_into(_memory, _SCAN_OFFSET, 0)
+        return json.loads(data)
+
+    def __len__(self):
+        return 1 if _LENGTH.unpack_from(_memory, _SCAN_OFFSET)[0] else 0
+
+
+LAST_SCAN = LastScan()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Leases:
+    """
+    At most `limit` holders per key (a positive integer) across processes.
+    A lease older than `timeout` seconds, or held by a process that has
+    exited, is taken back by the next acquire(). Without a `buffer` the
+    leases are private to this process.
+    """
+
+    def __init__(self, buffer=None, count=LEASE_COUNT):
+        self.buffer = buffer if buffer is not None else bytearray(_LEASE.size * count)
+        self.count = len(self.buffer) // _LEASE.size
+
+    def acquire(self, key, limit, timeout):
+        """A token for release(), or None when `limit` leases (or all of them) are taken"""
+        now = time.time()
+        held, free = 0, None
+        with _lock:
+            for i in range(self.count):
+                owner, pid, taken = _LEASE.unpack_from(self.buffer, i * _LEASE.size)
+                if owner and (now - taken > timeout or not _alive(pid)):
+                    _LEASE.pack_into(self.buffer, i * _LEASE.size, 0, 0, 0.0)
+                    owner = 0
+                if not owner:
+                    free = i if free is None else free
+                elif owner == key:
+                    held += 1
+            if held >= limit or free is None:
+                return None
+            _LEASE.pack_into(self.buffer, free * _LEASE.size, key, os.getpid(), now)
+        return free, now
+
+    def release(self, token):
+        """Give a lease back; a lease that was already taken back is left alone"""
+        index, taken = token
+        with _lock:
+            _owner, pid, stamp = _LEASE.unpack_from(self.buffer, index * _LEASE.size)
+            if pid == os.getpid() and stamp == taken:
+                _LEASE.pack_into(self.buffer, index * _LEASE.size, 0, 0, 0.0)
+
+    def held(self, key=None):
+        """Leases currently held for `key` (any key when None)"""
+        with _lock:
+            owners = [_LEASE.unpack_from(self.buffer, i * _LEASE.size)[0] for i in range(self.count)]
+        return sum(1 for owner in owners if owner and (key is None or owner == key))
+
+
+DOWNLOADS = Leases(memoryview(_memory)[_LEASE_OFFSET:_LEASE_OFFSET + _LEASE.size * LEASE_COUNT])
+
+
+def request_counts(window):
+    """(buffer, lock) for a maintenance.RequestRate of `window` seconds shared by all workers"""
+    if not 0 < window <= RATE_CAPACITY:
+        raise ValueError(f"Request rate window must be 1-{RATE_CAPACITY} seconds")
+    return memoryview(_memory)[_RATE_OFFSET:_RATE_OFFSET + _RATE_BUCKET_SIZE * window], _lock
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Exclusive lock across processes for the duration of the block"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def hold(path):
+    """
+    Try to take a lock for the rest of this process's life. True for the
+    one process that holds it; it is released when that process exits.
+    """
+    if path in _held:
+        return True
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    f = open(path, "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    _held[path] = f
+    return True
+
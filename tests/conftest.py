@@ -0,0 +1,27 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# The modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Modules read their paths at import time, so point them at scratch space first
+SCRATCH = tempfile.mkdtemp(prefix="laundry-tests-")
+atexit.register(shutil.rmtree, SCRATCH, ignore_errors=True)
+for folder in ("database", "firmware"):
+    os.makedirs(os.path.join(SCRATCH, folder))
+os.environ.update(DB_DIR=os.path.join(SCRATCH, "database"), FIRMWARE_DIR=os.path.join(SCRATCH, "firmware"),
+                  LOG_FILE="", TRACE_FILE=os.path.join(SCRATCH, "traces.jsonl"),
+                  SCAN_CAPTURE_FILE=os.path.join(SCRATCH, "capture.jsonl"))
+
+
+@pytest.fixture(scope="session")
+def web():
+    """web.py on the scratch database and firmware folder"""
+    import web
+    web.init_db()
+    return web
@@ -0,0 +1,52 @@
+import os
+import sqlite3
+import threading
+
+import backup
+
+
+def make_database(path, rows=5000):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE logs (id INTEGER PRIMARY KEY, action TEXT)")
+    conn.executemany("INSERT INTO logs (action) VALUES (?)", [("x" * 200,)] * rows)
+    conn.commit()
+    conn.close()
+
+
+def test_paths_follow_db_dir(web):
+    assert backup.DB_PATH == web.DB_PATH
+    assert backup.BACKUP_DIR == os.path.join(web.DB_DIR, "backups")
+
+
+def test_quiet_database_is_copied_stepwise(tmp_path):
+    make_database(str(tmp_path / "src.db"))
+    result = backup.copy_database(str(tmp_path / "src.db"), str(tmp_path / "copy.db"), pages=16, pause=0)
+    assert result == {"restarts": 0, "single_step": False}
+    backup.verify_database(str(tmp_path / "copy.db"))
+
+
+def test_copy_finishes_under_constant_writes(tmp_path):
+    src = str(tmp_path / "src.db")
+    make_database(src)
+    stop = threading.Event()
+
+    def writer():
+        conn = sqlite3.connect(src)
+        while not stop.is_set():
+            conn.execute("INSERT INTO logs (action) VALUES ('scan')")
+            conn.commit()
+        conn.close()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        result = backup.copy_database(src, str(tmp_path / "copy.db"), pages=4, pause=0.002, max_restarts=2)
+    finally:
+        stop.set()
+        thread.join()
+    assert result == {"restarts": 2, "single_step": True}
+    backup.verify_database(str(tmp_path / "copy.db"))
+    conn = sqlite3.connect(str(tmp_path / "copy.db"))
+    assert conn.execute("SELECT COUNT(*) FROM logs").fetchone()[0] >= 5000
+    conn.close()
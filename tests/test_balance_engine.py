@@ -0,0 +1,224 @@
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import balance_engine
+from balance_engine import BalanceEngine, JournalError, encode_record, OP_CREDIT, OP_DEBIT
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_db(path, users):
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE USERS (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL,
+                                        card_id TEXT UNIQUE NOT NULL, balance INTEGER DEFAULT 0)''')
+    conn.executemany("INSERT INTO USERS (username, card_id, balance) VALUES (?, ?, ?)",
+                     [(f"user-{card}", card, balance) for card, balance in users.items()])
+    conn.commit()
+    conn.close()
+
+
+def users(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return dict(conn.execute("SELECT card_id, balance FROM USERS"))
+    finally:
+        conn.close()
+
+
+def checkpointed_seq(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT last_seq FROM balance_engine_state WHERE id = 1").fetchone()[0]
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def paths(tmp_path):
+    db_path = str(tmp_path / "laundry.db")
+    make_db(db_path, {"A": 100, "B": 50})
+    return db_path, str(tmp_path / "journal")
+
+
+def open_engine(paths):
+    return BalanceEngine(*paths).open()
+
+
+def test_journal_is_replayed_after_a_restart(paths):
+    engine = open_engine(paths)
+    assert engine.debit("A", 3) == (True, "user-A", 97)
+    assert engine.credit("B", 10) == ("user-B", 60)
+    assert engine.debit("B", 100) == (False, "user-B", 60)
+    assert engine.debit("nobody", 1) is None
+    # No checkpoint: USERS still has the old balances, the journal the changes
+    assert users(paths[0]) == {"A": 100, "B": 50}
+
+    restarted = open_engine(paths)
+    assert restarted.replayed == 2
+    assert restarted.lookup("A") == ("user-A", 97)
+    assert restarted.lookup("B") == ("user-B", 60)
+
+
+def test_torn_journal_tail_is_cut_off(paths):
+    engine = open_engine(paths)
+    engine.debit("A", 1)
+    engine.debit("A", 1)
+    _index, segment = engine.journal.segments()[-1]
+    # A crash half way through the next record
+    torn = encode_record(engine.seq + 1, OP_DEBIT, -5, "A")
+    with open(segment, "ab") as f:
+        f.write(torn[:len(torn) // 2])
+
+    restarted = open_engine(paths)
+    assert restarted.truncated_bytes == len(torn) // 2
+    assert restarted.lookup("A")[1] == 98
+    # New records follow the intact ones and survive the next restart
+    restarted.debit("A", 4)
+    assert open_engine(paths).lookup("A")[1] == 94
+
+
+def test_corrupt_record_stops_replay(paths):
+    engine = open_engine(paths)
+    engine.debit("A", 1)
+    _index, segment = engine.journal.segments()[-1]
+    record = bytearray(encode_record(engine.seq + 1, OP_DEBIT, -5, "A"))
+    record[-1] ^= 0xFF
+    with open(segment, "ab") as f:
+        f.write(bytes(record) + encode_record(engine.seq + 2, OP_DEBIT, -7, "A"))
+
+    restarted = open_engine(paths)
+    assert restarted.lookup("A")[1] == 99
+
+
+def test_replay_applies_only_records_after_the_checkpoint(paths):
+    db_path, journal_dir = paths
+    engine = open_engine(paths)
+    engine.debit("A", 10)
+    engine.credit("B", 5)
+    assert engine.checkpoint() == {"cards": 2, "seq": 2, "reconciled": 0}
+    assert users(db_path) == {"A": 90, "B": 55}
+    engine.debit("A", 1)
+
+    # A crash between the USERS commit and the segment cleanup leaves
+    # already checkpointed records in the journal; they must not apply twice
+    stale = os.path.join(journal_dir, "balances-000000.journal")
+    with open(stale, "wb") as f:
+        f.write(encode_record(1, OP_DEBIT, -10, "A") + encode_record(2, OP_CREDIT, 5, "B"))
+
+    restarted = open_engine(paths)
+    assert restarted.replayed == 1
+    assert restarted.lookup("A")[1] == 89
+    assert restarted.lookup("B")[1] == 55
+
+
+def test_restart_leaves_users_consistent_with_the_engine(paths):
+    db_path, _ = paths
+    engine = open_engine(paths)
+    for _ in range(5):
+        engine.debit("A", 2)
+    engine.checkpoint()
+    engine.credit("B", 7)
+    engine.debit("A", 1)
+
+    restarted = open_engine(paths)
+    # open() checkpoints whatever it replayed
+    assert users(db_path) == {"A": 89, "B": 57}
+    assert checkpointed_seq(db_path) == restarted.seq == 7
+    assert restarted.total() == sum(users(db_path).values())
+    # Segments the checkpoint covers are gone
+    assert len(restarted.journal.segments()) == 1
+
+
+def test_failed_journal_write_is_undone_and_stops_the_engine(paths, monkeypatch):
+    db_path, _ = paths
+    engine = open_engine(paths)
+    engine.debit("A", 1)
+
+    def broken_fsync(fd):
+        raise OSError(5, "Input/output error")
+
+    monkeypatch.setattr(balance_engine.os, "fsync", broken_fsync)
+    with pytest.raises(JournalError):
+        engine.debit("A", 10)
+    # The debit is not visible to anyone, and nothing more is accepted or checkpointed
+    assert engine.lookup("A")[1] == 99
+    with pytest.raises(JournalError):
+        engine.credit("B", 5)
+    with pytest.raises(JournalError):
+        engine.checkpoint()
+    assert engine.status()["error"]
+    assert users(db_path) == {"A": 100, "B": 50}
+    monkeypatch.undo()
+
+    restarted = open_engine(paths)
+    assert restarted.lookup("A")[1] == 99
+    assert users(db_path) == {"A": 99, "B": 50}
+
+
+WORKER = textwrap.dedent('''
+    import sys
+    sys.path.insert(0, {root!r})
+    from balance_engine import BalanceEngine
+    engine = BalanceEngine({db!r}, {journal!r}).open()
+    while True:
+        approved, _username, balance = engine.debit("A", 1)
+        if not approved:
+            break
+        print(balance, flush=True)
+''')
+
+
+def test_killed_process_keeps_every_acknowledged_debit(tmp_path):
+    db_path = str(tmp_path / "laundry.db")
+    journal_dir = str(tmp_path / "journal")
+    make_db(db_path, {"A": 1000000})
+    script = WORKER.format(root=ROOT, db=db_path, journal=journal_dir)
+    proc = subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        lines = []
+        while len(lines) < 200:
+            line = proc.stdout.readline()
+            assert line
+            if line.strip().isdigit():
+                lines.append(line)
+        proc.send_signal(signal.SIGKILL)
+        proc.wait()
+        lines.extend(line for line in proc.stdout.read().splitlines() if line.strip().isdigit())
+        acknowledged = [int(line) for line in lines]
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+    last_acknowledged = acknowledged[-1]
+
+    restarted = BalanceEngine(db_path, journal_dir).open()
+    balance = restarted.lookup("A")[1]
+    # Every answered debit survived; at most the one in flight did too
+    assert balance in (last_acknowledged, last_acknowledged - 1)
+    assert users(db_path)["A"] == balance
+
+
+def test_checkpoint_keeps_changes_made_by_other_writers(paths):
+    db_path, _ = paths
+    engine = open_engine(paths)
+    engine.debit("A", 10)
+    # cloneWep.py tops up A and registers a card behind the engine's back
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE USERS SET balance = balance + 25 WHERE card_id = 'A'")
+    conn.execute("INSERT INTO USERS (username, card_id, balance) VALUES ('user-C', 'C', 40)")
+    conn.commit()
+    conn.close()
+
+    assert engine.checkpoint() == {"cards": 1, "seq": 1, "reconciled": 2}
+    assert users(db_path) == {"A": 115, "B": 50, "C": 40}
+    assert engine.lookup("A")[1] == 115
+    assert engine.debit("C", 5) == (True, "user-C", 35)
+    engine.checkpoint()
+    assert users(db_path) == {"A": 115, "B": 50, "C": 35}
+    assert engine.total() == sum(users(db_path).values())
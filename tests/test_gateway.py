@@ -0,0 +1,139 @@
+import asyncio
+import io
+import json
+
+import pytest
+
+import ota
+
+
+@pytest.fixture
+def image(web):
+    data = bytes([ota.ESP_IMAGE_MAGIC]) + bytes(23) + b"\x3c" * 300000
+    client = web.app.test_client()
+    response = client.post("/upload_firmware", data={"firmware": (io.BytesIO(data), "gateway.bin")},
+                           content_type="multipart/form-data")
+    name = response.get_json()["filename"]
+    yield name, data
+    client.post("/delete_firmware", json={"filename": name})
+
+
+def fetch(path, after_body, send_delay=0.0, stall_after=None):
+    """GET `path` through gateway.app; `after_body` answers receive() once the request was read"""
+    import gateway
+
+    scope = {"type": "http", "method": "GET", "path": path, "query_string": b"", "http_version": "1.1",
+             "headers": [(b"host", b"test")]}
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return await after_body()
+
+    async def send(message):
+        sent.append(message)
+        if stall_after is not None and len(sent) > stall_after:
+            await asyncio.Event().wait()
+        await asyncio.sleep(send_delay)
+
+    async def main():
+        await asyncio.wait_for(gateway.app(scope, receive, send), 10)
+    asyncio.run(main())
+    return sent
+
+
+def body_of(sent):
+    return b"".join(m.get("body", b"") for m in sent if m["type"] == "http.response.body")
+
+
+def test_bridge_ignores_messages_that_are_not_a_disconnect(web, image):
+    name, data = image
+    calls = []
+
+    async def after_body():
+        # A message other than http.disconnect, then nothing until the end
+        if not calls:
+            calls.append(1)
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.Event().wait()
+
+    sent = fetch(f"/firmware/{name}", after_body, send_delay=0.01)
+    assert sent[0]["status"] == 200
+    assert body_of(sent) == data
+
+
+def test_bridge_stops_a_download_when_the_device_disconnects(web, image):
+    name, data = image
+
+    async def after_body():
+        await asyncio.sleep(0.05)
+        return {"type": "http.disconnect"}
+
+    sent = fetch(f"/firmware/{name}", after_body, stall_after=2)
+    assert sent[0]["status"] == 200
+    assert len(body_of(sent)) < len(data)
+
+
+def test_bridged_requests_count_once_for_the_quiet_window(web, monkeypatch):
+    noted = []
+    monkeypatch.setattr(web.scheduler, "note_request", lambda: noted.append(1))
+
+    async def after_body():
+        await asyncio.Event().wait()
+
+    assert fetch("/firmware/manifest.json", after_body)[0]["status"] == 200    # served by the gateway
+    assert fetch("/api/maintenance", after_body)[0]["status"] == 200           # bridged to web.app
+    assert len(noted) == 2
+
+
+def post_scan(body):
+    """POST /scan_card through gateway.app; returns the sent messages"""
+    import gateway
+
+    scope = {"type": "http", "method": "POST", "path": "/scan_card", "query_string": b"",
+             "http_version": "1.1", "headers": [(b"host", b"test"), (b"content-type", b"application/json")]}
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asyncio.wait_for(gateway.app(scope, receive, send), 10))
+    return sent
+
+
+def test_failed_scan_gets_the_flask_error_body(web, monkeypatch):
+    import gateway
+
+    def broken(data):
+        raise RuntimeError("database is gone")
+
+    monkeypatch.setattr(web, "process_scan", broken)
+    errors = gateway.metrics.SCAN_OUTCOMES.value(outcome="error")
+    requests = gateway.metrics.REQUESTS.value(route="/scan_card", method="POST", status=500)
+    sent = post_scan(b'{"card_id": "X", "coins": 1}')
+    assert sent[0]["status"] == 500
+    assert json.loads(body_of(sent)) == {"success": False, "user_exists": False, "activate_machine": False,
+                                         "error": "database is gone"}
+    assert gateway.metrics.SCAN_OUTCOMES.value(outcome="error") == errors + 1
+    assert gateway.metrics.REQUESTS.value(route="/scan_card", method="POST", status=500) == requests + 1
+
+
+def test_inflight_semaphore_belongs_to_the_running_loop(web):
+    import gateway
+
+    async def slots():
+        return gateway.inflight_slots(), gateway.inflight_slots()
+
+    first, again = asyncio.run(slots())
+    assert first is again
+    # A new loop (e.g. a re-created worker loop) gets its own semaphore
+    assert asyncio.run(slots())[0] is not first
+    assert post_scan(b'{"card_id": ""}')[0]["status"] == 400
@@ -0,0 +1,93 @@
+import logging
+import mmap
+import multiprocessing
+import os
+from datetime import datetime
+
+import pytest
+
+import maintenance
+import metrics
+import shared
+
+
+def test_successful_runs_are_counted_and_logged_at_debug(caplog, capsys):
+    scheduler = maintenance.MaintenanceScheduler()
+    scheduler.add_job("noop", lambda: {"moved": 1}, "* * * * *")
+    before = metrics.MAINTENANCE_RUNS.value(job="noop", status="ok")
+    # applog.configure() stops "laundry" loggers from propagating to caplog's handler
+    maintenance.log.addHandler(caplog.handler)
+    try:
+        with caplog.at_level(logging.DEBUG, logger="laundry.maintenance"):
+            record = scheduler.run_job("noop")
+    finally:
+        maintenance.log.removeHandler(caplog.handler)
+    assert record["status"] == "ok" and record["effect"] == {"moved": 1}
+    assert metrics.MAINTENANCE_RUNS.value(job="noop", status="ok") == before + 1
+    assert {(r.levelno, r.getMessage()) for r in caplog.records} == {(logging.DEBUG, "maintenance_run")}
+    assert capsys.readouterr().out == ""
+
+
+def test_failed_runs_are_logged_as_warnings():
+    scheduler = maintenance.MaintenanceScheduler()
+
+    def broken():
+        raise OSError("disk full")
+
+    scheduler.add_job("broken", broken, "* * * * *")
+    before = metrics.MAINTENANCE_RUNS.value(job="broken", status="error")
+    record = scheduler.run_job("broken")
+    assert record["status"] == "error" and record["error"] == "disk full"
+    assert scheduler.jobs["broken"].failures == 1
+    assert metrics.MAINTENANCE_RUNS.value(job="broken", status="error") == before + 1
+
+
+def test_request_rate_counts_requests_of_every_worker():
+    # What shared.request_counts() hands out, without web.py's requests in it
+    rate = maintenance.RequestRate(10, mmap.mmap(-1, maintenance.RequestRate.BUCKET.size * 10),
+                                   multiprocessing.Lock())
+    pid = os.fork()
+    if pid == 0:
+        for _ in range(5):
+            rate.hit()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    rate.hit()
+    assert rate.rate() == pytest.approx(0.6)
+    assert len(shared.request_counts(10)[0]) == len(rate.buffer)
+    with pytest.raises(ValueError):
+        shared.request_counts(shared.RATE_CAPACITY + 1)
+
+
+def test_due_jobs_run_on_tick():
+    scheduler = maintenance.MaintenanceScheduler()
+    ran = []
+    scheduler.add_job("every5", lambda: ran.append(1), "*/5 * * * *")
+    scheduler.tick(datetime(2026, 3, 2, 10, 3))
+    scheduler.tick(datetime(2026, 3, 2, 10, 5))
+    assert len(ran) == 1
+
+
+@pytest.mark.parametrize("expr, when, matches", [
+    ("30 3 * * 0", datetime(2026, 3, 1, 3, 30), True),        # a Sunday
+    ("30 3 * * 0", datetime(2026, 3, 2, 3, 30), False),
+    ("0 0 1 * *", datetime(2026, 3, 1, 0, 0), True),
+    ("0 0 1 * *", datetime(2026, 3, 2, 0, 0), False),
+    # Both day fields restricted: the 1st of the month or any Monday
+    ("0 0 1 * 1", datetime(2026, 3, 1, 0, 0), True),
+    ("0 0 1 * 1", datetime(2026, 3, 2, 0, 0), True),
+    ("0 0 1 * 1", datetime(2026, 3, 3, 0, 0), False),
+    # A '*/n' day field still counts as unrestricted
+    ("0 0 */2 * 1", datetime(2026, 3, 3, 0, 0), False),
+    ("0 0 */2 * 1", datetime(2026, 3, 9, 0, 0), True),
+    ("*/15 8-10 * * 1-5", datetime(2026, 3, 4, 9, 45), True),
+    ("*/15 8-10 * * 1-5", datetime(2026, 3, 4, 9, 40), False),
+])
+def test_cron_matches(expr, when, matches):
+    assert maintenance.CronSchedule(expr).matches(when) is matches
+
+
+@pytest.mark.parametrize("expr", ["* * * *", "60 * * * *", "* * 0 * *", "*/0 * * * *"])
+def test_cron_rejects_invalid_expressions(expr):
+    with pytest.raises(ValueError):
+        maintenance.CronSchedule(expr)
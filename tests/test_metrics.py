@@ -0,0 +1,40 @@
+import metrics
+
+
+def make_registry():
+    registry = metrics.Registry()
+    registry.counter("requests_total", "Requests", ("route",))
+    registry.histogram("request_seconds", "Latency", buckets=(0.1, 1.0))
+    return registry
+
+
+def test_render_adds_other_workers_snapshots():
+    mine, other = make_registry(), make_registry()
+    mine.metrics["requests_total"].inc(route="/a")
+    other.metrics["requests_total"].inc(2, route="/a")
+    other.metrics["requests_total"].inc(route="/b")
+    mine.metrics["request_seconds"].observe(0.05)
+    other.metrics["request_seconds"].observe(0.5)
+    lines = mine.render([other.snapshot()]).splitlines()
+    assert 'requests_total{route="/a"} 3' in lines
+    assert 'requests_total{route="/b"} 1' in lines
+    assert 'request_seconds_bucket{le="0.1"} 1' in lines
+    assert 'request_seconds_bucket{le="1.0"} 2' in lines
+    assert "request_seconds_count 2" in lines
+    assert mine.metrics["requests_total"].value(route="/a") == 1
+
+
+def test_exchange_reads_the_other_workers_files(tmp_path):
+    first, second = make_registry(), make_registry()
+    first.metrics["requests_total"].inc(route="/a")
+    second.metrics["requests_total"].inc(4, route="/a")
+    first_exchange = metrics.Exchange(first, interval=3600)
+    second_exchange = metrics.Exchange(second, interval=3600)
+    assert first_exchange.others() == []
+    first_exchange.start(str(tmp_path), "w0")
+    second_exchange.start(str(tmp_path), "w1")
+    (tmp_path / "w2.json").write_text("{")    # unreadable snapshots are skipped
+    assert 'requests_total{route="/a"} 5' in first.render(first_exchange.others()).splitlines()
+    second.metrics["requests_total"].inc(route="/a")
+    second_exchange.write()
+    assert 'requests_total{route="/a"} 6' in first.render(first_exchange.others()).splitlines()
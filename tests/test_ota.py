@@ -0,0 +1,119 @@
+import io
+import logging
+import os
+
+import pytest
+
+import ota
+
+
+def image(payload=b"", chip_id=0):
+    """A minimal ESP32 app image header followed by `payload`"""
+    header = bytearray(24)
+    header[0] = ota.ESP_IMAGE_MAGIC
+    header[12:14] = chip_id.to_bytes(2, "little")
+    return bytes(header) + payload
+
+
+def multipart(filename, data, boundary="b0undary"):
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"firmware\"; filename=\"{filename}\"\r\n"
+            "Content-Type: application/octet-stream\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return io.BytesIO(body), len(body), {"boundary": boundary}
+
+
+def upload(folder, catalog, data, filename="app.bin"):
+    stream, length, options = multipart(filename, data)
+    name, received = ota.receive_upload(stream, "multipart/form-data", length, options, folder=folder)
+    return ota.store_upload(name, received, catalog)
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    folder = tmp_path / "firmware"
+    folder.mkdir()
+    return ota.FirmwareCatalog(str(tmp_path / "laundry.db"), str(folder))
+
+
+def test_duplicate_upload_is_not_stored_again(catalog):
+    data = image(os.urandom(4096))
+    first, duplicate = upload(catalog.folder, catalog, data)
+    assert not duplicate
+    second, duplicate = upload(catalog.folder, catalog, data, filename="renamed.bin")
+    assert duplicate
+    assert second["filename"] == first["filename"]
+    # Only the first copy is on disk, and no temporary upload is left behind
+    assert os.listdir(catalog.folder) == [first["filename"]]
+    assert [e["filename"] for e in catalog.list()] == [first["filename"]]
+
+
+def test_different_images_are_both_stored(catalog):
+    first, _ = upload(catalog.folder, catalog, image(b"\x01" * 100), filename="a.bin")
+    second, duplicate = upload(catalog.folder, catalog, image(b"\x02" * 100), filename="b.bin")
+    assert not duplicate
+    assert {e["sha256"] for e in catalog.list()} == {first["sha256"], second["sha256"]}
+    assert first["target_board"] == "esp32"
+
+
+def test_same_name_in_the_same_second_keeps_both_images(catalog, monkeypatch):
+    class Frozen(ota.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls(2025, 3, 1, 12, 0, 0)
+    monkeypatch.setattr(ota, "datetime", Frozen)
+    first, _ = upload(catalog.folder, catalog, image(b"\x01" * 100))
+    second, _ = upload(catalog.folder, catalog, image(b"\x02" * 100))
+    assert first["filename"] != second["filename"]
+    assert sorted(os.listdir(catalog.folder)) == sorted([first["filename"], second["filename"]])
+    assert len(catalog.list()) == 2
+
+
+def test_duplicate_from_another_worker_is_caught_in_the_transaction(catalog):
+    other = ota.FirmwareCatalog(catalog.db_path, catalog.folder)
+    other.list()    # loaded before the first upload, like a second worker process
+    data = image(os.urandom(256))
+    first, _ = upload(catalog.folder, catalog, data)
+    second, duplicate = upload(catalog.folder, other, data, filename="again.bin")
+    assert duplicate
+    assert second["filename"] == first["filename"]
+    assert os.listdir(catalog.folder) == [first["filename"]]
+
+
+def test_catalog_survives_a_reload(catalog):
+    entry, _ = upload(catalog.folder, catalog, image(os.urandom(512)))
+    reloaded = ota.FirmwareCatalog(catalog.db_path, catalog.folder)
+    assert reloaded.find_sha256(entry["sha256"])["filename"] == entry["filename"]
+
+
+@pytest.mark.parametrize("filename, data, status", [
+    ("app.bin", b"\x00" + os.urandom(100), 400),
+    ("app.txt", image(b"x"), 400),
+    ("app.bin", image(b"x" * ota.MAX_FIRMWARE_SIZE), 413),
+])
+def test_rejected_uploads_leave_nothing_behind(catalog, filename, data, status):
+    with pytest.raises(ota.FirmwareRejected) as rejected:
+        upload(catalog.folder, catalog, data, filename=filename)
+    assert rejected.value.status == status
+    assert os.listdir(catalog.folder) == []
+
+
+def test_background_worker_logs_a_failed_item_and_keeps_going():
+    records, done = [], []
+    handler = logging.Handler()
+    handler.emit = records.append
+    ota.log.addHandler(handler)
+
+    def work(item):
+        if item == "bad":
+            raise ValueError("broken image")
+        done.append(item)
+
+    try:
+        worker = ota.BackgroundWorker("test-worker", work)
+        worker.put("bad")
+        worker.put("good")
+        worker.join()
+    finally:
+        ota.log.removeHandler(handler)
+    assert done == ["good"]
+    assert [(r.getMessage(), r.fields["worker"], r.fields["item"]) for r in records] == \
+        [("background_job_failed", "test-worker", "bad")]
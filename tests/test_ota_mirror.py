@@ -0,0 +1,90 @@
+import hashlib
+import http.server
+import json
+import threading
+
+import pytest
+
+import ota
+import ota_mirror
+
+APP = bytes([ota.ESP_IMAGE_MAGIC]) + bytes(23) + b"\x11" * 5000
+PARTITIONS = b"\xaa\x50" + bytes(3070)
+
+
+class ReleaseServer(http.server.ThreadingHTTPServer):
+    """Stand-in for the two GitHub endpoints the mirror uses"""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ReleaseHandler)
+        self.assets = {1: ("firmware.bin", APP), 2: ("partitions.bin", PARTITIONS)}
+        self.etag = '"v1"'
+        self.requests = []
+
+
+class ReleaseHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path == "/repos/o/r/releases/latest":
+            if self.headers.get("If-None-Match") == self.server.etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = json.dumps({"tag_name": "v1.0", "assets": [
+                {"id": asset_id, "name": name, "size": len(data)}
+                for asset_id, (name, data) in self.server.assets.items()]}).encode()
+            self.send_response(200)
+            self.send_header("ETag", self.server.etag)
+        elif self.path.startswith("/repos/o/r/releases/assets/"):
+            _name, body = self.server.assets[int(self.path.rsplit("/", 1)[1])]
+            self.send_response(200)
+        else:
+            self.send_error(404)
+            return
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ReleaseServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def mirror(tmp_path, server):
+    folder = tmp_path / "firmware"
+    folder.mkdir()
+    catalog = ota.FirmwareCatalog(str(tmp_path / "laundry.db"), str(folder))
+    return ota_mirror.ReleaseMirror(catalog, api=f"http://127.0.0.1:{server.server_port}", owner="o", repo="r",
+                                    token="")
+
+
+def test_sync_skips_assets_that_are_not_app_images(mirror):
+    result = mirror.sync()
+    assert result == {"release": "v1.0", "changed": True, "assets": 1, "fetched": 1,
+                      "skipped": ["partitions.bin"]}
+    latest = mirror.latest()
+    assert latest["version"] == "v1.0"
+    assert latest["sha256"] == hashlib.sha256(APP).hexdigest()
+    assert [entry["filename"] for entry in mirror.catalog.list()] == [latest["filename"]]
+
+
+def test_unchanged_release_is_not_downloaded_again(mirror, server):
+    mirror.sync()
+    asked = len(server.requests)
+    assert mirror.sync() == {"release": "v1.0", "changed": False}
+    assert server.requests[asked:] == ["/repos/o/r/releases/latest"]
+
+    # A new ETag re-reads the release but fetches neither the stored nor the refused asset
+    server.etag = '"v2"'
+    assert mirror.sync()["fetched"] == 0
+    assert not any("/assets/" in path for path in server.requests[asked + 1:])
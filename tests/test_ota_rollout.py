@@ -0,0 +1,158 @@
+import os
+import sqlite3
+
+import pytest
+
+import ota
+import ota_rollout
+
+
+def add_image(catalog, name, uploaded_at):
+    data = bytes([ota.ESP_IMAGE_MAGIC]) + bytes(23) + os.urandom(64)
+    with open(os.path.join(catalog.folder, name), "wb") as f:
+        f.write(data)
+    entry = catalog.add(name, len(data), ota.file_sha256(os.path.join(catalog.folder, name)))
+    entry["uploaded_at"] = uploaded_at
+    return entry
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    folder = tmp_path / "firmware"
+    folder.mkdir()
+    catalog = ota.FirmwareCatalog(str(tmp_path / "laundry.db"), str(folder))
+    add_image(catalog, "old.bin", "2025-01-01T00:00:00")
+    add_image(catalog, "new.bin", "2025-02-01T00:00:00")
+    return catalog
+
+
+@pytest.fixture
+def rollouts(catalog):
+    return ota_rollout.RolloutController(catalog, max_concurrent=2, waves="10,50,100", wave_minutes=0)
+
+
+def devices(rollout, inside, count=20):
+    """Device ids whose bucket is inside (or outside) the rollout's current wave"""
+    found = []
+    for i in range(10000):
+        device = f"esp-{i}"
+        if (ota_rollout.device_bucket(rollout["id"], device) < rollout["percent"]) == inside:
+            found.append(device)
+            if len(found) == count:
+                break
+    return found
+
+
+def backdate(rollouts):
+    """Move every report so far into an earlier second than the next resume"""
+    conn = sqlite3.connect(rollouts.catalog.db_path)
+    conn.execute("UPDATE rollout_device SET updated_at = '2000-01-01T00:00:00'")
+    conn.commit()
+    conn.close()
+
+
+def test_start_picks_the_previous_image_as_base(rollouts):
+    rollout = rollouts.start("new.bin")
+    assert rollout["base"] == "old.bin"
+    assert rollout["percent"] == 10
+
+
+def test_resolve_offers_the_target_only_inside_the_wave(rollouts):
+    rollout = rollouts.start("new.bin")
+    assert all(rollouts.resolve("new.bin", d) == "new.bin" for d in devices(rollout, True))
+    assert all(rollouts.resolve("new.bin", d) == "old.bin" for d in devices(rollout, False))
+    assert rollouts.status()[0]["devices"]["assigned"] == 20
+
+
+def test_admit_caps_concurrent_downloads(rollouts):
+    rollout = rollouts.start("new.bin")
+    first, second, third = devices(rollout, True, 3)
+    release = rollouts.admit("new.bin", first)
+    rollouts.admit("new.bin", second)
+    with pytest.raises(ota_rollout.RolloutBusy):
+        rollouts.admit("new.bin", third)
+    release()
+    assert rollouts.admit("new.bin", third) is not None
+    assert rollouts.admit("old.bin", third) is None
+
+
+def test_advance_moves_through_every_wave_to_completion(rollouts):
+    rollout = rollouts.start("new.bin")
+    assert rollouts.advance() == {"advanced": ["1:50%"], "completed": []}
+    assert rollouts.advance() == {"advanced": ["1:100%"], "completed": []}
+    assert rollouts.admit("new.bin", devices(rollout, True, 1)[0]) is not None
+    assert rollouts.advance() == {"advanced": [], "completed": [1]}
+    assert rollout["state"] == "completed"
+    # Served like any other image again: no wave, no download cap, no device id needed
+    assert rollouts.status() == []
+    assert rollouts.resolve("new.bin", None) == "new.bin"
+    assert rollouts.admit("new.bin") is None
+    assert ota_rollout.RolloutController(rollouts.catalog).get(rollout["id"]) is None
+    assert rollouts.advance() == {"advanced": [], "completed": []}
+
+
+def test_rollout_ending_below_100_percent_stays_at_its_last_wave(rollouts):
+    rollout = rollouts.start("new.bin", waves="10,50")
+    rollouts.advance()
+    assert rollouts.advance() == {"advanced": [], "completed": []}
+    assert rollout["state"] == "active" and rollout["percent"] == 50
+
+
+def test_failures_pause_the_rollout(rollouts, monkeypatch):
+    monkeypatch.setattr(ota_rollout, "ROLLOUT_MIN_REPORTS", 100)
+    monkeypatch.setattr(ota_rollout, "ROLLOUT_MAX_FAILURES", 2)
+    rollout = rollouts.start("new.bin")
+    first, second = devices(rollout, True, 2)
+    rollouts.report(first, rollout["target_sha256"], False)
+    assert rollout["state"] == "active"
+    rollouts.report(second, rollout["target_sha256"], False)
+    assert rollout["state"] == "paused"
+    with pytest.raises(ota_rollout.RolloutBusy):
+        rollouts.admit("new.bin", first)
+    # The pause is persisted
+    reloaded = ota_rollout.RolloutController(rollouts.catalog)
+    assert reloaded.get(rollout["id"])["state"] == "paused"
+
+
+def test_admit_rejects_devices_outside_the_wave(rollouts):
+    rollout = rollouts.start("new.bin")
+    outside = devices(rollout, False, 1)[0]
+    with pytest.raises(ota_rollout.RolloutBusy):
+        rollouts.admit("new.bin", outside)
+    with pytest.raises(ota_rollout.RolloutBusy):
+        rollouts.admit("new.bin")
+    # Nothing was reserved or recorded for them
+    assert rollouts.status()[0]["downloading"] == 0
+    assert rollouts.status()[0]["devices"]["downloading"] == 0
+
+
+def test_resume_is_not_undone_by_earlier_failures(rollouts, monkeypatch):
+    monkeypatch.setattr(ota_rollout, "ROLLOUT_MIN_REPORTS", 100)
+    monkeypatch.setattr(ota_rollout, "ROLLOUT_MAX_FAILURES", 2)
+    rollout = rollouts.start("new.bin", waves="100")
+    failing, other, succeeding, failing_again = devices(rollout, True, 4)
+    rollouts.report(failing, rollout["target_sha256"], False)
+    rollouts.report(other, rollout["target_sha256"], False)
+    assert rollout["state"] == "paused"
+
+    # Reports from before the resume no longer count
+    backdate(rollouts)
+    rollouts.set_state(rollout["id"], "resume")
+    rollouts.report(succeeding, rollout["target_sha256"], True)
+    assert rollout["state"] == "active"
+    rollouts.report(failing_again, rollout["target_sha256"], False)
+    assert rollout["state"] == "active"
+    rollouts.report(failing, rollout["target_sha256"], False)
+    assert rollout["state"] == "paused"
+
+
+def test_success_reports_never_pause(rollouts, monkeypatch):
+    monkeypatch.setattr(ota_rollout, "ROLLOUT_MAX_FAILURES", 1)
+    rollout = rollouts.start("new.bin", waves="100")
+    first, second = devices(rollout, True, 2)
+    rollouts.report(first, rollout["target_sha256"], False)
+    assert rollout["state"] == "paused"
+    backdate(rollouts)
+    rollouts.set_state(rollout["id"], "resume")
+    rollouts.report(second, rollout["target_sha256"], True)
+    assert rollout["state"] == "active"
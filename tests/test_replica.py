@@ -0,0 +1,44 @@
+import sqlite3
+import time
+
+import replica
+
+
+def make_replica(tmp_path, **options):
+    db_path = str(tmp_path / "laundry.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE USERS (card_id TEXT, balance INTEGER)")
+    conn.execute("INSERT INTO USERS VALUES ('A', 5)")
+    conn.commit()
+    conn.close()
+    return replica.ReadReplica(db_path, str(tmp_path / "replica.db"), **options)
+
+
+def test_disabled_or_fresh_reads_use_the_primary(tmp_path):
+    disabled = make_replica(tmp_path, enabled=False)
+    assert disabled.source() == (disabled.db_path, 0.0)
+    enabled = replica.ReadReplica(disabled.db_path, disabled.replica_path, enabled=True)
+    enabled.refresh()
+    assert enabled.source(fresh=True) == (enabled.db_path, 0.0)
+
+
+def test_recent_snapshot_is_served_with_its_age(tmp_path):
+    reader = make_replica(tmp_path, enabled=True, max_staleness=30)
+    reader.refresh()
+    path, age = reader.source()
+    assert path == reader.replica_path
+    assert 0 <= age < 30
+    conn = reader.connect(path)
+    assert conn.execute("SELECT balance FROM USERS").fetchone() == (5,)
+    conn.close()
+
+
+def test_stale_snapshot_falls_back_to_the_primary(tmp_path):
+    reader = make_replica(tmp_path, enabled=True, max_staleness=30)
+    reader.refresh()
+    reader.refreshed_at = time.time() - 60
+    reader.refresh_lock.acquire()    # keep the background refresh from racing the assertion
+    try:
+        assert reader.source() == (reader.db_path, 0.0)
+    finally:
+        reader.refresh_lock.release()
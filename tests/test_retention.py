@@ -0,0 +1,113 @@
+import os
+import sqlite3
+
+import retention
+
+
+def make_db(tmp_path, hot_rows):
+    db_path = str(tmp_path / "laundry.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute('''CREATE TABLE logs (id INTEGER PRIMARY KEY, card_id TEXT, username TEXT,
+                                       action TEXT, balance INTEGER, timestamp DATETIME)''')
+    conn.executemany("INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?)", hot_rows)
+    retention.init_summary_table(conn)
+    conn.commit()
+    conn.close()
+    return db_path
+
+
+def make_archive(db_path, month, rows):
+    path = retention.archive_path(month, db_path)
+    retention._ensure_archive(path)
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def test_query_logs_reads_more_archives_than_can_be_attached(tmp_path):
+    db_path = make_db(tmp_path, [(1000, "A", "u", "Used 1 coin", 5, "2025-01-15 10:00:00")])
+    (tmp_path / "archive").mkdir()
+    months = [f"2023-{m:02d}" for m in range(1, 13)] + ["2024-01", "2024-02"]
+    assert len(months) > retention.MAX_ATTACHED
+    for i, month in enumerate(months):
+        make_archive(db_path, month, [(i + 1, "A", "u", "Used 1 coin", i, f"{month}-10 12:00:00")])
+
+    rows = retention.query_logs(db_path, limit=100)
+
+    assert [row[0] for row in rows] == [1000] + list(range(len(months), 0, -1))
+    # The oldest archive is still reachable
+    assert rows[-1][5] == "2023-01-10 12:00:00"
+
+
+def test_query_logs_limit_and_filters_across_batches(tmp_path):
+    db_path = make_db(tmp_path, [])
+    (tmp_path / "archive").mkdir()
+    months = [f"2023-{m:02d}" for m in range(1, 13)]
+    for i, month in enumerate(months):
+        make_archive(db_path, month, [(2 * i + 1, "A", "u", "x", 0, f"{month}-01 00:00:00"),
+                                      (2 * i + 2, "B", "u", "x", 0, f"{month}-02 00:00:00")])
+
+    newest = retention.query_logs(db_path, limit=3)
+    assert [row[0] for row in newest] == [24, 23, 22]
+
+    card_a = retention.query_logs(db_path, card_id="A", limit=100)
+    assert [row[0] for row in card_a] == list(range(23, 0, -2))
+
+    ranged = retention.query_logs(db_path, start="2023-02-01", end="2023-04-01", limit=100)
+    assert [row[0] for row in ranged] == [6, 5, 4, 3]
+
+
+def test_connect_reporting_refuses_too_many_archives(tmp_path):
+    db_path = make_db(tmp_path, [])
+    archives = [(f"2023-{m:02d}", "unused") for m in range(1, retention.MAX_ATTACHED + 2)]
+    try:
+        retention.connect_reporting(db_path, archives)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("attached more than MAX_ATTACHED archives")
+
+
+def test_run_retention_moves_old_rows_into_monthly_archives(tmp_path):
+    db_path = make_db(tmp_path, [(1, "A", "u", "Used 2 coins", 8, "2020-03-01 08:00:00"),
+                                 (2, "A", "u", "Balance added +5", 13, "2020-04-01 08:00:00"),
+                                 (3, "A", "u", "Used 1 coin", 12, "2999-01-01 08:00:00")])
+
+    assert retention.run_retention(db_path, days=30, pause=0) == 2
+
+    assert [a[0] for a in retention.list_archives(db_path)] == ["2020-03", "2020-04"]
+    conn = sqlite3.connect(db_path)
+    assert [r[0] for r in conn.execute("SELECT id FROM logs")] == [3]
+    summary = conn.execute("SELECT day, entries, coins_used, coins_added FROM log_daily_summary "
+                           "ORDER BY day").fetchall()
+    conn.close()
+    assert summary == [("2020-03-01", 1, 2, 0), ("2020-04-01", 1, 0, 5)]
+    assert [row[0] for row in retention.query_logs(db_path)] == [3, 2, 1]
+
+
+def test_daily_report_groups_hot_rows_in_sql_and_merges_the_summary(tmp_path):
+    rows = [(1, "A", "u", "Used 2 coins", 8, "2020-03-01 08:00:00"),
+            (2, "A", "u", "Used 1 hour(s) - 1 coin(s)", 7, "2999-01-01 08:00:00"),
+            (3, "A", "u", "Balance added +5", 12, "2999-01-01 09:00:00"),
+            (4, "B", "v", "Used 3 coins", 0, "2999-01-01 10:00:00"),
+            (5, "A", "u", "Used 1 coin", 11, "2999-01-02 08:00:00")]
+    db_path = make_db(tmp_path, rows)
+    retention.run_retention(db_path, days=30, pause=0)
+
+    report = retention.daily_report(db_path)
+    assert report == [("2999-01-02", "A", "u", 1, 1, 0, 11),
+                      ("2999-01-01", "B", "v", 1, 3, 0, 0),
+                      ("2999-01-01", "A", "u", 2, 1, 5, 12),
+                      ("2020-03-01", "A", "u", 1, 2, 0, 8)]
+    # Same totals as folding the rows in Python
+    hot = retention._summarize(rows[1:])
+    assert {(day, card): list(values) for day, card, *values in report[:3]} == hot
+
+    assert retention.daily_report(db_path, card_id="A", start="2999-01-01", end="2999-01-02") == \
+        [("2999-01-01", "A", "u", 2, 1, 5, 12)]
+
+
+def test_default_paths_follow_db_dir(web):
+    assert retention.DB_PATH == web.DB_PATH
+    assert retention.archive_dir() == os.path.join(web.DB_DIR, "archive")
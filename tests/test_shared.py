@@ -0,0 +1,89 @@
+import signal
+import os
+import subprocess
+import sys
+import time
+
+import shared
+
+
+def test_leases_cap_each_key():
+    leases = shared.Leases(count=4)
+    first = leases.acquire(1, 2, 60)
+    assert leases.acquire(1, 2, 60) is not None
+    assert leases.acquire(1, 2, 60) is None
+    assert leases.acquire(2, 2, 60) is not None
+    assert leases.held(1) == 2 and leases.held() == 3
+    leases.release(first)
+    leases.release(first)    # a second release must not free someone else's lease
+    assert leases.held(1) == 1
+    assert leases.acquire(1, 2, 60) is not None
+    assert leases.acquire(3, 9, 60) is not None
+    assert leases.acquire(4, 9, 60) is None    # all four leases taken
+
+
+def test_expired_and_orphaned_leases_are_taken_back():
+    leases = shared.Leases(count=2)
+    index, _ = leases.acquire(1, 2, 60)
+    shared._LEASE.pack_into(leases.buffer, index * shared._LEASE.size, 1, os.getpid(), time.time() - 120)
+    child = subprocess.Popen([sys.executable, "-c", "pass"])
+    child.wait()
+    shared._LEASE.pack_into(leases.buffer, (1 - index) * shared._LEASE.size, 1, child.pid, time.time())
+    assert leases.held(1) == 2
+    assert leases.acquire(1, 1, 60) is not None
+    assert leases.held(1) == 1
+
+
+def test_downloads_are_shared_with_forked_workers():
+    token = shared.DOWNLOADS.acquire(7, 5, 60)
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if shared.DOWNLOADS.held(7) == 1 and shared.DOWNLOADS.acquire(7, 1, 60) is None else 1)
+    _, status = os.waitpid(pid, 0)
+    shared.DOWNLOADS.release(token)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert shared.DOWNLOADS.held(7) == 0
+
+
+def locked_in_child(lock, then):
+    """Fork a child that takes `lock` and then calls `then`; returns once it holds the lock"""
+    ready_r, ready_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        lock.__enter__()
+        os.write(ready_w, b"x")
+        then()
+        os._exit(0)
+    os.read(ready_r, 1)
+    os.close(ready_r)
+    os.close(ready_w)
+    return pid
+
+
+def test_lock_of_a_killed_worker_is_released():
+    lock = shared.SharedLock(timeout=5)
+    pid = locked_in_child(lock, lambda: os.kill(os.getpid(), signal.SIGKILL))
+    os.waitpid(pid, 0)
+    started = time.monotonic()
+    with lock:
+        pass
+    assert time.monotonic() - started < 1
+    assert lock.bypassed == 0
+
+
+def test_hung_holder_is_bypassed_after_the_timeout():
+    lock = shared.SharedLock(timeout=0.2)
+    pid = locked_in_child(lock, lambda: time.sleep(30))
+    try:
+        started = time.monotonic()
+        with lock:
+            pass
+        assert 0.2 <= time.monotonic() - started < 2
+        assert lock.bypassed == 1
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    # Usable again once the holder is gone
+    with lock:
+        pass
+    assert lock.bypassed == 1
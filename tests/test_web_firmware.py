@@ -0,0 +1,67 @@
+import io
+
+import pytest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wsgi import FileWrapper
+
+import ota
+
+
+class ServerFileWrapper(FileWrapper):
+    """Stands in for a server's wsgi.file_wrapper, which it would send with sendfile()"""
+
+
+def call(web, path, headers=None):
+    environ = EnvironBuilder(path=path, headers=headers or {}).get_environ()
+    environ["wsgi.file_wrapper"] = ServerFileWrapper
+    started = []
+    body = web.app(environ, lambda status, response_headers, exc_info=None: started.append(status))
+    return started[0], body
+
+
+@pytest.fixture
+def rollout(web):
+    data = bytes([ota.ESP_IMAGE_MAGIC]) + bytes(23) + b"\x5a" * 200000
+    client = web.app.test_client()
+    response = client.post("/upload_firmware", data={"firmware": (io.BytesIO(data), "rollout.bin")},
+                           content_type="multipart/form-data")
+    name = response.get_json()["filename"]
+    rollout = web.firmware_rollouts.start(name, waves="100", max_concurrent=1)
+    yield name, rollout, data
+    web.firmware_rollouts.set_state(rollout["id"], "cancel")
+
+
+def downloading(web, rollout):
+    return web.firmware_rollouts.leases.held(rollout["id"])
+
+
+@pytest.mark.parametrize("headers, status", [({}, "200 OK"), ({"Range": "bytes=100-"}, "206 PARTIAL CONTENT")])
+def test_rollout_download_keeps_the_file_wrapper_and_frees_its_slot(web, rollout, headers, status):
+    name, rollout, data = rollout
+    answered, body = call(web, f"/firmware/{name}", dict(headers, **{"X-Device-Id": "esp-1"}))
+    assert answered == status
+    if not headers:
+        # Passed through to the server untouched, so it can use sendfile()
+        assert isinstance(body, ServerFileWrapper)
+    assert b"".join(body) == (data[100:] if headers else data)
+    assert downloading(web, rollout) == 1
+    body.close()
+    assert downloading(web, rollout) == 0
+
+
+@pytest.mark.parametrize("body, content_type", [("not json", "text/plain"), ("[1]", "application/json"),
+                                                ('{"sha256": 5}', "application/json")])
+def test_malformed_update_reports_are_rejected(web, body, content_type):
+    response = web.app.test_client().post("/api/firmware/report", data=body, content_type=content_type,
+                                          headers={"X-Device-Id": "esp-1"})
+    assert response.status_code == 400
+
+
+def test_revalidated_download_frees_its_slot(web, rollout):
+    name, rollout, _data = rollout
+    etag = web.firmware_catalog.get(name)["sha256"]
+    answered, body = call(web, f"/firmware/{name}", {"X-Device-Id": "esp-2", "If-None-Match": f'"{etag}"'})
+    assert answered == "304 NOT MODIFIED"
+    list(body)
+    body.close()
+    assert downloading(web, rollout) == 0
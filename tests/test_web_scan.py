@@ -0,0 +1,42 @@
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def card(web):
+    conn = sqlite3.connect(web.DB_PATH)
+    conn.execute("INSERT OR REPLACE INTO USERS (username, card_id, balance) VALUES ('scan-user', 'SCAN1', 10)")
+    conn.commit()
+    conn.close()
+    return "SCAN1"
+
+
+def balance(web, card_id):
+    conn = sqlite3.connect(web.DB_PATH)
+    try:
+        return conn.execute("SELECT balance FROM USERS WHERE card_id = ?", (card_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("coins", [-5, "1", True, 1.5, None])
+def test_scan_with_invalid_coins_is_rejected_before_the_debit(web, card, coins):
+    response = web.app.test_client().post("/scan_card", json={"card_id": card, "coins": coins})
+    assert response.status_code == 400
+    assert response.get_json()["activate_machine"] is False
+    assert balance(web, card) == 10
+
+
+def test_scan_without_coins_only_shows_the_balance(web, card):
+    response = web.app.test_client().post("/scan_card", json={"card_id": card})
+    assert response.status_code == 200
+    assert response.get_json()["balance"] == 10
+    assert balance(web, card) == 10
+
+
+@pytest.mark.parametrize("cost", [0, -1, "2", True])
+def test_debit_card_refuses_non_positive_or_non_integer_costs(web, card, cost):
+    with pytest.raises(ValueError):
+        web.debit_card(card, cost)
+    assert balance(web, card) == 10
@@ -0,0 +1,324 @@
+"""
+Lightweight per-request tracing.
+
+A sampled request gets a root span, and the handlers open child spans
+with span("name") around the steps worth timing (JSON parse, user
+lookup, debit, log write, ...). Every span carries the applog request
+id, so a trace lines up with the log events of the same request.
+
+Finished traces go on a bounded queue; one exporter thread appends them
+to a JSONL file (TRACE_EXPORTER=jsonl) or POSTs them as OTLP/HTTP JSON to
+a local collector (TRACE_EXPORTER=otlp). A full queue drops traces
+instead of blocking the request.
+
+Sampling is decided once per request (TRACE_SAMPLE_RATE). With slow_ms
+set, only sampled requests at least that slow are exported, which keeps
+the p99 tail without the bulk of fast requests. An unsampled request
+costs one random() call, and each span() in it one context lookup.
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from collections import deque
+from datetime import datetime
+
+import applog
+
+# Tracing configuration
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0))
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", 0))
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "jsonl")
+TRACE_FILE = os.environ.get("TRACE_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs",
+                                                       "traces.jsonl"))
+TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT", "http://127.0.0.1:4318/v1/traces")
+TRACE_QUEUE_SIZE = 1000
+SERVICE_NAME = "laundry-web"
+# Recent durations kept per span name for the percentiles in status()
+SUMMARY_WINDOW = 1000
+
+log = applog.get_logger("tracing")
+_current = contextvars.ContextVar("trace_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "attributes", "start_ns", "duration_ns",
+                 "_started", "_token")
+
+    def __init__(self, trace, name, parent_id=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.start_ns = 0
+        self.duration_ns = 0
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._started = time.perf_counter_ns()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration_ns = time.perf_counter_ns() - self._started
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # Finished from another context (a streamed response's teardown)
+            _current.set(None)
+        self.trace.spans.append(self)
+
+    def to_dict(self):
+        return {"trace_id": self.trace.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+                "request_id": self.trace.request_id, "name": self.name,
+                "start": datetime.fromtimestamp(self.start_ns / 1e9).isoformat(timespec="microseconds"),
+                "duration_ms": round(self.duration_ns / 1e6, 3), "attributes": self.attributes}
+
+
+class _NoopSpan:
+    """Returned by span() outside a sampled request"""
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    __slots__ = ("trace_id", "request_id", "spans")
+
+    def __init__(self, request_id=None):
+        self.trace_id = uuid.uuid4().hex
+        self.request_id = request_id
+        self.spans = []
+
+
+def span(name, **attributes):
+    """Child span of the current span; a no-op when the request is not traced"""
+    parent = _current.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+
+class JsonlExporter:
+    """One JSON object per span, appended to a local file"""
+
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+
+    def export(self, traces):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            for trace in traces:
+                for s in trace.spans:
+                    f.write(json.dumps(s.to_dict(), default=str, ensure_ascii=False) + "\n")
+
+
+class OtlpExporter:
+    """OTLP/HTTP JSON to a collector (an OpenTelemetry Collector, Jaeger or Tempo on localhost)"""
+
+    def __init__(self, endpoint=TRACE_OTLP_ENDPOINT, service=SERVICE_NAME, timeout=5):
+        self.endpoint = endpoint
+        self.service = service
+        self.timeout = timeout
+
+    @staticmethod
+    def _attributes(values):
+        attributes = []
+        for key, value in values.items():
+            if isinstance(value, bool):
+                attributes.append({"key": key, "value": {"boolValue": value}})
+            elif isinstance(value, int):
+                attributes.append({"key": key, "value": {"intValue": str(value)}})
+            elif isinstance(value, float):
+                attributes.append({"key": key, "value": {"doubleValue": value}})
+            else:
+                attributes.append({"key": key, "value": {"stringValue": str(value)}})
+        return attributes
+
+    def payload(self, traces):
+        spans = []
+        for trace in traces:
+            for s in trace.spans:
+                attributes = dict(s.attributes)
+                if trace.request_id:
+                    attributes["request_id"] = trace.request_id
+                item = {"traceId": trace.trace_id, "spanId": s.span_id, "name": s.name,
+                        "kind": 2 if s.parent_id is None else 1,
+                        "startTimeUnixNano": str(s.start_ns), "endTimeUnixNano": str(s.start_ns + s.duration_ns),
+                        "attributes": self._attributes(attributes)}
+                if s.parent_id:
+                    item["parentSpanId"] = s.parent_id
+                spans.append(item)
+        return {"resourceSpans": [{
+            "resource": {"attributes": self._attributes({"service.name": self.service})},
+            "scopeSpans": [{"scope": {"name": "laundry.tracing"}, "spans": spans}]
+        }]}
+
+    def export(self, traces):
+        body = json.dumps(self.payload(traces)).encode()
+        req = urllib.request.Request(self.endpoint, data=body, method="POST",
+                                     headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            resp.read()
+
+
+def make_exporter(kind=TRACE_EXPORTER):
+    if kind == "otlp":
+        return OtlpExporter()
+    if kind == "jsonl":
+        return JsonlExporter()
+    raise ValueError("TRACE_EXPORTER must be jsonl or otlp")
+
+
+class Tracer:
+    def __init__(self, exporter=None, sample_rate=TRACE_SAMPLE_RATE, slow_ms=TRACE_SLOW_MS,
+                 batch_size=100, flush_interval=1.0):
+        self.exporter = exporter or make_exporter()
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue(TRACE_QUEUE_SIZE)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.durations = {}      # span name -> recent durations (ms)
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def configure(self, sample_rate=None, slow_ms=None):
+        if sample_rate is not None and not 0 <= float(sample_rate) <= 1:
+            raise ValueError("sample_rate must be between 0 and 1")
+        if sample_rate is not None:
+            self.sample_rate = float(sample_rate)
+        if slow_ms is not None:
+            self.slow_ms = float(slow_ms)
+        return self.settings()
+
+    def settings(self):
+        return {"sample_rate": self.sample_rate, "slow_ms": self.slow_ms,
+                "exporter": type(self.exporter).__name__}
+
+    def start(self, name, request_id=None, **attributes):
+        """Root span for a request if it is sampled, else None"""
+        if not self.sample_rate or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return None
+        root = Span(Trace(request_id), name, None, attributes)
+        root.__enter__()
+        return root
+
+    def finish(self, root):
+        root.__exit__(None, None, None)
+        if root.duration_ns / 1e6 < self.slow_ms:
+            return
+        with self.lock:
+            for s in root.trace.spans:
+                recent = self.durations.get(s.name)
+                if recent is None:
+                    recent = self.durations[s.name] = deque(maxlen=SUMMARY_WINDOW)
+                recent.append(s.duration_ns / 1e6)
+        try:
+            self.pending.put_nowait(root.trace)
+        except queue.Full:
+            self.dropped += 1
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._export_loop, name="trace-exporter", daemon=True)
+                self.thread.start()
+
+    def _export_loop(self):
+        while True:
+            try:
+                batch = [self.pending.get(timeout=5)]
+            except queue.Empty:
+                return
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.pending.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.exporter.export(batch)
+                self.exported += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                applog.event(log, logging.WARNING, "trace_export_failed", traces=len(batch), error=str(e),
+                             exporter=type(self.exporter).__name__)
+            finally:
+                for _ in batch:
+                    self.pending.task_done()
+
+    def flush(self):
+        """Wait until every queued trace has been exported"""
+        self.pending.join()
+
+    def summary(self):
+        """p50/p99 per span name over the recent exported traces"""
+        with self.lock:
+            items = [(name, sorted(recent)) for name, recent in self.durations.items()]
+        steps = []
+        for name, values in items:
+            count = len(values)
+            steps.append({"span": name, "count": count, "p50_ms": round(values[count // 2], 3),
+                          "p99_ms": round(values[min(count - 1, int(count * 0.99))], 3),
+                          "max_ms": round(values[-1], 3)})
+        return sorted(steps, key=lambda step: step["p99_ms"], reverse=True)
+
+    def status(self):
+        return dict(self.settings(), exported=self.exported, dropped=self.dropped, failed=self.failed,
+                    queued=self.pending.qsize(), steps=self.summary())
+
+
+def instrument(app, tracer):
+    """Trace sampled requests of a Flask app; call after applog.instrument()"""
+    from flask import request
+
+    @app.before_request
+    def _start_trace():
+        if not tracer.sample_rate:
+            return
+        rule = request.url_rule
+        root = tracer.start(f"{request.method} {rule.rule if rule else 'unmatched'}",
+                            request_id=applog.request_id.get(), method=request.method)
+        if root:
+            request.environ["tracing.root"] = root
+
+    @app.after_request
+    def _record_status(response):
+        root = request.environ.get("tracing.root")
+        if root:
+            root.set(status=response.status_code)
+        return response
+
+    @app.teardown_request
+    def _finish_trace(error=None):
+        root = request.environ.pop("tracing.root", None)
+        if root:
+            if error is not None:
+                root.set(error=type(error).__name__)
+            tracer.finish(root)
+
+    return app
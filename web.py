@@ -1,22 +1,131 @@
-from flask import Flask, request, render_template_string, redirect, jsonify, send_from_directory
+from flask import Flask, request, render_template, redirect, jsonify, send_from_directory
 import sqlite3
 import os
+import atexit
+import logging
+import functools
+import hmac
+import threading
+import time
 from datetime import datetime
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+import retention
+import backup
+import maintenance
+import replica
+import balance_engine
+import ota
+import ota_mirror
+import ota_delta
+import ota_compress
+import ota_rollout
+import ota_retention
+import metrics
+import profiling
+import applog
+import tracing
+import querylog
+import memprofile
+import capture
+import shared
 
 app = Flask(__name__)
+# JSON events with a request id, written by a background thread (LOG_LEVEL, LOG_FILE)
+applog.configure()
+applog.instrument(app)
+log = applog.get_logger("web")
+
+# Request, database and business counters at /metrics
+metrics.instrument(app)
+# Sampled or cProfile'd requests, switched on at runtime through /api/profiling
+profiler = profiling.RequestProfiler()
+profiling.instrument(app, profiler)
+# Sampled spans through the transaction path (TRACE_SAMPLE_RATE, TRACE_EXPORTER)
+tracer = tracing.Tracer()
+tracing.instrument(app, tracer)
+# /scan_card traffic recorded for replay (SCAN_CAPTURE=1 or /api/capture)
+scan_recorder = capture.ScanRecorder()
+capture.instrument(app, scan_recorder)
+
+# Admin endpoints want X-Admin-Token: $ADMIN_TOKEN; without a token only localhost may call them
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
 
 # Database configuration
-DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database")
+DB_DIR = os.environ.get("DB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "database"))
 DB_PATH = os.path.join(DB_DIR, "laundry.db")
 
 # OTA Upload configuration
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "firmware")
+UPLOAD_FOLDER = os.environ.get("FIRMWARE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "firmware"))
 ALLOWED_EXTENSIONS = {'bin'}
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Reject oversized bodies before Werkzeug reads them (multipart overhead allowed for)
+app.config['MAX_CONTENT_LENGTH'] = ota.MAX_FIRMWARE_SIZE + ota.CHUNK_SIZE
+# Stored images never change, so devices may reuse them; the ETag covers revalidation
+FIRMWARE_MAX_AGE = 3600
+# Let a fronting proxy (nginx/apache) send firmware files itself
+app.config['USE_X_SENDFILE'] = os.environ.get("USE_X_SENDFILE", "0") == "1"
+
+# Metadata for uploaded firmware, loaded on first use (and again after another worker changed it)
+firmware_catalog = ota.FirmwareCatalog(DB_PATH, UPLOAD_FOLDER, generation=shared.generation("firmware"))
+
+# bsdiff patches between consecutive images, generated in the background after each upload
+firmware_deltas = ota_delta.DeltaStore(firmware_catalog)
+firmware_catalog.on_add.append(firmware_deltas.schedule)
+
+# gzip copy of every image for devices that send Accept-Encoding: gzip
+firmware_artifacts = ota_compress.CompressedArtifacts(firmware_catalog)
+firmware_catalog.on_add.append(firmware_artifacts.schedule)
+
+# Percentage waves and a download budget for new images (ROLLOUT_AUTO=1 starts one per upload)
+firmware_rollouts = ota_rollout.RolloutController(firmware_catalog, generation=shared.generation("rollout"),
+                                                  leases=shared.DOWNLOADS)
+if ota_rollout.ROLLOUT_AUTO:
+    firmware_catalog.on_add.append(lambda entry: firmware_rollouts.start(entry['filename']))
+
+# Copies GitHub releases into the catalog (GITHUB_MIRROR=1) so devices update from the LAN
+release_mirror = ota_mirror.ReleaseMirror(firmware_catalog)
 
-# Server-side cache for last scanned RFID data
-LAST_RFID = None
+# Keeps the newest FIRMWARE_KEEP images per board plus those devices still need
+firmware_retention = ota_retention.FirmwareRetention(firmware_catalog, firmware_deltas, firmware_artifacts,
+                                                     firmware_rollouts, release_mirror)
+
+# Seconds after startup before prewarm() fills caches that card scans do not need
+PREWARM_DELAY = float(os.environ.get("PREWARM_DELAY", 5))
+
+# Background database housekeeping (checkpoints, ANALYZE, vacuum, archival, backups)
+scheduler = maintenance.create_scheduler(DB_PATH, rate=maintenance.RequestRate(
+    maintenance.QUIET_WINDOW, *shared.request_counts(maintenance.QUIET_WINDOW)))
+scheduler.add_job("log_retention", lambda: {"archived": retention.run_retention(DB_PATH)},
+                  retention.ARCHIVE_SCHEDULE, quiet_only=True)
+scheduler.add_job("backup", lambda: {"snapshot": os.path.basename(backup.create_backup(DB_PATH))},
+                  backup.BACKUP_SCHEDULE, quiet_only=True)
+scheduler.add_job("rollout_advance", lambda: firmware_rollouts.advance(), "* * * * *")
+scheduler.add_job("firmware_gc", lambda: firmware_retention.run(), ota_retention.FIRMWARE_GC_SCHEDULE,
+                  quiet_only=True)
+
+# In-memory balances with a journal (BALANCE_ENGINE=1), opened in __main__
+balances = None
+
+# Snapshot of the database that serves heavy admin reads
+read_replica = replica.ReadReplica(DB_PATH, os.path.join(DB_DIR, "replica.db"), connect=metrics.connect)
+
+# tracemalloc snapshots on demand (/api/memory), plus the sizes of our own buffers and queues
+memory = memprofile.MemoryProfiler()
+memory.watch("last_scan", lambda: len(shared.LAST_SCAN))
+memory.watch("log_queue", applog.queued)
+memory.watch("trace_queue", lambda: tracer.pending.qsize())
+memory.watch("trace_durations", lambda: sum(len(recent) for recent in tracer.durations.values()))
+memory.watch("slow_query_log", lambda: len(querylog.SLOW_QUERIES.recent))
+memory.watch("metric_series", lambda: sum(len(m.values) for m in metrics.REGISTRY.metrics.values()))
+memory.watch("delta_queue", lambda: firmware_deltas.worker.pending.qsize())
+memory.watch("gzip_queue", lambda: firmware_artifacts.worker.pending.qsize())
+memory.watch("rollout_devices", lambda: sum(len(ids) for ids in firmware_rollouts.assigned.values()))
+memory.watch("rollout_slots", lambda: firmware_rollouts.leases.held())
+memory.watch("balance_cards", lambda: len(balances.cards) if balances else 0)
+memory.watch("journal_pending", lambda: len(balances.journal.pending) if balances else 0)
+memory.watch("maintenance_history", lambda: len(scheduler.history))
+memory.watch("jinja_cache", lambda: len(app.jinja_env.cache or {}))
 
 # HTML template with OTA section
 template = """
@@ -285,6 +394,7 @@ template = """
         <a onclick="showSection('show-logs')" id="link-show-logs">Transaction Logs</a>
         <a onclick="showSection('spending')" id="link-spending">Make Transaction</a>
         <a onclick="showSection('ota-update')" id="link-ota-update">🔧 OTA Update</a>
+        <a onclick="showSection('slow-queries')" id="link-slow-queries">🐢 Slow Queries</a>
     </div>
 
     <div class="content">
@@ -483,7 +593,7 @@ template = """
                     {% if firmware_files %}
                         {% for file in firmware_files %}
                         <li>
-                            <span>{{ file.name }} ({{ file.size }})</span>
+                            <span>{{ file.name }} ({{ file.size }}{% if file.version %}, v{{ file.version }}{% endif %}{% if file.board %}, {{ file.board }}{% endif %})</span>
                             <div>
                                 <button class="btn btn-small btn-danger" onclick="deleteFirmware('{{ file.name }}')">🗑️ Delete</button>
                             </div>
@@ -503,6 +613,37 @@ template = """
                 <p><strong>Alternative Method:</strong> You can also use Arduino IDE's "Network Port" feature</p>
             </div>
         </section>
+
+        <!-- Slow Queries Section -->
+        <section id="slow-queries">
+            <h2>🐢 Slow Queries</h2>
+            <div class="card">
+                <p>Statements slower than {{ slow_queries.threshold_ms }} ms since the last restart, by total time.</p>
+                <table>
+                    <tr>
+                        <th>Statement</th>
+                        <th>Count</th>
+                        <th>Avg / Max ms</th>
+                        <th>Rows</th>
+                        <th>Query Plan</th>
+                    </tr>
+                    {% for q in slow_queries.statements %}
+                    <tr>
+                        <td><code>{{ q.sql }}</code><br><small>params: {{ q.params }}</small></td>
+                        <td>{{ q.count }}</td>
+                        <td>{{ q.avg_ms }} / {{ q.max_ms }}</td>
+                        <td>{{ q.last_rows }}</td>
+                        <td>
+                            <pre style="margin: 0;">{{ (q.plan or ["(no plan)"]) | join("\n") }}</pre>
+                            {% for w in q.warnings %}<div class="alert alert-danger" style="margin: 5px 0 0; padding: 5px;">⚠️ {{ w }}</div>{% endfor %}
+                        </td>
+                    </tr>
+                    {% else %}
+                    <tr><td colspan="5">No slow queries recorded</td></tr>
+                    {% endfor %}
+                </table>
+            </div>
+        </section>
     </div>
 
     <script>
@@ -638,12 +779,23 @@ template = """
 </html>
 """
 
+@functools.cache
+def dashboard_template():
+    """The admin panel template, compiled once (render_template_string compiles it on every call)"""
+    return app.jinja_env.from_string(template)
+
 def init_db():
     """Initialize database with required tables"""
     os.makedirs(DB_DIR, exist_ok=True)
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
    
+    # Only takes effect on a new database; lets the scheduler vacuum incrementally
+    c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL lets backups and readers run without blocking card debits
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+   
     c.execute('''CREATE TABLE IF NOT EXISTS USERS (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         username TEXT NOT NULL,
@@ -660,49 +812,155 @@ def init_db():
         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
     )''')
    
+    # Daily summaries left behind by log archival
+    retention.init_summary_table(conn)
+   
     conn.commit()
     conn.close()
     print("✓ Database initialized at:", DB_PATH)
 
 def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(DB_PATH)
+    """Get database connection (statement and commit times go to /metrics)"""
+    conn = metrics.connect(DB_PATH)
     return conn
 
 def log_action(card_id, username, action, balance):
     """Log an action to the database"""
     try:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("INSERT INTO logs (card_id, username, action, balance) VALUES (?, ?, ?, ?)",
-                  (card_id, username, action, balance))
-        conn.commit()
-        conn.close()
+        with tracing.span("log_write"):
+            conn = get_db()
+            c = conn.cursor()
+            c.execute("INSERT INTO logs (card_id, username, action, balance) VALUES (?, ?, ?, ?)",
+                      (card_id, username, action, balance))
+            conn.commit()
+            conn.close()
         return True
     except Exception as e:
-        print("Error logging action:", e)
+        log.error("log_action_failed", exc_info=True, extra={"fields": {"card_id": card_id}})
         return False
 
+def scan_event(outcome, level=logging.INFO, **fields):
+    """Count a card scan outcome and log it as one structured event"""
+    metrics.SCAN_OUTCOMES.inc(outcome=outcome)
+    if log.isEnabledFor(level):
+        applog.event(log, level, "scan_card", outcome=outcome, latency_ms=applog.elapsed_ms(), **fields)
+
+def find_user(card_id):
+    """(username, balance) for a card, or None if it is not registered"""
+    if balances:
+        return balances.lookup(card_id)
+    conn = get_db()
+    try:
+        return conn.execute("SELECT username, balance FROM USERS WHERE card_id=?", (card_id,)).fetchone()
+    finally:
+        conn.close()
+
+def debit_card(card_id, cost):
+    """Deduct cost from a card. Returns the new balance, or None if it no longer covers the cost."""
+    if isinstance(cost, bool) or not isinstance(cost, int) or cost <= 0:
+        raise ValueError(f"cost must be a positive integer, not {cost!r}")
+    if balances:
+        result = balances.debit(card_id, cost)
+        if not (result and result[0]):
+            return None
+        metrics.COINS_DEBITED.inc(cost)
+        return result[2]
+    conn = get_db()
+    try:
+        c = conn.execute("UPDATE USERS SET balance = balance - ? WHERE card_id = ? AND balance >= ?",
+                         (cost, card_id, cost))
+        if not c.rowcount:
+            return None
+        new_balance = conn.execute("SELECT balance FROM USERS WHERE card_id=?", (card_id,)).fetchone()[0]
+        conn.commit()
+        metrics.COINS_DEBITED.inc(cost)
+        return new_balance
+    finally:
+        conn.close()
+
+def read_source():
+    """
+    (database file, data age) for this request's reads. Admin reads may
+    bypass the replica with ?fresh=1 or an X-Fresh-Read: 1 header.
+    """
+    fresh = request.args.get("fresh") == "1" or request.headers.get("X-Fresh-Read") == "1"
+    return read_replica.source(fresh)
+
+def data_age_header(age):
+    """Tell the client how old the data it got is"""
+    return {"X-Data-Age": f"{age:.1f}"}
+
+def admin_required(view):
+    """Guard for operator-only endpoints"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if ADMIN_TOKEN:
+            if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN):
+                return jsonify({"error": "Admin token required"}), 403
+        elif request.remote_addr not in ("127.0.0.1", "::1"):
+            return jsonify({"error": "Set ADMIN_TOKEN to use admin endpoints remotely"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+def device_id():
+    """Identity a device sends with OTA requests (X-Device-Id header or ?device=), e.g. its MAC"""
+    return request.headers.get("X-Device-Id") or request.args.get("device")
+
+def busy_response(e):
+    """503 asking a device to come back later (rollout budget used up or paused)"""
+    return jsonify({"error": str(e), "retry_after": e.retry_after}), 503, {"Retry-After": str(e.retry_after)}
+
+def release_on_close(response, release):
+    """
+    Run `release` once the server closes the response body. A file
+    wrapper's own close() is chained, so the response stays
+    direct_passthrough and the server can still use sendfile().
+    """
+    body = response.response
+    if hasattr(body, "close"):
+        close = body.close
+
+        def closing():
+            try:
+                close()
+            finally:
+                release()
+        body.close = closing
+    else:
+        # Nothing to stream (X-Sendfile): Werkzeug closes its own iterator
+        response.direct_passthrough = False
+        response.call_on_close(release)
+
+def current_firmware_sha256():
+    """SHA-256 of the image a device says it runs (?from=<sha256> or ?from_version=<version>)"""
+    if request.args.get("from"):
+        return request.args["from"].lower()
+    if request.args.get("from_version"):
+        entry = firmware_catalog.find_version(request.args["from_version"])
+        return entry["sha256"] if entry else None
+    return None
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def get_firmware_files():
-    """Get list of uploaded firmware files"""
-    files = []
-    if os.path.exists(UPLOAD_FOLDER):
-        for filename in os.listdir(UPLOAD_FOLDER):
-            if filename.endswith('.bin'):
-                filepath = os.path.join(UPLOAD_FOLDER, filename)
-                size = os.path.getsize(filepath)
-                size_str = f"{size / 1024:.1f} KB" if size < 1024*1024 else f"{size / (1024*1024):.1f} MB"
-                files.append({'name': filename, 'size': size_str})
-    return files
+    """Get list of uploaded firmware files from the catalog (no filesystem access)"""
+    return [{'name': entry['filename'], 'size': ota.format_size(entry['size']),
+             'version': entry['version'], 'board': entry['target_board']}
+            for entry in firmware_catalog.list()]
+
+@app.before_request
+def track_request_rate():
+    """Feed the maintenance scheduler's quiet-window detection"""
+    if not request.environ.get("gateway.request_noted"):
+        scheduler.note_request()
 
 @app.route("/")
 def index():
     """Main dashboard page"""
     try:
-        conn = get_db()
+        path, age = read_source()
+        conn = read_replica.connect(path)
         c = conn.cursor()
        
         c.execute("SELECT id, username, card_id, balance FROM USERS ORDER BY id DESC")
@@ -716,10 +974,18 @@ def index():
        
         conn.close()
        
+        if balances:
+            # USERS lags the engine until the next checkpoint
+            users = [(uid, name, card, (balances.lookup(card) or (name, bal))[1])
+                     for uid, name, card, bal in users]
+            total_balance = balances.total()
+       
         firmware_files = get_firmware_files()
        
-        return render_template_string(template, users=users, logs=logs, 
-                                     total_balance=total_balance, firmware_files=firmware_files)
+        return render_template(dashboard_template(), users=users, logs=logs,
+                               total_balance=total_balance, firmware_files=firmware_files,
+                               slow_queries=querylog.SLOW_QUERIES.report(20)), \
+            200, data_age_header(age)
     except Exception as e:
         return f"Error: {str(e)}", 500
 
@@ -747,6 +1013,9 @@ def add_user():
         conn.commit()
         conn.close()
        
+        if balances:
+            balances.register(card_id, username, balance)
+       
         log_action(card_id, username, f"User added with balance {balance}", balance)
        
         return redirect("/#show-users")
@@ -759,27 +1028,35 @@ def add_user():
 def update_balance():
     """Update user balance"""
     try:
-        card_id = request.form.get("card_id", "").strip()
-        added = int(request.form.get("balance", 0))
+        with tracing.span("form_parse"):
+            card_id = request.form.get("card_id", "").strip()
+            added = int(request.form.get("balance", 0))
        
         if not card_id or added <= 0:
             return "Invalid input", 400
        
-        conn = get_db()
-        c = conn.cursor()
-       
-        c.execute("UPDATE USERS SET balance = balance + ? WHERE card_id = ?", (added, card_id))
-       
-        c.execute("SELECT balance, username FROM USERS WHERE card_id=?", (card_id,))
-        row = c.fetchone()
-       
-        if not row:
-            conn.close()
-            return "User not found", 404
-       
-        balance, username = row
-        conn.commit()
-        conn.close()
+        with tracing.span("credit", amount=added):
+            if balances:
+                result = balances.credit(card_id, added)
+                if not result:
+                    return "User not found", 404
+                username, balance = result
+            else:
+                conn = get_db()
+                c = conn.cursor()
+               
+                c.execute("UPDATE USERS SET balance = balance + ? WHERE card_id = ?", (added, card_id))
+               
+                c.execute("SELECT balance, username FROM USERS WHERE card_id=?", (card_id,))
+                row = c.fetchone()
+               
+                if not row:
+                    conn.close()
+                    return "User not found", 404
+               
+                balance, username = row
+                conn.commit()
+                conn.close()
        
         log_action(card_id, username, f"Balance added +{added}", balance)
        
@@ -791,34 +1068,31 @@ def update_balance():
 def spend():
     """Process spending transaction"""
     try:
-        card_id = request.form.get("card_id", "").strip()
-        hours = int(request.form.get("hours", 1))
+        with tracing.span("form_parse"):
+            card_id = request.form.get("card_id", "").strip()
+            hours = int(request.form.get("hours", 1))
         cost = hours
        
         if not card_id:
             return "Card ID required", 400
+        if cost <= 0:
+            return "Hours must be at least 1", 400
        
-        conn = get_db()
-        c = conn.cursor()
-       
-        c.execute("SELECT balance, username FROM USERS WHERE card_id=?", (card_id,))
-        row = c.fetchone()
+        with tracing.span("user_lookup"):
+            row = find_user(card_id)
        
         if not row:
-            conn.close()
             return "User not found", 404
        
-        balance, username = row
+        username, balance = row
        
-        if balance < cost:
-            conn.close()
+        with tracing.span("balance_check", balance=balance, cost=cost):
+            sufficient = balance >= cost
+        with tracing.span("debit"):
+            new_balance = debit_card(card_id, cost) if sufficient else None
+        if new_balance is None:
             return f"Insufficient balance! Current: {balance}, Required: {cost}", 400
        
-        new_balance = balance - cost
-        c.execute("UPDATE USERS SET balance=? WHERE card_id=?", (new_balance, card_id))
-        conn.commit()
-        conn.close()
-       
         log_action(card_id, username, f"Used {hours} hour(s) - {cost} coin(s)", new_balance)
        
         return redirect("/#spending")
@@ -831,68 +1105,87 @@ def scan_card():
     Handle RFID card scanning from ESP32
     This is the main endpoint ESP32 uses for transactions
     """
-    global LAST_RFID
-    
-    try:
+    with tracing.span("json_parse"):
         data = request.get_json(silent=True) or {}
+    result, status = process_scan(data)
+    with tracing.span("serialize"):
+        return jsonify(result), status
+
+def process_scan(data):
+    """
+    The card transaction behind /scan_card for a parsed request body;
+    returns (response body, status). gateway.py calls it too.
+    """
+    try:
         card_id = data.get("card_id", "").strip()
         coins = data.get("coins", 0)  # Number of coins from ESP32
         machine_id = data.get("machine_id", "unknown")
        
         if not card_id:
-            return jsonify({
+            scan_event("invalid", logging.WARNING, machine_id=machine_id)
+            return {
                 "success": False,
                 "user_exists": False,
                 "activate_machine": False,
                 "message": "No card_id provided"
-            }), 400
+            }, 400
+
+        # 0 (or no coins) is a display scan; anything else must be a whole number of coins to take
+        if isinstance(coins, bool) or not isinstance(coins, int) or coins < 0:
+            scan_event("invalid", logging.WARNING, card_id=card_id, machine_id=machine_id)
+            return {
+                "success": False,
+                "user_exists": False,
+                "activate_machine": False,
+                "message": "coins must be a non-negative integer"
+            }, 400
        
-        # Cache the card for web interface
-        LAST_RFID = {
+        # Cache the card for web interface (shared by all worker processes)
+        shared.LAST_SCAN.put({
             "card_id": card_id,
             "coins": coins,
             "machine_id": machine_id,
             "timestamp": datetime.now().isoformat()
-        }
+        })
        
         # Get user info
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT username, balance FROM USERS WHERE card_id=?", (card_id,))
-        row = c.fetchone()
+        with tracing.span("user_lookup"):
+            row = find_user(card_id)
        
         if not row:
-            conn.close()
-            print(f"✗ Unregistered card: {card_id}")
-            return jsonify({
+            scan_event("unregistered", card_id=card_id, machine_id=machine_id)
+            return {
                 "success": False,
                 "user_exists": False,
                 "activate_machine": False,
                 "message": "Card not registered",
                 "card_id": card_id
-            })
+            }, 200
        
         username, balance = row
        
         # Check if this is just a display scan (no coins) or actual transaction
         if coins == 0:
             # Just displaying card info
-            conn.close()
-            print(f"✓ Card displayed: {username} (Balance: {balance})")
-            return jsonify({
+            scan_event("display", logging.DEBUG, card_id=card_id, machine_id=machine_id, balance=balance)
+            return {
                 "success": True,
                 "user_exists": True,
                 "activate_machine": False,
                 "message": f"Welcome {username}",
                 "username": username,
                 "balance": balance
-            })
+            }, 200
        
-        # Transaction with coins - check balance
-        if balance < coins:
-            conn.close()
-            print(f"✗ Insufficient balance: {username} needs {coins}, has {balance}")
-            return jsonify({
+        # Transaction with coins - check balance and deduct
+        with tracing.span("balance_check", balance=balance, coins=coins):
+            sufficient = balance >= coins
+        with tracing.span("debit"):
+            new_balance = debit_card(card_id, coins) if sufficient else None
+        if new_balance is None:
+            scan_event("insufficient", card_id=card_id, machine_id=machine_id, username=username,
+                       coins=coins, balance=balance)
+            return {
                 "success": False,
                 "user_exists": True,
                 "activate_machine": False,
@@ -900,22 +1193,17 @@ def scan_card():
                 "username": username,
                 "balance": balance,
                 "coins_required": coins
-            })
-       
-        # Sufficient balance - deduct and activate machine
-        new_balance = balance - coins
-        c.execute("UPDATE USERS SET balance=? WHERE card_id=?", (new_balance, card_id))
-        conn.commit()
-        conn.close()
+            }, 200
        
         # Log transaction
         log_action(card_id, username, 
                   f"Machine {machine_id} used {coins} coin(s)", 
                   new_balance)
        
-        print(f"✓ Transaction approved: {username} used {coins} coins, new balance: {new_balance}")
+        scan_event("approved", card_id=card_id, machine_id=machine_id, username=username,
+                   coins=coins, balance=new_balance)
        
-        return jsonify({
+        return {
             "success": True,
             "user_exists": True,
             "activate_machine": True,
@@ -924,77 +1212,463 @@ def scan_card():
             "balance": new_balance,
             "coins_used": coins,
             "machine_id": machine_id
-        })
+        }, 200
        
     except Exception as e:
-        print("Error processing card:", e)
-        return jsonify({
-            "success": False,
-            "user_exists": False,
-            "activate_machine": False,
-            "error": str(e)
-        }), 500
+        return scan_failed(e)
+
+def scan_failed(e):
+    """Log a scan that raised `e` (call from its except block); returns the 500 answer for the device"""
+    log.error("scan_card", exc_info=True, extra={"fields": {"outcome": "error"}})
+    metrics.SCAN_OUTCOMES.inc(outcome="error")
+    return {
+        "success": False,
+        "user_exists": False,
+        "activate_machine": False,
+        "error": str(e)
+    }, 500
+
+@app.route("/api/logs", methods=["GET"])
+def api_logs():
+    """Transaction logs spanning the hot table and the monthly archives"""
+    try:
+        limit = max(1, min(int(request.args.get("limit", 100)), 5000))
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+    try:
+        path, age = read_source()
+        rows = retention.query_logs(
+            path,
+            card_id=request.args.get("card_id") or None,
+            start=request.args.get("start") or None,
+            end=request.args.get("end") or None,
+            limit=limit
+        )
+        keys = ("id", "card_id", "username", "action", "balance", "timestamp")
+        return jsonify({"success": True, "logs": [dict(zip(keys, row)) for row in rows]}), \
+            200, data_age_header(age)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/report/daily", methods=["GET"])
+def api_daily_report():
+    """Per-day, per-card totals including archived days"""
+    try:
+        path, age = read_source()
+        rows = retention.daily_report(
+            path,
+            card_id=request.args.get("card_id") or None,
+            start=request.args.get("start") or None,
+            end=request.args.get("end") or None
+        )
+        keys = ("day", "card_id", "username", "entries", "coins_used", "coins_added", "last_balance")
+        return jsonify({"success": True, "days": [dict(zip(keys, row)) for row in rows]}), \
+            200, data_age_header(age)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/maintenance", methods=["GET"])
+def api_maintenance():
+    """Maintenance job schedule, recent run metrics and replica state"""
+    return jsonify(dict(scheduler.status(), replica=read_replica.status(), mirror=release_mirror.status()))
+
+@app.route("/api/profiling", methods=["GET", "POST"])
+@admin_required
+def api_profiling():
+    """
+    GET: profiler settings and stored profiles.
+    POST {"enabled", "method": "sample"|"cprofile", "fraction", "slow_ms", "routes": [...]}: change them.
+    """
+    try:
+        if request.method == "POST":
+            data = request.get_json(silent=True) or {}
+            profiler.configure(data.get("enabled"), data.get("method"), data.get("fraction"),
+                               data.get("slow_ms"), data.get("routes"))
+            print(f"✓ Profiling {'on' if profiler.enabled else 'off'}: {profiler.settings()}")
+        return jsonify({"settings": profiler.settings(), "profiles": profiler.list()})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/tracing", methods=["GET", "POST"])
+@admin_required
+def api_tracing():
+    """
+    GET: tracer settings, export counters and p50/p99 per span name.
+    POST {"sample_rate", "slow_ms"}: change the sampling.
+    """
+    try:
+        if request.method == "POST":
+            data = request.get_json(silent=True) or {}
+            tracer.configure(data.get("sample_rate"), data.get("slow_ms"))
+            print(f"✓ Tracing: {tracer.settings()}")
+        return jsonify(tracer.status())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/slow_queries", methods=["GET", "POST", "DELETE"])
+@admin_required
+def api_slow_queries():
+    """
+    GET: slowest statements with their plans, and recent slow occurrences.
+    POST {"threshold_ms"}: change the threshold (0 switches the log off). DELETE: clear the log.
+    """
+    try:
+        if request.method == "POST":
+            data = request.get_json(silent=True) or {}
+            settings = querylog.SLOW_QUERIES.configure(data.get("threshold_ms"))
+            print(f"✓ Slow-query log: {settings}")
+        elif request.method == "DELETE":
+            querylog.SLOW_QUERIES.clear()
+        return jsonify(querylog.SLOW_QUERIES.report(int(request.args.get("limit", 50))))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/capture", methods=["GET", "POST"])
+@admin_required
+def api_capture():
+    """
+    GET: /scan_card capture state and files.
+    POST {"enabled": true|false}: start or stop recording.
+    """
+    try:
+        if request.method == "POST":
+            data = request.get_json(silent=True) or {}
+            if data.get("enabled"):
+                scan_recorder.start()
+            else:
+                scan_recorder.stop()
+                print("✓ /scan_card capture stopped")
+        return jsonify(scan_recorder.status())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/memory", methods=["GET", "POST"])
+@admin_required
+def api_memory():
+    """
+    GET: tracemalloc state, RSS, stored snapshots and our structure sizes; ?types=1 adds live object counts.
+    POST {"action": "start"|"stop"|"snapshot", "frames", "label"}: control tracing and take snapshots.
+    """
+    try:
+        if request.method == "POST":
+            data = request.get_json(silent=True) or {}
+            action = data.get("action")
+            if action == "start":
+                memory.start(data.get("frames"))
+                print(f"✓ tracemalloc started ({memory.frames} frame(s))")
+            elif action == "stop":
+                memory.stop()
+                print("✓ tracemalloc stopped")
+            elif action == "snapshot":
+                return jsonify(memory.snapshot(data.get("label")))
+            else:
+                return jsonify({"error": "action must be start, stop or snapshot"}), 400
+        status = memory.status()
+        if request.args.get("types") == "1":
+            status["types"] = memory.type_counts(int(request.args.get("limit", 30)))
+        return jsonify(status)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/memory/snapshots/<int:snapshot_id>", methods=["GET"])
+@admin_required
+def api_memory_top(snapshot_id):
+    """Top allocators of one snapshot; ?key=lineno|filename|traceback&limit=20"""
+    try:
+        return jsonify(memory.top(snapshot_id, request.args.get("key", "lineno"),
+                                  int(request.args.get("limit", 20))))
+    except KeyError as e:
+        return jsonify({"error": e.args[0]}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route("/api/memory/diff/<int:old_id>/<int:new_id>", methods=["GET"])
+@admin_required
+def api_memory_diff(old_id, new_id):
+    """Allocation growth between two snapshots, grouped by file and line (?key=, ?limit=)"""
+    try:
+        return jsonify(memory.diff(old_id, new_id, request.args.get("key", "lineno"),
+                                   int(request.args.get("limit", 20))))
+    except KeyError as e:
+        return jsonify({"error": e.args[0]}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route("/api/profiling/<name>", methods=["GET"])
+@admin_required
+def api_profile_download(name):
+    """One stored profile; ?format=text renders a .prof as a pstats table"""
+    path = profiler.path(name)
+    if not path:
+        return jsonify({"error": "Profile not found"}), 404
+    if request.args.get("format") == "text" and name.endswith(".prof"):
+        return profiler.text_report(name), 200, {"Content-Type": "text/plain; charset=utf-8"}
+    return send_from_directory(profiler.folder, name, as_attachment=True)
 
 @app.route("/get_last_card", methods=["GET"])
 def get_last_card():
     """Web interface polls for last scanned card"""
-    global LAST_RFID
-    
-    if LAST_RFID:
-        response = {"card_id": LAST_RFID.get("card_id")}
-        LAST_RFID = None  # Clear after reading
-        return jsonify(response)
+    scan = shared.LAST_SCAN.pop()  # Clear after reading
+    if scan:
+        return jsonify({"card_id": scan.get("card_id")})
     else:
         return jsonify({"error": "No card data available"}), 404
 
 @app.route("/upload_firmware", methods=["POST"])
 def upload_firmware():
-    """Upload firmware .bin file for OTA"""
+    """Upload firmware .bin file for OTA, streamed to disk while it is hashed"""
     try:
-        if 'firmware' not in request.files:
-            return jsonify({"error": "No file provided"}), 400
-        
-        file = request.files['firmware']
+        # Parse the body ourselves; touching request.files would spool it first
+        original_name, upload = ota.receive_upload(request.stream, request.mimetype,
+                                                   request.content_length, request.mimetype_params,
+                                                   UPLOAD_FOLDER)
         
-        if file.filename == '':
-            return jsonify({"error": "No file selected"}), 400
-        
-        if not allowed_file(file.filename):
+        if not allowed_file(original_name):
+            upload.discard()
             return jsonify({"error": "Only .bin files allowed"}), 400
         
-        # Secure filename and save
-        filename = secure_filename(file.filename)
-        
-        # Add timestamp to avoid conflicts
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        base_name = filename.rsplit('.', 1)[0]
-        filename = f"{base_name}_{timestamp}.bin"
-        
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)
+        entry, duplicate = ota.store_upload(original_name, upload, firmware_catalog)
+        filename, file_size, sha256 = entry['filename'], entry['size'], entry['sha256']
         
-        file_size = os.path.getsize(filepath)
-        print(f"✓ Firmware uploaded: {filename} ({file_size} bytes)")
+        if duplicate:
+            print(f"✓ Firmware already stored as {filename}")
+            message = f"Identical firmware already uploaded: {filename}"
+        else:
+            print(f"✓ Firmware uploaded: {filename} ({file_size} bytes)")
+            message = f"Firmware uploaded: {filename}"
         
         return jsonify({
             "success": True,
-            "message": f"Firmware uploaded: {filename}",
+            "message": message,
             "filename": filename,
-            "size": file_size
+            "size": file_size,
+            "sha256": sha256,
+            "duplicate": duplicate
         })
         
+    except ota.FirmwareRejected as e:
+        print(f"✗ Upload rejected: {e}")
+        return jsonify({"error": str(e)}), e.status
+    except RequestEntityTooLarge:
+        return jsonify({"error": f"Firmware larger than {ota.MAX_FIRMWARE_SIZE} bytes"}), 413
     except Exception as e:
         print(f"✗ Upload error: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/firmware/manifest.json")
+def firmware_manifest():
+    """Catalog of available firmware for devices, with ETag revalidation"""
+    body, etag = firmware_catalog.manifest_json()
+    if request.if_none_match.contains(etag):
+        return "", 304, {"ETag": f'"{etag}"'}
+    return body, 200, {"Content-Type": "application/json", "ETag": f'"{etag}"',
+                       "Cache-Control": "no-cache"}
+
+@app.route("/firmware/latest")
+def firmware_latest():
+    """
+    Version check for devices: {version, url, size, sha256} of the newest
+    image (?asset=<release asset name> picks one board's build). Send the
+    returned ETag as If-None-Match; an unchanged answer is an empty 304.
+    During a staged rollout, devices outside the current wave are offered
+    the rollout's base image instead.
+    """
+    try:
+        latest = release_mirror.latest(request.args.get("asset"))
+        if not latest:
+            return jsonify({"error": "No firmware available"}), 404
+        offered = firmware_rollouts.resolve(latest["filename"], device_id())
+        if offered != latest["filename"]:
+            entry = firmware_catalog.get(offered) if offered else None
+            if not entry:
+                return jsonify({"error": "No firmware available"}), 404
+            latest = {"version": entry["version"], "filename": offered, "url": f"/firmware/{offered}",
+                      "size": entry["size"], "sha256": entry["sha256"]}
+        patch = firmware_deltas.find(current_firmware_sha256(), firmware_catalog.get(latest["filename"]))
+        if patch:
+            latest["patch"] = {"url": f"/firmware/{latest['filename']}/delta?from={patch['from_sha256']}",
+                               "size": patch["size"], "sha256": patch["sha256"]}
+        etag = f"{latest['sha256'][:32]}-{latest['version'] or ''}" + ("-patch" if patch else "")
+        if request.if_none_match.contains(etag):
+            return "", 304, {"ETag": f'"{etag}"'}
+        return jsonify(latest), 200, {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/mirror/sync", methods=["POST"])
+@admin_required
+def mirror_sync():
+    """Check GitHub for a new release now instead of waiting for the schedule"""
+    try:
+        result = release_mirror.sync()
+        print(f"✓ Release mirror: {result}")
+        return jsonify(dict(result, success=True))
+    except Exception as e:
+        print(f"✗ Release mirror sync failed: {e}")
+        return jsonify({"error": str(e)}), 502
+
 @app.route("/firmware/<filename>")
 def download_firmware(filename):
-    """Download firmware file (for ESP32 OTA)"""
+    """
+    Download firmware file (for ESP32 OTA)
+
+    - ETag is the image's SHA-256 (strong); If-None-Match answers 304
+    - Range: bytes=N- resumes a dropped download with 206 Partial Content;
+      If-Range with the ETag makes the resume safe against a replaced file
+    - X-Firmware-SHA256 lets the device verify the finished image
+    - Accept-Encoding: gzip gets the precompressed artifact with
+      Content-Encoding: gzip; Content-Length and ranges then refer to the
+      compressed bytes and X-Firmware-Size gives the image size
+    - The body is a file wrapper, so servers with wsgi.file_wrapper use
+      sendfile(); USE_X_SENDFILE=1 hands the file to a fronting proxy
+    - While the image is being rolled out, only devices in the current
+      wave (by X-Device-Id) may download it and only max_concurrent at
+      once; others get 503 with Retry-After. A download holds its slot
+      until the server closes the body (sendfile still applies).
+    """
+    release = None
     try:
-        return send_from_directory(UPLOAD_FOLDER, filename, as_attachment=True)
+        entry = firmware_catalog.get(filename)
+        if not entry:
+            return jsonify({"error": "Firmware not found"}), 404
+        release = firmware_rollouts.admit(filename, device_id())
+        artifact = firmware_artifacts.get(filename) if request.accept_encodings["gzip"] else None
+        if artifact:
+            response = send_from_directory(firmware_artifacts.folder, artifact[0], as_attachment=True,
+                                           download_name=filename, mimetype="application/octet-stream",
+                                           etag=f"{entry['sha256']}-gzip", conditional=True,
+                                           max_age=FIRMWARE_MAX_AGE)
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = send_from_directory(UPLOAD_FOLDER, filename, as_attachment=True,
+                                           mimetype="application/octet-stream",
+                                           etag=entry['sha256'], conditional=True,
+                                           max_age=FIRMWARE_MAX_AGE)
+        response.vary.add("Accept-Encoding")
+        response.headers["X-Firmware-SHA256"] = entry['sha256']
+        response.headers["X-Firmware-Size"] = str(entry['size'])
+        if response.status_code in (200, 206):
+            metrics.FIRMWARE_BYTES.inc(response.content_length or 0, kind="gzip" if artifact else "full")
+        if release:
+            release_on_close(response, release)
+        return response
+    except ota_rollout.RolloutBusy as e:
+        return busy_response(e)
     except Exception as e:
+        if release:
+            release()
         return jsonify({"error": str(e)}), 404
 
+@app.route("/firmware/<filename>/delta")
+def download_firmware_delta(filename):
+    """
+    bsdiff patch from the image the device runs (?from=<sha256> or
+    ?from_version=) to `filename`. 404 with the full image's URL when no
+    worthwhile patch is cached; the device then downloads that instead.
+    X-Firmware-SHA256 is the patched result's hash. Counts against the
+    rollout's download budget like the full image.
+    """
+    release = None
+    try:
+        entry = firmware_catalog.get(filename)
+        if not entry:
+            return jsonify({"error": "Firmware not found"}), 404
+        patch = firmware_deltas.find(current_firmware_sha256(), entry)
+        if not patch:
+            return jsonify({"error": "No patch available", "url": f"/firmware/{filename}"}), 404
+        release = firmware_rollouts.admit(filename, device_id())
+        response = send_from_directory(firmware_deltas.folder, patch['filename'],
+                                       mimetype="application/octet-stream",
+                                       etag=patch['sha256'], conditional=True,
+                                       max_age=FIRMWARE_MAX_AGE)
+        response.headers["X-Firmware-SHA256"] = entry['sha256']
+        response.headers["X-Patch-From-SHA256"] = patch['from_sha256']
+        if response.status_code in (200, 206):
+            metrics.FIRMWARE_BYTES.inc(response.content_length or 0, kind="delta")
+        if release:
+            release_on_close(response, release)
+        return response
+    except ota_rollout.RolloutBusy as e:
+        return busy_response(e)
+    except Exception as e:
+        if release:
+            release()
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/firmware/deltas", methods=["GET"])
+def api_firmware_deltas():
+    """Cached patches with their size against the full image and generation time"""
+    return jsonify({"enabled": firmware_deltas.enabled, "deltas": firmware_deltas.report()})
+
+@app.route("/api/firmware/report", methods=["POST"])
+def firmware_report():
+    """
+    Device reports the outcome of an update:
+    {"device_id", "sha256" (of the image it tried), "success": bool, "detail"}
+    """
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"error": "JSON body required"}), 400
+        reporter = data.get("device_id") or device_id()
+        if not reporter or not isinstance(data.get("sha256"), str) or not data["sha256"]:
+            return jsonify({"error": "device_id and sha256 required"}), 400
+        rollout = firmware_rollouts.report(reporter, data["sha256"].lower(), bool(data.get("success")),
+                                           data.get("detail"))
+        if not data.get("success"):
+            applog.event(log, logging.WARNING, "ota_failed", device_id=reporter, sha256=data["sha256"],
+                         detail=data.get("detail"))
+        return jsonify({"success": True, "rollout": rollout["id"] if rollout else None,
+                        "rollout_state": rollout["state"] if rollout else None})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/rollout", methods=["GET", "POST"])
+@admin_required
+def api_rollout():
+    """GET: active and paused rollouts. POST {"filename", "waves": "5,25,100", "max_concurrent"}: start one"""
+    try:
+        if request.method == "GET":
+            return jsonify({"rollouts": firmware_rollouts.status()})
+        data = request.get_json()
+        rollout = firmware_rollouts.start(secure_filename(data.get("filename", "")), data.get("waves"),
+                                          data.get("max_concurrent"))
+        return jsonify({"success": True, "rollout": rollout})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/rollout/<int:rollout_id>/<action>", methods=["POST"])
+@admin_required
+def api_rollout_action(rollout_id, action):
+    """pause, resume, advance (next wave now) or cancel a rollout"""
+    try:
+        return jsonify({"success": True, "rollout": firmware_rollouts.set_state(rollout_id, action)})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/firmware/gc", methods=["POST"])
+@admin_required
+def firmware_gc():
+    """Apply the firmware retention policy now ({"dry_run": true} only reports)"""
+    try:
+        data = request.get_json(silent=True) or {}
+        result = firmware_retention.run(dry_run=bool(data.get("dry_run")))
+        return jsonify(dict(result, success=True))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/delete_firmware", methods=["POST"])
 def delete_firmware():
     """Delete firmware file"""
@@ -1008,7 +1682,7 @@ def delete_firmware():
         filepath = os.path.join(UPLOAD_FOLDER, secure_filename(filename))
         
         if os.path.exists(filepath):
-            os.remove(filepath)
+            firmware_retention.remove(secure_filename(filename))
             print(f"✓ Firmware deleted: {filename}")
             return jsonify({"success": True, "message": "File deleted"})
         else:
@@ -1017,12 +1691,80 @@ def delete_firmware():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-if __name__ == "__main__":
+def startup(leader=True):
+    """
+    Open the database and start the background jobs; returns how long each
+    step took (ms). Under a multi-process server every worker calls this,
+    and only the leader runs the maintenance jobs and the firmware backfill.
+    """
+    global balances
+    timings = {}
+    started = step = time.perf_counter()
+
+    def done(name):
+        nonlocal step
+        now = time.perf_counter()
+        timings[name] = round((now - step) * 1000, 1)
+        step = now
+
+    init_db()
+    done("init_db")
+    if balance_engine.BALANCE_ENGINE_ENABLED:
+        balances = balance_engine.BalanceEngine(DB_PATH, os.path.join(DB_DIR, "journal")).open()
+        scheduler.add_job("balance_checkpoint", balances.checkpoint, balance_engine.CHECKPOINT_SCHEDULE)
+        atexit.register(balances.checkpoint)
+        done("balance_engine")
+    if ota_mirror.GITHUB_MIRROR_ENABLED:
+        scheduler.add_job("release_mirror", release_mirror.sync, ota_mirror.MIRROR_SCHEDULE)
+    if capture.CAPTURE_ENABLED:
+        scan_recorder.start()
+    atexit.register(scan_recorder.stop)
+    if leader:
+        scheduler.start()
+        done("scheduler")
+    # Nothing below is needed to approve a coin, so it runs while the server already listens
+    threading.Thread(target=prewarm, args=(leader,), name="prewarm", daemon=True).start()
+    timings["total"] = round((time.perf_counter() - started) * 1000, 1)
+    return timings
+
+def prewarm(leader=True):
+    """Startup work that can wait: the page cache, then caches and firmware artifacts"""
+    started = time.perf_counter()
+    try:
+        conn = get_db()
+        try:
+            # Read USERS and its card_id index once so the first scans find them in the page cache
+            conn.execute("SELECT count(card_id) FROM USERS WHERE card_id > ''").fetchone()
+            conn.execute("SELECT sum(balance) FROM USERS").fetchone()
+        finally:
+            conn.close()
+        # Machines that queued up during the restart go first; compiling templates holds the GIL
+        time.sleep(PREWARM_DELAY)
+        dashboard_template()
+        if leader:
+            firmware_artifacts.backfill()
+        if read_replica.enabled:
+            read_replica.refresh_async()
+        applog.event(log, logging.INFO, "prewarm_done",
+                     ms=round((time.perf_counter() - started - PREWARM_DELAY) * 1000, 1))
+    except Exception:
+        log.error("prewarm_failed", exc_info=True)
+
+def main(host="0.0.0.0", port=5000):
+    """Development server (Werkzeug); see server.py for the production one"""
     print("╔════════════════════════════════════════╗")
     print("║   Laundry Management System v2.0       ║")
     print("║   With OTA Update Support              ║")
     print("╚════════════════════════════════════════╝")
-    init_db()
-    print("✓ Starting Flask server on http://0.0.0.0:5000")
+    timings = startup()
+    print(f"✓ Log retention: keeping {retention.LOG_RETENTION_DAYS} days in the hot table")
+    print(f"✓ Backups at '{backup.BACKUP_SCHEDULE}' to {backup.BACKUP_DIR} (keeping {backup.BACKUP_KEEP})")
+    print(f"✓ Maintenance scheduler: {', '.join(scheduler.jobs)}")
+    steps = ", ".join(f"{name} {ms} ms" for name, ms in timings.items() if name != "total")
+    print(f"✓ Startup took {timings['total']} ms ({steps})")
+    print(f"✓ Starting Flask server on http://{host}:{port}")
     print("✓ OTA firmware folder:", UPLOAD_FOLDER)
-    app.run(host="0.0.0.0", port=5000, debug=False)
+    app.run(host=host, port=port, debug=False)
+
+if __name__ == "__main__":
+    main()